@@ -14,14 +14,280 @@ function on_load() {
             columns.forEach(function (col) {
                 $('<td/>').html(c.fields[col]).appendTo(row);
             });
-            row.click(function () { $('#content-pane').load(c.content_url); });
-            row.dblclick(function () { $('#content-pane').load(c.content_url); hide_panel(); });
+            row.click(function () { open_sample(c); });
+            row.dblclick(function () { open_sample(c); hide_panel(); });
             row.appendTo('#list-table');
         });
         show_panel();
     }
 
 
+    // Browsers that can draw on a canvas and read binary responses
+    // fetch the whole sample as a track file and draw it themselves;
+    // the others fill the frame's tiles with HTML from the server.
+    var can_draw = !!(window.ArrayBuffer && window.DataView &&
+                      document.createElement('canvas').getContext);
+
+    function open_sample(c) {
+        // Either way of drawing may have been used for the last sample.
+        $(window).unbind('resize.tracks resize.tiles');
+        $('#content-pane').load(c.content_url, function () {
+            if (can_draw && c.data_url) {
+                fetch_track_file(c.data_url, draw_tracks, load_tiles);
+            } else {
+                load_tiles();
+            }
+        });
+    }
+
+    function fetch_track_file(url, success, failure) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', url, true);
+        xhr.responseType = 'arraybuffer';
+        xhr.onload = function () {
+            var tracks;
+            if (xhr.status !== 200 || !xhr.response) {
+                failure();
+                return;
+            }
+            try {
+                tracks = parse_track_file(xhr.response);
+            } catch (e) {
+                failure();
+                return;
+            }
+            success(tracks);
+        };
+        xhr.onerror = failure;
+        xhr.send();
+    }
+
+    // Read a track file (see trackfile.py) into {meta, entries}.  The
+    // arrays of each entry are typed array views onto the buffer.
+    // Quantized trace points are in units of 1/meta.trace_scale.
+    var header_size = 32, entry_size = 80;
+    var kinds = ['Sequence', 'Numeric', 'Traces'];
+    var array_types = {'<f8': window.Float64Array, '<f4': window.Float32Array,
+                       '<i4': window.Int32Array, '<u4': window.Uint32Array,
+                       '<i2': window.Int16Array, '<u2': window.Uint16Array,
+                       '|i1': window.Int8Array, '|u1': window.Uint8Array};
+
+    function parse_track_file(buf) {
+        var view = new DataView(buf);
+        var u64 = function (at) {
+            return view.getUint32(at, true) + view.getUint32(at + 4, true) * 4294967296;
+        };
+        var i64 = function (at) {
+            return view.getUint32(at, true) + view.getInt32(at + 4, true) * 4294967296;
+        };
+        var text = function (start, size) {
+            var bytes = new Uint8Array(buf, start, size), s = '', i;
+            for (i = 0; i < size; i += 1) {
+                s += String.fromCharCode(bytes[i]);
+            }
+            return s;
+        };
+        var numbers = function (dtype, start, count) {
+            var values, i;
+            if (array_types[dtype]) {
+                return new array_types[dtype](buf, start, count);
+            }
+            if (dtype !== '<i8' && dtype !== '<u8') {
+                throw new Error('Cannot read numbers of type ' + dtype);
+            }
+            values = new Float64Array(count);
+            for (i = 0; i < count; i += 1) {
+                values[i] = dtype === '<i8' ? i64(start + 8*i) : u64(start + 8*i);
+            }
+            return values;
+        };
+        var n, meta, entries = [], i, at, e, kind, starts, counts;
+        if (text(0, 4) !== 'SVTS' || view.getUint32(4, true) !== 1) {
+            throw new Error('Not a track file');
+        }
+        n = u64(8);
+        meta = JSON.parse(text(u64(16), u64(24)));
+        for (i = 0; i < n; i += 1) {
+            at = header_size + i * entry_size;
+            kind = kinds[view.getUint8(at + 16)];
+            starts = [u64(at + 32), u64(at + 40), u64(at + 48)];
+            counts = [u64(at + 56), u64(at + 64), u64(at + 72)];
+            e = {name: decodeURIComponent(escape(text(u64(at), u64(at + 8)))),
+                 offset: i64(at + 24), kind: kind};
+            if (kind === 'Sequence') {
+                e.length = counts[0];
+                e.bases = text(starts[0], counts[0]);
+            } else if (kind === 'Numeric') {
+                e.length = counts[0];
+                e.values = numbers(text(at + 17, 7).replace(/\0+$/, ''),
+                                   starts[0], counts[0]);
+                e.gaps = new Uint8Array(buf, starts[1], counts[1]);
+            } else {
+                e.length = counts[1];
+                if (text(at + 17, 7).replace(/\0+$/, '') === '<i2') {
+                    e.points = new Int16Array(buf, starts[0], 2 * counts[0]);
+                    e.scale = 1 / meta.trace_scale;
+                } else {
+                    e.points = new Float32Array(buf, starts[0], 2 * counts[0]);
+                    e.scale = 1;
+                }
+                e.starts = new Int32Array(buf, starts[1], 4 * counts[1]);
+                e.ends = new Int32Array(buf, starts[2], 4 * counts[2]);
+            }
+            entries.push(e);
+        }
+        return {meta: meta, entries: entries};
+    }
+
+    var base_colors = {A: 'green', C: 'blue', T: 'red', G: 'black',
+                       U: 'red', X: 'black'};
+
+    function base_color(base) {
+        return base_colors[base] || 'yellow';
+    }
+
+    // Replace the tiles of the frame in the content pane with a canvas
+    // as wide as the container's view, which follows the view as it
+    // scrolls and draws only the columns in it.  Rows line up with the
+    // frame's labels.
+    function draw_tracks(tracks) {
+        var container = $('#content-pane .scrolling-container')[0];
+        var labels = $('#content-pane .label-column').children();
+        var em, column, first_top, rows, n, height, canvas, ctx;
+        if (!container || labels.length !== tracks.entries.length + 1) {
+            load_tiles();
+            return;
+        }
+        em = parseFloat($(container).css('font-size'));
+        column = 1.3 * em;
+        first_top = labels[0].offsetTop;
+        rows = labels.map(function () {
+            return {top: this.offsetTop - first_top, height: this.offsetHeight};
+        }).get();
+        height = rows[rows.length - 1].top + rows[rows.length - 1].height;
+        n = 0;
+        tracks.entries.forEach(function (e) {
+            n = Math.max(n, e.offset + e.length);
+        });
+
+        $(container).empty();
+        $('<div/>').css({width: n * column + 'px', height: height + 'px'})
+            .appendTo(container);
+        canvas = $('<canvas/>').css({position: 'absolute', top: 0, left: 0})
+            .appendTo(container)[0];
+        ctx = canvas.getContext('2d');
+
+        var draw = function () {
+            var left = container.scrollLeft, width = container.clientWidth;
+            var ratio = window.devicePixelRatio || 1;
+            var first = Math.max(0, Math.floor(left / column));
+            var last = Math.min(n, Math.ceil((left + width) / column));
+            var i;
+            canvas.style.left = left + 'px';
+            if (canvas.width !== Math.round(width * ratio) ||
+                canvas.height !== Math.round(height * ratio)) {
+                canvas.width = Math.round(width * ratio);
+                canvas.height = Math.round(height * ratio);
+                canvas.style.width = width + 'px';
+                canvas.style.height = height + 'px';
+            }
+            ctx.setTransform(ratio, 0, 0, ratio, 0, 0);
+            ctx.clearRect(0, 0, width, height);
+            ctx.textAlign = 'center';
+            ctx.textBaseline = 'middle';
+            ctx.font = Math.round(0.7 * em) + 'px sans-serif';
+            ctx.fillStyle = '#666';
+            for (i = first; i < last; i += 1) {
+                ctx.fillText(String(i), (i + 0.5) * column - left,
+                             rows[0].top + rows[0].height / 2);
+            }
+            ctx.font = em + 'px sans-serif';
+            tracks.entries.forEach(function (e, k) {
+                var lo = Math.max(first, e.offset);
+                var hi = Math.min(last, e.offset + e.length);
+                var x = function (i) { return i * column - left; };
+                if (e.kind === 'Traces') {
+                    draw_traces(ctx, e, lo - e.offset, hi - e.offset,
+                                x(e.offset), column, rows[k + 1]);
+                    return;
+                }
+                for (i = lo; i < hi; i += 1) {
+                    if (e.kind === 'Sequence') {
+                        ctx.fillStyle = base_color(e.bases.charAt(i - e.offset));
+                        ctx.fillText(e.bases.charAt(i - e.offset),
+                                     x(i) + column / 2,
+                                     rows[k + 1].top + rows[k + 1].height / 2);
+                    } else if (!e.gaps[i - e.offset]) {
+                        ctx.fillStyle = 'black';
+                        ctx.fillText(String(e.values[i - e.offset]),
+                                     x(i) + column / 2,
+                                     rows[k + 1].top + rows[k + 1].height / 2);
+                    }
+                }
+            });
+        };
+        $(container).scroll(draw);
+        $(window).unbind('resize.tracks').bind('resize.tracks', draw);
+        draw();
+    }
+
+    // Draw bases lo to hi of the Traces entry e, whose base 0 starts at
+    // x0, with one path per channel.  As in the server's SVGs, each
+    // base's curves run from 0 to 1 across it and from -0.05 to 1 down.
+    function draw_traces(ctx, e, lo, hi, x0, column, row) {
+        var k, j, p, s, end, px, py;
+        ctx.lineWidth = 1;
+        for (k = 0; k < 4; k += 1) {
+            ctx.strokeStyle = base_color('ACTG'.charAt(k));
+            ctx.beginPath();
+            for (j = lo; j < hi; j += 1) {
+                s = e.starts[4*j + k];
+                end = e.ends[4*j + k];
+                for (p = s; p < end; p += 1) {
+                    px = x0 + (j + e.points[2*p] * e.scale) * column;
+                    py = row.top + (e.points[2*p + 1] * e.scale + 0.05) / 1.05 * row.height;
+                    if (p === s) {
+                        ctx.moveTo(px, py);
+                    } else {
+                        ctx.lineTo(px, py);
+                    }
+                }
+            }
+            ctx.stroke();
+        }
+    }
+
+    // The content pane holds a frame of empty .tile placeholders.
+    // Fill the ones in or near view with their columns from the
+    // server, and keep doing so as the frame scrolls.
+    function load_tiles() {
+        $(window).unbind('resize.tiles');
+        $('#content-pane .scrolling-container').each(function () {
+            var container = this;
+            var fill = function () { fill_tiles(container); };
+            $(container).scroll(fill);
+            $(window).bind('resize.tiles', fill);
+            fill();
+        });
+    }
+
+    function fill_tiles(container) {
+        var url = $(container).data('tile-url');
+        var left = container.scrollLeft - container.clientWidth;
+        var right = container.scrollLeft + 2 * container.clientWidth;
+        $(container).children('.tile').each(function () {
+            var tile = $(this);
+            if (tile.data('requested') ||
+                this.offsetLeft + this.offsetWidth < left ||
+                this.offsetLeft > right) {
+                return;
+            }
+            tile.data('requested', true);
+            $.get(url, {start: tile.data('start'), end: tile.data('end')},
+                  function (html) { tile.html(html); });
+        });
+    }
+
     function show_panel() {
         var offset = (n_entries+2) * 1.5 + 0.7;
         $('#list-table').css('display', 'table');
@@ -40,7 +306,7 @@ function on_load() {
     }
 
     $(document).ready(function () {
-        $.getJSON('http://localhost/~ross/web_interface/list.json', load_list);
+        $.getJSON('list.json', load_list);
     });
 }
 
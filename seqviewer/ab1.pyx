@@ -1,142 +1,173 @@
-from libc.stdio cimport fopen, fclose, fseek, fread, FILE, SEEK_SET, ftell
+import mmap
 
 import tracks
+import instrument
 
 import numpy
-cimport numpy
-
-cdef extern from "arpa/inet.h":
-    int ntohl(int)
-    short ntohs(short)
-
-ctypedef struct DirEntry:
-    char[4] name
-    int number
-    short elementtype
-    short elementsize
-    int numelements
-    int datasize
-    int dataoffset
-    int datahandle
-
-cdef short fread_short(FILE *p):
-    cdef short s = 0
-    fread(&s, 2, 1, p)
-    host_s = ntohs(s)
-    return host_s
-
-cdef char fread_byte(FILE *p):
-    cdef char c = 0
-    fread(&c, 1, 1, p)
-    return c
-
-cdef numpy.ndarray fread_byte_array_at(FILE *p, int N, int offset):
-    cdef long return_to = ftell(p)
-    fseek(p, offset, SEEK_SET)
-    cdef numpy.ndarray[numpy.int8_t, ndim=1] arr = numpy.zeros(N, dtype=numpy.byte)
-    cdef int j
-    for j in range(N):
-        arr[j] = fread_byte(p)
-    fseek(p, return_to, SEEK_SET)
-    return arr
-
-cdef numpy.ndarray fread_short_array_at(FILE *p, int N, int offset):
-    cdef long return_to = ftell(p)
-    fseek(p, offset, SEEK_SET)
-    cdef numpy.ndarray[numpy.int16_t, ndim=1] arr = numpy.zeros(N, dtype=numpy.short)
-    cdef int j
-    for j in range(N):
-        arr[j] = fread_short(p)
-    fseek(p, return_to, SEEK_SET)
-    return arr
-
-cdef DirEntry fread_direntry(FILE *p):
-    cdef DirEntry td
-    fread(&td, sizeof(DirEntry), 1, p)
-    td.number = ntohl(td.number)
-    td.elementtype = ntohs(td.elementtype)
-    td.elementsize = ntohs(td.elementsize)
-    td.numelements = ntohl(td.numelements)
-    td.datasize = ntohl(td.datasize)
-    td.dataoffset = ntohl(td.dataoffset)
-    td.datahandle = ntohl(td.datahandle)
-    return td
 
-def read(filename):
-    tmp = filename.encode('UTF-8')
-    cdef char* c_filename = tmp
-    cdef FILE *p
-    p = fopen(c_filename, "rb")
-    if p == NULL:
+# An ABIF directory entry is 28 bytes, all fields big endian.  The
+# whole directory is decoded in one pass by viewing the file buffer
+# through this dtype.
+direntry_dtype = numpy.dtype([('name', 'S4'),
+                              ('number', '>i4'),
+                              ('elementtype', '>i2'),
+                              ('elementsize', '>i2'),
+                              ('numelements', '>i4'),
+                              ('datasize', '>i4'),
+                              ('dataoffset', '>i4'),
+                              ('datahandle', '>i4')])
+
+# Offset of the dataoffset field within an entry.  Tags with four or
+# fewer bytes of data store it there instead of pointing elsewhere.
+inline_data_offset = 20
+
+element_dtypes = {1: '>u1', 2: '>i1', 3: '>u2', 4: '>i2', 5: '>i4',
+                  7: '>f4', 8: '>f8', 18: '>i1', 19: '>i1'}
+
+def load(filename):
+    """Map *filename* into memory and return a buffer over its contents.
+
+    Falls back to a single read() for files that cannot be mapped.
+    """
+    try:
+        h = open(filename, 'rb')
+    except IOError:
         raise ValueError("Failed to open file %s" % filename)
+    with h:
+        try:
+            return mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            return h.read()
 
-    cdef char* magic_number = b'0000'
-    fread(magic_number, 4, 1, p)
-    if magic_number != b'ABIF':
-        raise ValueError("Not a valid ABI file: bad magic number.")
+def directory(buf):
+    """Decode the directory of the ABIF file in *buf*.
 
-    host_version = fread_short(p)
+    Returns a structured array of entries with dtype direntry_dtype,
+    plus the byte offset of the first entry in *buf*.
+    """
+    if len(buf) < 34 or buf[:4] != b'ABIF':
+        raise ValueError("Not a valid ABI file: bad magic number.")
+    header = numpy.ndarray(shape=(), dtype='>i2', buffer=buf, offset=4)
+    host_version = int(header)
     if host_version < 100 or host_version > 199:
         raise ValueError("ABI file version not supported by this library.")
 
-    td = fread_direntry(p)
-    assert td.name[:4] == b'tdir'.encode()
-    assert td.number == 1
-    assert td.elementtype == 1023
-    assert td.elementsize == 28
-    
-    # Find the entries for eight fields: FWO_ to give base order, the
-    # last four DATA fields of 12, PBAS for basis, PLOC for ceners,
-    # and PCON for confidences.
-    
-    fseek(p, td.dataoffset, SEEK_SET)
-    entries = {}
-    cdef short data_index = 0, pbas_index = 0, pcon_index = 0, ploc_index = 0
-    cdef int i, j
-    cdef char ctmp
-    cdef long return_to
-    cdef numpy.ndarray bases_array, confidences, centers
-    cdef str bases
-    data = []
-    cdef int c, q
-    for i in range(td.numelements):
-        d = fread_direntry(p)
-        name = d.name[:4]
-        if name == b'PBAS':
-            if pbas_index == 1: # We want the second entry, the BaseCaller's entry
-                bases_array = fread_byte_array_at(p, d.numelements, d.dataoffset)
-                bases = ''.join(chr(x) for x in bases_array)
-            pbas_index += 1
-        if name == b'PCON':
-            if pcon_index == 1:
-                confidences = fread_byte_array_at(p, d.numelements, d.dataoffset)
-            pcon_index += 1
-        if name == b'PLOC':
-            if ploc_index == 1:
-                centers = fread_short_array_at(p, d.numelements, d.dataoffset)
-            ploc_index += 1
-        if name == b'FWO_':
-            base_order = []
-            for q,sh in enumerate([24, 16, 8, 0]):
-                c = 255 & (d.dataoffset >> sh)
-                base_order.append((chr(c), q))
-            base_order = dict(base_order)
-        if name == b'DATA':
-            if data_index < 8:
-                pass
-            else:
-                data.append(fread_short_array_at(p, d.numelements, d.dataoffset))
-            data_index += 1
-
-    confidence_track = tracks.numeric(confidences)
-    sequence_track = tracks.sequence(bases)
-
-    traces_track = tracks.traces(A=data[base_order['A']],
-                                 C=data[base_order['C']],
-                                 T=data[base_order['T']],
-                                 G=data[base_order['G']],
-                                 centers=centers)
-    val = {'sequence': sequence_track,
-           'confidences': confidence_track,
-           'traces': traces_track}
+    td = numpy.ndarray(shape=(), dtype=direntry_dtype, buffer=buf, offset=6)
+    assert td['name'] == b'tdir'
+    assert td['number'] == 1
+    assert td['elementtype'] == 1023
+    assert td['elementsize'] == 28
+
+    offset = int(td['dataoffset'])
+    entries = numpy.ndarray(shape=(int(td['numelements']),),
+                            dtype=direntry_dtype, buffer=buf, offset=offset)
+    return entries, offset
+
+def entry_data(buf, entries, offset, i):
+    """Return a zero-copy view of the data of entry *i*.
+
+    The view has the big endian dtype given by the entry's element
+    type, so it is only converted when a caller asks for it.
+    """
+    e = entries[i]
+    if e['datasize'] <= 4:
+        start = offset + i*direntry_dtype.itemsize + inline_data_offset
+    else:
+        start = int(e['dataoffset'])
+    dtype = numpy.dtype(element_dtypes.get(int(e['elementtype']), '>u1'))
+    if dtype.itemsize != e['elementsize']:
+        dtype = numpy.dtype('>u1')
+        n = int(e['datasize'])
+    else:
+        n = int(e['numelements'])
+    return numpy.ndarray(shape=(n,), dtype=dtype, buffer=buf, offset=start)
+
+class ABIFFile(object):
+    """An ABIF file whose tags are decoded on first access.
+
+    The directory is indexed when the file is opened.  Tags are
+    returned as big endian views onto the mapped file, and the tracks
+    built from them ('sequence', 'confidences', 'traces') are computed
+    on first access and cached, so callers that only need bases and
+    confidences never decode or sparsify the traces.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.buf = load(filename)
+        self.entries, self.offset = directory(self.buf)
+        self.index = {}
+        for i, name in enumerate(self.entries['name']):
+            self.index.setdefault(name, []).append(i)
+        self.cache = {}
+        self.decoded = {}
+
+    def tag(self, name, occurrence=0):
+        """Return the data of the *occurrence*th entry named *name*."""
+        key = (name, occurrence)
+        if key not in self.cache:
+            try:
+                i = self.index[name][occurrence]
+            except (KeyError, IndexError):
+                raise KeyError("No entry %s %d in %s" % (name, occurrence,
+                                                         self.filename))
+            self.cache[key] = entry_data(self.buf, self.entries,
+                                         self.offset, i)
+        return self.cache[key]
+
+    # We want the second PBAS, PCON, and PLOC entries (the
+    # BaseCaller's), and the last four of the twelve DATA entries.
+    @property
+    def bases(self):
+        return self.tag(b'PBAS', 1)
+
+    @property
+    def confidences(self):
+        return self.tag(b'PCON', 1)
+
+    @property
+    def centers(self):
+        return self.tag(b'PLOC', 1)
+
+    @property
+    def base_order(self):
+        return self.tag(b'FWO_').tostring()
+
+    def channel(self, base):
+        return self.tag(b'DATA', 8 + self.base_order.index(base))
+
+    def __getitem__(self, field):
+        if field not in self.decoded:
+            if field not in field_decoders:
+                raise KeyError("Unknown field %s" % (field,))
+            self.decoded[field] = field_decoders[field](self)
+        return self.decoded[field]
+
+
+def sequence_field(f):
+    return tracks.sequence(f.bases.tostring())
+
+def confidences_field(f):
+    return tracks.numeric(f.confidences)
+
+def traces_field(f):
+    return tracks.traces(A=f.channel('A'), C=f.channel('C'),
+                         T=f.channel('T'), G=f.channel('G'),
+                         centers=f.centers)
+
+field_decoders = {'sequence': sequence_field,
+                  'confidences': confidences_field,
+                  'traces': traces_field}
+
+def read(filename):
+    """Read the sequence, confidences, and traces of *filename*.
+
+    Returns a dict from field name to track.  Use ABIFFile directly
+    to decode only some of them.
+    """
+    with instrument.span('ab1.read', filename=filename):
+        f = ABIFFile(filename)
+        val = dict((k, f[k]) for k in field_decoders)
+        if instrument.active():
+            instrument.count('ab1.bytes', len(f.buf))
+            instrument.count('ab1.bases', len(f.bases))
     return val
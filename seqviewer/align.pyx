@@ -0,0 +1,244 @@
+"""
+align.pyx - Native pairwise alignment of nucleotide sequences
+
+Smith-Waterman (mode='local') and Needleman-Wunsch with free end gaps
+(mode='global') with affine gap penalties, optionally restricted to a
+band of diagonals.  Results follow the same contract as fasta.fasta:
+((offset1, aligned1), (offset2, aligned2)), where aligned1 and
+aligned2 are the whole sequences with gaps inserted in the aligned
+region, and the offsets place them in a common frame so aligned
+columns coincide.
+"""
+import numpy
+cimport numpy
+cimport cython
+
+# Bump whenever a change could alter alignments, so cached results
+# computed with the old code are not reused.
+version = 1
+
+iupac_bases = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T',
+               'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT',
+               'K': 'GT', 'M': 'AC', 'B': 'CGT', 'D': 'AGT',
+               'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+codes = 'ACGTRYSWKMBDHVN'
+
+# Anything that is not an IUPAC code, including gaps, aligns as an N.
+code_of = numpy.zeros(256, dtype=numpy.uint8) + codes.index('N')
+for i, c in enumerate(codes):
+    code_of[ord(c)] = i
+    code_of[ord(c.lower())] = i
+code_of[ord('U')] = code_of[ord('u')] = codes.index('T')
+
+score_tables = {}
+
+def score_table(match, mismatch):
+    """Scores between IUPAC codes.
+
+    Two codes score the expected value of match and mismatch if each
+    ambiguous code were resolved uniformly at random, so A/A scores
+    *match*, A/C *mismatch*, and A/R halfway between.
+    """
+    if (match, mismatch) in score_tables:
+        return score_tables[(match, mismatch)]
+    n = len(codes)
+    table = numpy.zeros((n, n), dtype=numpy.int32)
+    for i, a in enumerate(codes):
+        for j, b in enumerate(codes):
+            sa, sb = set(iupac_bases[a]), set(iupac_bases[b])
+            p = len(sa & sb) / float(len(sa) * len(sb))
+            table[i, j] = int(round(match*p + mismatch*(1-p)))
+    score_tables[(match, mismatch)] = table
+    return table
+
+def encode(s):
+    return code_of[numpy.frombuffer(s, dtype=numpy.uint8)]
+
+# Traceback bits: the source of H in the low two bits, and whether
+# E and F extended an existing gap rather than opening one.
+DEF H_STOP = 0
+DEF H_DIAG = 1
+DEF H_FROM_E = 2
+DEF H_FROM_F = 3
+DEF E_EXTEND = 4
+DEF F_EXTEND = 8
+DEF NEG = -1000000000
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def align(seq1, seq2, mode='local', diagonals=None, match=5, mismatch=-4,
+          gap_open=-12, gap_extend=-4):
+    """Align *seq1* against *seq2*.
+
+    *diagonals*, if given, is a pair (lo, hi) and restricts the
+    alignment to cells (i, j) with lo <= j - i <= hi, so the cost is
+    proportional to len(seq1) * (hi - lo) instead of len(seq1) *
+    len(seq2).  A gap of length k costs gap_open + (k-1)*gap_extend.
+    The default scores are ssearch36's for DNA.
+    """
+    if mode not in ('local', 'global'):
+        raise ValueError("Unknown alignment mode %s" % (mode,))
+    cdef bint local = mode == 'local'
+    cdef numpy.uint8_t[:] a = encode(seq1)
+    cdef numpy.uint8_t[:] b = encode(seq2)
+    cdef numpy.int32_t[:,:] S = score_table(match, mismatch)
+    cdef int n = a.shape[0], m = b.shape[0]
+    cdef int lo, hi
+    if diagonals is None:
+        lo, hi = -n, m
+    else:
+        lo, hi = max(diagonals[0], -n), min(diagonals[1], m)
+        if lo > hi:
+            raise ValueError("Empty band of diagonals %s" % (diagonals,))
+    cdef int W = hi - lo + 1
+    cdef int go = gap_open, ge = gap_extend
+
+    tb_array = numpy.zeros((n+1, W), dtype=numpy.uint8)
+    cdef numpy.uint8_t[:,:] tb = tb_array
+    H_arrays = [numpy.zeros(m+1, dtype=numpy.int32) + NEG for _ in range(2)]
+    F_array = numpy.zeros(m+1, dtype=numpy.int32) + NEG
+    cdef numpy.int32_t[:] Hp = H_arrays[0], Hc = H_arrays[1], tmp
+    cdef numpy.int32_t[:] F = F_array
+
+    cdef int i, j, jlo, jhi, h, e, f, d, t
+    cdef int best = NEG, best_i = 0, best_j = 0
+    cdef numpy.uint8_t bits
+
+    for j in range(0, min(m, hi) + 1):
+        Hp[j] = 0
+    for i in range(1, n+1):
+        jlo = max(1, i + lo)
+        jhi = min(m, i + hi)
+        if jlo > m:
+            break
+        # The cells either side of the band are unreachable, except
+        # for column 0, where every alignment may start.
+        if jlo == 1:
+            Hc[0] = 0
+        else:
+            Hc[jlo-1] = NEG
+        e = NEG
+        for j in range(jlo, jhi+1):
+            bits = 0
+            if Hc[j-1] + go >= e + ge:
+                e = Hc[j-1] + go
+            else:
+                e = e + ge
+                bits |= E_EXTEND
+            if Hp[j] + go >= F[j] + ge:
+                f = Hp[j] + go
+            else:
+                f = F[j] + ge
+                bits |= F_EXTEND
+            F[j] = f
+            d = Hp[j-1] + S[a[i-1], b[j-1]]
+            if d >= e and d >= f:
+                h = d
+                bits |= H_DIAG
+            elif e >= f:
+                h = e
+                bits |= H_FROM_E
+            else:
+                h = f
+                bits |= H_FROM_F
+            if local and h <= 0:
+                h = 0
+                bits &= ~3
+            Hc[j] = h
+            tb[i, j - i - lo] = bits
+            if local or i == n or j == m:
+                if h > best:
+                    best, best_i, best_j = h, i, j
+        if max(jhi, jlo-1) < m:
+            Hc[max(jhi, jlo-1) + 1] = NEG
+        tmp = Hp
+        Hp = Hc
+        Hc = tmp
+
+    if best == NEG:
+        raise ValueError("No alignment within diagonals %s" % (diagonals,))
+
+    # Trace back from the best cell to the start of the alignment.
+    out1 = []
+    out2 = []
+    i, j = best_i, best_j
+    cdef int state = 0 # 0 for H, 1 for E, 2 for F
+    while i > 0 and j > 0 and lo <= j - i <= hi:
+        bits = tb[i, j - i - lo]
+        if state == 0:
+            t = bits & 3
+            if t == H_STOP:
+                break
+            elif t == H_DIAG:
+                out1.append(seq1[i-1])
+                out2.append(seq2[j-1])
+                i -= 1
+                j -= 1
+            elif t == H_FROM_E:
+                state = 1
+            else:
+                state = 2
+        elif state == 1:
+            out1.append('-')
+            out2.append(seq2[j-1])
+            if not (bits & E_EXTEND):
+                state = 0
+            j -= 1
+        else:
+            out1.append(seq1[i-1])
+            out2.append('-')
+            if not (bits & F_EXTEND):
+                state = 0
+            i -= 1
+
+    i0, j0 = i, j
+    aligned1 = seq1[:i0] + ''.join(reversed(out1)) + seq1[best_i:]
+    aligned2 = seq2[:j0] + ''.join(reversed(out2)) + seq2[best_j:]
+    start = max(i0, j0)
+    return ((start - i0, aligned1), (start - j0, aligned2))
+
+def kmers(s, k):
+    """Encode the k-mers of *s* as integers, two bits per base.
+
+    Returns (values, positions) for the k-mers made only of A, C, G
+    and T, so masked or ambiguous regions never seed an alignment.
+    """
+    c = encode(s).astype(numpy.int64)
+    n = len(c) - k + 1
+    if n <= 0:
+        return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=int)
+    invalid = numpy.concatenate([[0], numpy.cumsum(c > 3)])
+    values = numpy.zeros(n, dtype=numpy.int64)
+    for t in range(k):
+        values = values*4 + (c[t:t+n] & 3)
+    positions = numpy.nonzero(invalid[k:] - invalid[:n] == 0)[0]
+    return values[positions], positions
+
+def best_diagonal(seq1, seq2, k=12, min_hits=3, max_repeats=8):
+    """Find the diagonal j - i on which most k-mers of *seq1* and *seq2* match.
+
+    k-mers occurring more than *max_repeats* times in *seq2* are
+    ignored.  Returns None if no diagonal has *min_hits* matches.
+    """
+    v1, p1 = kmers(seq1, k)
+    v2, p2 = kmers(seq2, k)
+    if len(v1) == 0 or len(v2) == 0:
+        return None
+    order = numpy.argsort(v2, kind='mergesort')
+    v2, p2 = v2[order], p2[order]
+    left = numpy.searchsorted(v2, v1, side='left')
+    right = numpy.searchsorted(v2, v1, side='right')
+    counts = right - left
+    keep = (counts > 0) & (counts <= max_repeats)
+    left, counts, p1 = left[keep], counts[keep], p1[keep]
+    if len(p1) == 0:
+        return None
+    # Expand each k-mer of seq1 into one hit per matching k-mer of seq2.
+    first = numpy.repeat(left - numpy.cumsum(counts) + counts, counts)
+    hits2 = p2[first + numpy.arange(counts.sum())]
+    hits1 = numpy.repeat(p1, counts)
+    votes = numpy.bincount(hits2 - hits1 + len(seq1))
+    d = numpy.argmax(votes)
+    if votes[d] < min_hits:
+        return None
+    return int(d) - len(seq1)
@@ -1,22 +1,68 @@
+import numpy
+
 import tracks
 import contig
 import ab1
 import fasta
+import align
+import cache as cache_
+import instrument
+from store import find_track
+
+def assemble(read1, read2, *extra_seqs, **kwargs):
+    """Assemble the AB1 files *read1* and *read2* into a TrackSet.
+
+    Any further keyword arguments are passed to contig.contig.  With
+    cache=a cache.Cache, the parsed AB1 files, the contig, and the
+    final result are each looked up by the contents of the inputs and
+    the arguments before being computed.
+    """
+    cache = kwargs.pop('cache', None)
+    key = lambda: (cache.hash_file(read1), cache.hash_file(read2),
+                   extra_seqs, sorted(kwargs.items()), align.version)
+    with instrument.span('assemble', read1=read1, read2=read2) as s:
+        t, fate = cache_.memoize(cache, 'trackset', key, build, read1, read2,
+                                 extra_seqs, kwargs, cache)
+        s['fate'] = fate
+    return t, fate
+
+def read_abif(filename, cache):
+    return cache_.memoize(cache, 'abif', lambda: (cache.hash_file(filename),),
+                          ab1.read, filename)
+
+def build(read1, read2, extra_seqs, contig_args, cache):
+    tracks1 = read_abif(read1, cache)
+    tracks2 = read_abif(read2, cache)
+    key = lambda: (cache.hash_file(read1), cache.hash_file(read2),
+                   sorted(contig_args.items()), align.version)
+    ref = cache_.memoize(cache, 'contig', key, contig_reads,
+                         tracks1, tracks2, contig_args)
+    return build_tracks(tracks1, tracks2, ref, extra_seqs)
 
-def assemble(read1, read2, *extra_seqs):
-    tracks1 = ab1.read(read1)
-    tracks2 = ab1.read(read2)
-    ref = contig.contig(tracks1['sequence'], tracks1['confidences'],
-                        tracks.revcomp(tracks2['sequence']), 
-                        tracks.revcomp(tracks2['confidences']))
+def contig_reads(tracks1, tracks2, contig_args={}):
+    """Contig the reads in *tracks1* and *tracks2*, as read by ab1.read."""
+    return contig.contig(tracks1['sequence'], tracks1['confidences'],
+                         tracks.revcomp(tracks2['sequence']),
+                         tracks.revcomp(tracks2['confidences']),
+                         **contig_args)
+
+def build_tracks(tracks1, tracks2, ref, extra_seqs=()):
+    """Lay out the reads and their contig *ref* as a TrackSet.
+
+    Returns (trackset, fate), with *extra_seqs* aligned to the reference.
+    """
     t = tracks.TrackSet()
 
     read1_offset, read1_sequence = ref['read1']
     read2_offset, read2_sequence = ref['read2']
-    read1_confs = tracks.regap(read1_sequence, tracks1['confidences'])
-    read2_confs = tracks.regap(read2_sequence, tracks.revcomp(tracks2['confidences']))
-    read1_traces = tracks.regap(read1_sequence, tracks1['traces'])
-    read2_traces = tracks.regap(read2_sequence, tracks.revcomp(tracks2['traces']))
+    with instrument.span('regap'):
+        read1_confs = tracks.regap(read1_sequence, tracks1['confidences'])
+        read2_confs = tracks.regap(read2_sequence, tracks.revcomp(tracks2['confidences']))
+        read1_traces = tracks.regap(read1_sequence, tracks1['traces'])
+        read2_traces = tracks.regap(read2_sequence, tracks.revcomp(tracks2['traces']))
+        if instrument.active():
+            instrument.count('regap.gaps', read1_sequence.count('-') +
+                             read2_sequence.count('-'))
 
     t.extend([
               tracks.TrackEntry('read 1 traces', read1_offset, read1_traces),
@@ -31,28 +77,144 @@ def assemble(read1, read2, *extra_seqs):
         reference_offset, reference_sequence = ref['reference']
         t.append(tracks.TrackEntry('reference', reference_offset, reference_sequence))
 
-    for (name,s) in extra_seqs:
-        if ref['reference'] != None:
-            (roffset, _), (soffset, saligned) = fasta.fasta(reference_sequence, s)
-            t.append(tracks.TrackEntry(name, reference_offset + soffset - roffset,
-                                       tracks.sequence(saligned)))
-        else:
-            t.append(tracks.TrackEntry(name, 0, s))
-
-    # Now add an assembly of the lab sequence and reference sequence
-    if len(extra_seqs) == 1 and ref['reference'] != None:
-        labtrack = t[-1]
-        reftrack = t[-2]
-        offset = max(labtrack.offset, reftrack.offset)
-        loffset = offset - labtrack.offset
-        roffset = offset - reftrack.offset
-        assert loffset >= 0 and roffset >= 0 and (loffset == 0 or roffset == 0)
-        bases = tracks.sequence(''.join([a == b and ' ' or 'X' for a,b in
-                                         zip(labtrack.track[loffset:], 
-                                             reftrack.track[roffset:])]))
-        if 'X' in bases:
-            t.append(tracks.TrackEntry('mismatches', offset, bases))
-    return (t, ref['strands'])
+    return (add_sequences(t, extra_seqs), ref['strands'])
+
+# Tracks made by build from the AB1 files, as opposed to the extra
+# sequences aligned to the reference.
+assembled_tracks = ['read 1 traces', 'read 1 confidences', 'read 1 bases',
+                    'read 2 traces', 'read 2 confidences', 'read 2 bases',
+                    'reference', 'mismatches']
+
+def align_sequence(t, name, s):
+    """Return a TrackEntry of *s* aligned to the reference track of *t*.
+
+    If *t* has no reference, *s* is placed unaligned at offset 0.
+    """
+    reftrack = find_track(t, 'reference')
+    if reftrack is None:
+        return tracks.TrackEntry(name, 0, s)
+    (roffset, _), (soffset, saligned) = fasta.fasta(reftrack.track, s)
+    return tracks.TrackEntry(name, reftrack.offset + soffset - roffset,
+                             tracks.sequence(saligned))
+
+def mismatches(t):
+    """Return the mismatches track of *t*, or None if there is none.
+
+    Mismatches are only shown when exactly one extra sequence, such as
+    a lab assembly, has been aligned to the reference.
+    """
+    reftrack = find_track(t, 'reference')
+    extra = [e for e in t if e.name not in assembled_tracks]
+    if reftrack is None or len(extra) != 1:
+        return None
+    labtrack = extra[0]
+    offset = max(labtrack.offset, reftrack.offset)
+    loffset = offset - labtrack.offset
+    roffset = offset - reftrack.offset
+    assert loffset >= 0 and roffset >= 0 and (loffset == 0 or roffset == 0)
+    bases = tracks.sequence(''.join([a == b and ' ' or 'X' for a,b in
+                                     zip(labtrack.track[loffset:],
+                                         reftrack.track[roffset:])]))
+    if 'X' not in bases:
+        return None
+    return tracks.TrackEntry('mismatches', offset, bases)
+
+def add_sequences(t, seqs):
+    """Return a copy of TrackSet *t* with the (name, sequence) pairs
+    *seqs* aligned to its reference, and its mismatches track updated.
+
+    The other tracks are shared with *t*, and no AB1 file is read, so
+    this costs one alignment per sequence.
+    """
+    result = tracks.TrackSet([e for e in t if e.name != 'mismatches'])
+    for (name, s) in seqs:
+        with instrument.span('align_sequence', track=name):
+            result.append(align_sequence(result, name, s))
+    m = mismatches(result)
+    if m is not None:
+        result.append(m)
+    return result
+
+def test_ab1_directory():
+    import os
+    import struct
+    filename = os.path.join(os.path.dirname(__file__), '..', 'test_data',
+                            'tmpzRpKiy-1.ab1')
+    buf = ab1.load(filename)
+    with open(filename, 'rb') as h:
+        data = h.read()
+    assert buf[:] == data
+    entries, offset = ab1.directory(buf)
+    # The tdir entry in the header says where the directory is.
+    assert struct.unpack('>4sihhiiii', data[6:34])[4] == len(entries) == 122
+    assert struct.unpack('>4sihhiiii', data[6:34])[6] == offset == 233978
+    for i in [0, 51, 72, 121]:
+        at = offset + 28*i
+        assert tuple(entries[i]) == struct.unpack('>4sihhiiii',
+                                                  data[at:at+28])
+    fallback, _ = ab1.directory(data)
+    assert numpy.array_equal(fallback, entries)
+    index = lambda name, number: \
+        [i for i, e in enumerate(entries)
+         if e['name'] == name and e['number'] == number][0]
+    # Four bytes or fewer are stored in the entry itself...
+    assert ab1.entry_data(buf, entries, offset,
+                          index('FWO_', 1)).tostring() == 'GATC'
+    assert ab1.entry_data(buf, entries, offset,
+                          index('LANE', 1)).tolist() == [1]
+    # ...and longer data where the entry points.
+    bases = ab1.entry_data(buf, entries, offset, index('PBAS', 2))
+    assert bases.tostring() == data[222728:222728+324]
+    assert bases[:10].tostring() == 'CAGGGGCATC'
+    centers = ab1.entry_data(buf, entries, offset, index('PLOC', 2))
+    assert centers.dtype == numpy.dtype('>i2')
+    assert centers.tolist() == list(struct.unpack('>324h',
+                                                  data[223376:223376+648]))
+    assert centers[:5].tolist() == [2, 10, 26, 36, 56]
+
+def test_ab1_load():
+    import os
+    import shutil
+    import tempfile
+    d = tempfile.mkdtemp()
+    try:
+        # An empty file cannot be mapped, so it is read instead.
+        p = os.path.join(d, 'empty.ab1')
+        open(p, 'wb').close()
+        assert ab1.load(p) == ''
+        for p in [p, os.path.join(d, 'missing.ab1')]:
+            try:
+                ab1.directory(ab1.load(p))
+                assert False
+            except ValueError:
+                pass
+    finally:
+        shutil.rmtree(d)
+
+def test_abif_file():
+    import os
+    filename = os.path.join(os.path.dirname(__file__), '..', 'test_data',
+                            'tmpzRpKiy-1.ab1')
+    full = ab1.read(filename)
+    assert sorted(full) == ['confidences', 'sequence', 'traces']
+    f = ab1.ABIFFile(filename)
+    assert f.tag('PBAS', 1) is f.tag('PBAS', 1)
+    assert f.tag('PBAS', 1) is f.bases
+    assert f['sequence'] == full['sequence']
+    assert f['sequence'].startswith('CAGGGGCATC')
+    assert f['confidences'] == full['confidences']
+    # Bases and confidences are decoded without touching the traces.
+    assert sorted(f.decoded) == ['confidences', 'sequence']
+    assert not any(name == 'DATA' for name, _ in f.cache)
+    assert f['sequence'] is f['sequence']
+    assert f['traces'] == full['traces']
+    for key in [lambda: f['bogus'], lambda: f.tag('PBAS', 5),
+                lambda: f.tag('XXXX')]:
+        try:
+            key()
+            assert False
+        except KeyError:
+            pass
 
 # def test_assemble():
 #     import Bio.SeqIO
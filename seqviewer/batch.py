@@ -0,0 +1,280 @@
+"""
+batch.py - Assemble every sample in a directory in parallel
+
+A sample is a group of files sharing a prefix: NAME-1.ab1 and
+NAME-2.ab1, plus NAME.fasta holding the lab assembly if there is one.
+Each sample is assembled in a worker process and written to
+NAME.tracks (see trackfile.py), or NAME.pickle with --format pickle, in
+the output directory as soon as it finishes, and recorded in the
+catalog there (see store.py).  A sample that fails is reported and the
+rest of the batch carries on.  With --trace, the spans and counters
+each worker records (see instrument.py) are written to a JSON lines
+file; with --profile, they are totalled at the end.
+
+    python -m seqviewer.batch [-j JOBS] [-o OUTDIR] [--force]
+                              [--cache CACHEDIR] [--format FORMAT]
+                              [--catalog CATALOG] [--trace FILE]
+                              [--profile] DIRECTORY
+"""
+import os
+import sys
+import time
+import cPickle
+import argparse
+import traceback
+import collections
+import multiprocessing
+import Bio.SeqIO
+
+import tracks
+import assemble
+import cache
+import store as store_
+import trackfile
+import instrument
+
+Sample = collections.namedtuple('Sample', ['name', 'read1', 'read2', 'fasta'])
+Result = collections.namedtuple('Result', ['name', 'fate', 'timings', 'error',
+                                           'path', 'stats', 'events'])
+
+def discover(directory):
+    """Find the samples in *directory*, sorted by name."""
+    files = set(os.listdir(directory))
+    samples = []
+    for n in sorted(x[:-6] for x in files if x.endswith('-1.ab1')):
+        if '%s-2.ab1' % n not in files:
+            continue
+        fasta = '%s.fasta' % n in files and \
+            os.path.join(directory, '%s.fasta' % n) or None
+        samples.append(Sample(n, os.path.join(directory, '%s-1.ab1' % n),
+                              os.path.join(directory, '%s-2.ab1' % n), fasta))
+    return samples
+
+def lab_sequences(sample):
+    if sample.fasta is None:
+        return []
+    seq = str(Bio.SeqIO.read(sample.fasta, 'fasta').seq)
+    return [('lab assembly', tracks.sequence(seq))]
+
+def save(obj, filename):
+    """Pickle *obj* to *filename*, so that readers never see half a file."""
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as h:
+        cPickle.dump(obj, h, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, filename)
+
+formats = ('tracks', 'pickle')
+
+def output_path(outdir, name, format='tracks'):
+    return os.path.join(outdir, '%s.%s' % (name, format))
+
+def store(t, fate, filename, format='tracks'):
+    if format == 'tracks':
+        trackfile.save(filename, t, {'fate': fate})
+    else:
+        save((t, fate), filename)
+
+def process(sample, outdir, cache_dir=None, format='tracks',
+            instrumented=False):
+    """Assemble *sample* into *outdir*, returning a Result.
+
+    If *instrumented*, the Result's events are those recorded while
+    assembling (see instrument.py); otherwise they are empty.
+    """
+    collector = instrument.Collector()
+    with instrument.recording(*(instrumented and [collector] or [])):
+        with instrument.span('sample', sample=sample.name):
+            return process_sample(sample, outdir, cache_dir, format,
+                                  collector.events)
+
+def process_sample(sample, outdir, cache_dir, format, events):
+    timings = collections.OrderedDict()
+    fate = None
+    path = output_path(outdir, sample.name, format)
+    c = cache_dir and cache.Cache(cache_dir) or None
+    try:
+        start = time.time()
+        extra_seqs = lab_sequences(sample)
+        timings['read fasta'] = time.time() - start
+
+        start = time.time()
+        t, fate = assemble.assemble(sample.read1, sample.read2, *extra_seqs,
+                                    cache=c)
+        timings['assemble'] = time.time() - start
+
+        start = time.time()
+        store(t, fate, path, format)
+        stats = store_.sample_stats(t, fate)
+        timings['store'] = time.time() - start
+    except Exception:
+        return Result(sample.name, fate, timings, traceback.format_exc(),
+                      None, None, events)
+    return Result(sample.name, fate, timings, None, path, stats, events)
+
+def failed(sample, error):
+    """The Result of *sample* when assembling it raised *error*."""
+    return Result(sample.name, None, collections.OrderedDict(), error,
+                  None, None, [])
+
+def process_star(args):
+    return process(*args)
+
+def run(directory, outdir=None, jobs=None, force=False, report=None,
+        cache_dir=None, format='tracks', catalog=None, sinks=()):
+    """Assemble all samples in *directory* on *jobs* processes.
+
+    Samples whose output already exists in *outdir* are skipped
+    unless *force* is set.  Each Result is passed to *report* as it
+    arrives.  Returns the list of Results in order of completion.
+    With *cache_dir*, results are cached there (see cache.py).
+    *format* is 'tracks' or 'pickle'.  Each sample assembled is
+    added to *catalog*, a store.Catalog, if there is one.  The events
+    the workers record are passed to each of *sinks* (see
+    instrument.py); without sinks, nothing is recorded.
+    """
+    if format not in formats:
+        raise ValueError("Unknown output format %s" % (format,))
+    outdir = outdir or directory
+    samples = [s for s in discover(directory)
+               if force or not os.path.exists(
+                   output_path(outdir, s.name, format))]
+    pool = multiprocessing.Pool(jobs)
+    results = []
+    try:
+        for r in pool.imap_unordered(process_star,
+                                     [(s, outdir, cache_dir, format,
+                                       bool(sinks))
+                                      for s in samples]):
+            results.append(r)
+            for e in r.events:
+                for sink in sinks:
+                    sink.event(e)
+            if catalog is not None and r.error is None:
+                catalog.add(r.name, r.path, r.stats)
+            if report:
+                report(r)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def report_result(r, h=sys.stdout):
+    if r.error is None:
+        print >>h, '%-20s %-10s %s' % (r.name, r.fate,
+            '  '.join('%s %.3fs' % kv for kv in r.timings.items()))
+    else:
+        print >>h, '%-20s FAILED' % r.name
+    h.flush()
+
+def summarize(results, elapsed, h=sys.stdout):
+    failures = [r for r in results if r.error is not None]
+    stages = collections.OrderedDict()
+    for r in results:
+        for stage, t in r.timings.items():
+            stages.setdefault(stage, []).append(t)
+    print >>h, '%d samples in %.2fs, %d failed' % \
+        (len(results), elapsed, len(failures))
+    for stage, ts in stages.items():
+        print >>h, '  %-12s total %8.3fs  mean %7.3fs  max %7.3fs' % \
+            (stage, sum(ts), sum(ts)/len(ts), max(ts))
+    for r in failures:
+        print >>h, '\n%s failed:\n%s' % (r.name, r.error)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Assemble all samples in a directory.')
+    parser.add_argument('directory')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='where to write results (default: DIRECTORY)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--force', action='store_true',
+                        help='reassemble samples that already have a result')
+    parser.add_argument('--cache', default=None, metavar='CACHEDIR',
+                        help='cache parsed reads, contigs and results here')
+    parser.add_argument('--format', choices=formats, default='tracks',
+                        help='write track files (default) or pickles')
+    parser.add_argument('--catalog', default=None,
+                        help='SQLite catalog to record samples in '
+                        '(default: OUTDIR/catalog.sqlite)')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='write spans and counters here as JSON lines')
+    parser.add_argument('--profile', action='store_true',
+                        help='total the spans and counters at the end')
+    args = parser.parse_args(argv)
+    catalog = store_.Catalog(args.catalog or os.path.join(
+        args.outdir or args.directory, 'catalog.sqlite'))
+    sinks = []
+    trace = args.trace and open(args.trace, 'a')
+    if trace:
+        sinks.append(instrument.JSONLines(trace))
+    if args.profile:
+        sinks.append(instrument.Summary())
+    start = time.time()
+    try:
+        results = run(args.directory, args.outdir, args.jobs, args.force,
+                      report=report_result, cache_dir=args.cache,
+                      format=args.format, catalog=catalog, sinks=sinks)
+    finally:
+        if trace:
+            trace.close()
+    summarize(results, time.time() - start)
+    if args.profile:
+        print
+        sinks[-1].report()
+    return any(r.error is not None for r in results) and 1 or 0
+
+
+def test_discover():
+    import tempfile, shutil
+    d = tempfile.mkdtemp()
+    try:
+        for f in ['a-1.ab1', 'a-2.ab1', 'a.fasta', 'b-1.ab1', 'b-2.ab1',
+                  'c-1.ab1', 'notes.txt']:
+            open(os.path.join(d, f), 'w').close()
+        samples = discover(d)
+        assert [s.name for s in samples] == ['a', 'b']
+        assert samples[0].fasta == os.path.join(d, 'a.fasta')
+        assert samples[1].fasta is None
+    finally:
+        shutil.rmtree(d)
+
+def test_run():
+    import tempfile, shutil
+    here = os.path.join(os.path.dirname(__file__), '..', 'test_data')
+    d = tempfile.mkdtemp()
+    try:
+        for f in ['tmpzRpKiy-1.ab1', 'tmpzRpKiy-2.ab1', 'tmpzRpKiy.fasta']:
+            shutil.copy(os.path.join(here, f), d)
+        with open(os.path.join(d, 'bad-1.ab1'), 'w') as h:
+            h.write('not an ABI file')
+        shutil.copy(os.path.join(here, 'tmpzRpKiy-2.ab1'), os.path.join(d, 'bad-2.ab1'))
+        catalog = store_.Catalog(os.path.join(d, 'catalog.sqlite'))
+        results = dict((r.name, r) for r in run(d, jobs=2, catalog=catalog))
+        assert results['tmpzRpKiy'].error is None
+        assert results['tmpzRpKiy'].fate == 'both'
+        assert 'bad magic number' in results['bad'].error
+        t, meta = trackfile.load(os.path.join(d, 'tmpzRpKiy.tracks'))
+        assert meta == {'fate': 'both'}
+        assert not os.path.exists(os.path.join(d, 'bad.tracks'))
+        assert [r['name'] for r in catalog.samples()] == ['tmpzRpKiy']
+        assert catalog.get('tmpzRpKiy')['fate'] == 'both'
+        assert catalog.get('tmpzRpKiy')['reference_length'] == 322
+        # Finished samples are skipped on a rerun.
+        assert [r.name for r in run(d, jobs=2)] == ['bad']
+        summary = instrument.Summary()
+        results = run(d, jobs=2, format='pickle', sinks=[summary])
+        spans = [e['path'] for r in results for e in r.events
+                 if e['type'] == 'span']
+        assert 'sample/assemble/contig/fasta' in spans
+        assert 'sample/assemble/ab1.read/traces' in spans
+        assert 'sample/assemble/align_sequence/fasta' in spans
+        assert summary.counters['fasta.gaps'][0] == 2
+        assert summary.spans['sample'][3] == 0
+        with open(os.path.join(d, 'tmpzRpKiy.pickle'), 'rb') as h:
+            assert tracks.load(h) == (t, 'both')
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    sys.exit(main())
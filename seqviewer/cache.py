@@ -0,0 +1,210 @@
+"""
+cache.py - Content-addressed on-disk cache of pipeline results
+
+Values are pickled under a layer name ('abif', 'contig', 'trackset')
+and a key digested from the contents of the inputs, so renaming or
+copying a file does not invalidate its entries, and editing it does.
+The cache holds at most max_bytes on disk, evicting the least
+recently used entries first.
+"""
+import os
+import hashlib
+import cPickle
+import tempfile
+import collections
+
+import instrument
+
+def digest(*parts):
+    """Digest *parts*, which must have a stable repr, into a key."""
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def hash_file(filename):
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), ''):
+            h.update(block)
+    return h.hexdigest()
+
+class Cache(object):
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.file_hashes = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Bytes on disk, counted on the first put.
+        self.total = None
+
+    def path(self, layer, key):
+        return os.path.join(self.directory, layer, key[:2], key + '.pickle')
+
+    def entries(self):
+        """Yield (path, size, last use) for every entry in the cache."""
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if f.endswith('.pickle'):
+                    p = os.path.join(root, f)
+                    try:
+                        st = os.stat(p)
+                    except OSError:
+                        continue
+                    yield p, st.st_size, st.st_mtime
+
+    def hash_file(self, filename):
+        """Hash the contents of *filename*, rehashing only if it changes."""
+        st = os.stat(filename)
+        k = (os.path.abspath(filename), st.st_size, st.st_mtime)
+        if k not in self.file_hashes:
+            self.file_hashes[k] = hash_file(filename)
+        return self.file_hashes[k]
+
+    def get(self, layer, key):
+        """Return the value under *layer* and *key*, or raise KeyError.
+
+        An entry that cannot be unpickled, such as one truncated or
+        written by an older version, is removed and counts as a miss.
+        """
+        p = self.path(layer, key)
+        try:
+            h = open(p, 'rb')
+        except IOError:
+            self.misses[layer] += 1
+            raise KeyError((layer, key))
+        try:
+            with h:
+                value = cPickle.load(h)
+        except Exception:
+            self.misses[layer] += 1
+            self.remove(p)
+            raise KeyError((layer, key))
+        os.utime(p, None)
+        self.hits[layer] += 1
+        return value
+
+    def remove(self, p):
+        try:
+            size = os.path.getsize(p)
+            os.unlink(p)
+        except OSError:
+            return
+        if self.total is not None:
+            self.total -= size
+
+    def put(self, layer, key, value):
+        p = self.path(layer, key)
+        if not os.path.isdir(os.path.dirname(p)):
+            try:
+                os.makedirs(os.path.dirname(p))
+            except OSError:
+                pass # Another process made it first.
+        if self.total is None:
+            self.total = sum(size for _, size, _ in self.entries())
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(p))
+        with os.fdopen(fd, 'wb') as h:
+            cPickle.dump(value, h, cPickle.HIGHEST_PROTOCOL)
+        self.total += os.path.getsize(tmp)
+        os.rename(tmp, p)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes."""
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        self.total = sum(size for _, size, _ in entries)
+        for p, size, _ in entries:
+            if self.total <= self.max_bytes:
+                break
+            try:
+                os.unlink(p)
+            except OSError:
+                pass
+            self.total -= size
+
+    def memoize(self, layer, key, f, *args, **kwargs):
+        try:
+            value = self.get(layer, key)
+            instrument.count('cache.%s.hits' % layer)
+            return value
+        except KeyError:
+            instrument.count('cache.%s.misses' % layer)
+            value = f(*args, **kwargs)
+            self.put(layer, key, value)
+            return value
+
+    def stats(self):
+        """Return a dict from layer to (hits, misses)."""
+        layers = set(self.hits) | set(self.misses)
+        return dict((l, (self.hits[l], self.misses[l])) for l in layers)
+
+def memoize(cache, layer, key, f, *args, **kwargs):
+    """Call f(*args, **kwargs) through *cache*, which may be None.
+
+    *key* is a function returning the parts of the key, so inputs are
+    only hashed when there is a cache to look them up in.
+    """
+    if cache is None:
+        return f(*args, **kwargs)
+    return cache.memoize(layer, digest(layer, *key()), f, *args, **kwargs)
+
+
+def test_cache():
+    import shutil
+    d = tempfile.mkdtemp()
+    try:
+        c = Cache(d, max_bytes=2000)
+        calls = []
+        def f(x):
+            calls.append(x)
+            return 'x' * x
+        assert memoize(c, 'a', lambda: (500,), f, 500) == 'x'*500
+        assert memoize(c, 'a', lambda: (500,), f, 500) == 'x'*500
+        assert memoize(None, 'a', lambda: (500,), f, 500) == 'x'*500
+        assert calls == [500, 500]
+        assert c.stats() == {'a': (1, 1)}
+        # Filling the cache evicts the least recently used entry.
+        memoize(c, 'b', lambda: (600,), f, 600)
+        memoize(c, 'a', lambda: (500,), f, 500)
+        memoize(c, 'b', lambda: (700,), f, 700)
+        memoize(c, 'b', lambda: (800,), f, 800)
+        assert c.total <= 2000
+        assert sum(s for _, s, _ in c.entries()) == c.total
+        assert os.path.exists(c.path('b', digest('b', 800)))
+        assert not os.path.exists(c.path('b', digest('b', 600)))
+        # The cache survives reopening.
+        assert Cache(d, max_bytes=2000).get('b', digest('b', 800)) == 'x'*800
+        # Entries that fail to unpickle are removed and recomputed.
+        for data in ['', cPickle.dumps('x'*800)[:-10],
+                     "cnosuchmodule\nThing\np0\n."]:
+            p = c.path('b', digest('b', 800))
+            with open(p, 'wb') as h:
+                h.write(data)
+            assert memoize(c, 'b', lambda: (800,), f, 800) == 'x'*800
+            assert calls[-1] == 800
+            calls.pop()
+            assert c.get('b', digest('b', 800)) == 'x'*800
+    finally:
+        shutil.rmtree(d)
+
+def test_assemble_cache():
+    import shutil
+    import assemble
+    here = os.path.join(os.path.dirname(__file__), '..', 'test_data')
+    read1 = os.path.join(here, 'tmpzRpKiy-1.ab1')
+    read2 = os.path.join(here, 'tmpzRpKiy-2.ab1')
+    d = tempfile.mkdtemp()
+    try:
+        c = Cache(d)
+        t, fate = assemble.assemble(read1, read2, cache=c)
+        assert c.stats() == {'trackset': (0, 1), 'abif': (0, 2),
+                             'contig': (0, 1)}
+        assert assemble.assemble(read1, read2, cache=c) == (t, fate)
+        assert c.stats()['trackset'] == (1, 1)
+        # New thresholds rebuild the contig from the cached reads.
+        assemble.assemble(read1, read2, cache=c, call_threshold=30)
+        assert c.stats() == {'trackset': (1, 2), 'abif': (2, 2),
+                             'contig': (0, 2)}
+    finally:
+        shutil.rmtree(d)
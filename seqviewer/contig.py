@@ -3,6 +3,7 @@ import re
 import collections
 import fasta
 import tracks
+import instrument
 
 iupac = {('A','C'): 'M',
          ('A','G'): 'R',
@@ -35,6 +36,78 @@ for i in iupac.itervalues():
 iupac_table[('-',)] = '-'
 iupac_table[tuple()] = 'N'
 
+def combine(b1, c1, b2, c2, call_threshold=20):
+    """Call the consensus of bases *b1* and *b2* with confidences *c1*, *c2*."""
+    d = collections.defaultdict(lambda: 0)
+    d[b1] += c1
+    d[b2] += c2
+    key = tuple(sorted(k for k,v in d.iteritems() if v > call_threshold))
+    return iupac_table[key]
+
+# consensus_table[x, y, k1, k2] is combine's call for the symbols
+# numbered x and y, where k1 and k2 say whether each one's confidence
+# is above the call threshold.  The last symbol stands for any other
+# character, and calls involving it are '\0', which combine would
+# fail on.
+consensus_symbols = '-ACGTMRWSYKVHDBN'
+symbol_code = numpy.zeros(256, dtype=numpy.intp) + len(consensus_symbols)
+for i, c in enumerate(consensus_symbols):
+    symbol_code[ord(c)] = i
+consensus_table = numpy.zeros((len(consensus_symbols)+1,)*2 + (2, 2),
+                              dtype='S1')
+for i, x in enumerate(list(consensus_symbols) + [None]):
+    for j, y in enumerate(list(consensus_symbols) + [None]):
+        for k1 in (0, 1):
+            for k2 in (0, 1):
+                key = tuple(sorted(set([b for b,k in [(x,k1), (y,k2)] if k])))
+                if None not in key and key in iupac_table:
+                    consensus_table[i, j, k1, k2] = iupac_table[key]
+
+def consensus(bases1, confs1, bases2, confs2, call_threshold=20):
+    """Call combine on each column of two aligned sequences at once."""
+    b1 = numpy.frombuffer(str(bases1), dtype=numpy.uint8)
+    b2 = numpy.frombuffer(str(bases2), dtype=numpy.uint8)
+    c1 = numpy.asarray(confs1, dtype=numpy.int64)
+    c2 = numpy.asarray(confs2, dtype=numpy.int64)
+    # Equal bases pool their confidences.
+    same = b1 == b2
+    k1 = numpy.where(same, c1 + c2 > call_threshold, c1 > call_threshold)
+    k2 = numpy.where(same, k1, c2 > call_threshold)
+    calls = consensus_table[symbol_code[b1], symbol_code[b2],
+                            k1.astype(int), k2.astype(int)]
+    bad = numpy.nonzero(calls == '')[0]
+    if len(bad):
+        i = bad[0]
+        raise KeyError("No consensus of %r and %r" % (bases1[i], bases2[i]))
+    return calls.tostring()
+
+def test_consensus():
+    import random
+    r = random.Random(1)
+    symbols = consensus_symbols + 'X'
+    b1 = ''.join(r.choice(symbols) for _ in range(5000))
+    b2 = ''.join(r.choice(symbols) for _ in range(5000))
+    c1 = [r.choice([0, 10, 15, 20, 25, 60]) for _ in b1]
+    c2 = [r.choice([0, 10, 15, 20, 25, 60]) for _ in b2]
+    calls = []
+    for x in zip(b1, c1, b2, c2):
+        try:
+            calls.append(combine(*x))
+        except KeyError:
+            calls.append(None)
+    good = [i for i, c in enumerate(calls) if c is not None]
+    assert len(good) > 4000
+    assert consensus(''.join(b1[i] for i in good), [c1[i] for i in good],
+                     ''.join(b2[i] for i in good), [c2[i] for i in good]) == \
+        ''.join(calls[i] for i in good)
+    bad = calls.index(None)
+    try:
+        consensus(b1[bad], c1[bad:bad+1], b2[bad], c2[bad:bad+1])
+        assert False
+    except KeyError:
+        pass
+    assert consensus('', [], '', []) == ''
+
 def dashify(target,template):
     for i in [j for j,v in enumerate(template) if v=='-']:
         target.insert(i, 0)
@@ -52,7 +125,7 @@ def find_steps(bs):
             pass
     return (ups,downs)
 
-def canny_mask(vals, high_threshold=40, low_threshold=10):
+def looped_canny_mask(vals, high_threshold=40, low_threshold=10):
     mask = [c >= high_threshold for c in vals]
     N = len(vals)
     ups, downs = find_steps(mask)
@@ -76,6 +149,76 @@ def canny_mask(vals, high_threshold=40, low_threshold=10):
                 break
     return mask
 
+def runs(bs):
+    """Return (starts, ends) of the runs of True in the boolean array *bs*."""
+    edges = numpy.diff(numpy.concatenate([[0], bs.view(numpy.int8), [0]]))
+    return numpy.nonzero(edges == 1)[0], numpy.nonzero(edges == -1)[0]
+
+def hysteresis_mask(vals, high_threshold=40, low_threshold=10):
+    """Mark the runs of values >= *low_threshold* that reach *high_threshold*.
+
+    Returns a boolean array, True for every value in a run of
+    consecutive values at least *low_threshold* (or at least
+    *high_threshold*) that contains a value at least *high_threshold*.
+    """
+    vals = numpy.asarray(vals)
+    high = vals >= high_threshold
+    low = high | (vals >= low_threshold)
+    starts, ends = runs(low)
+    # Number of high values before each position, to count them per run.
+    nhigh = numpy.concatenate([[0], numpy.cumsum(high)])
+    keep = nhigh[ends] > nhigh[starts]
+    # Runs are separated by at least one value, so no run ends where
+    # another starts.
+    edges = numpy.zeros(len(vals) + 1, dtype=numpy.int8)
+    edges[starts[keep]] = 1
+    edges[ends[keep]] = -1
+    return numpy.cumsum(edges[:-1]) > 0
+
+def canny_mask(vals, high_threshold=40, low_threshold=10):
+    return hysteresis_mask(vals, high_threshold, low_threshold).tolist()
+
+def usable_window(seq, conf, threshold, min_run=10):
+    """Find the part of *seq* worth aligning.
+
+    A base is good if it is not N and its confidence is above
+    *threshold*.  Returns (start, end) running from the first to the
+    end of the last run of at least *min_run* good bases, or None if
+    there is no such run.  This is the span matched by the regular
+    expression usable_pattern on *seq* with the bad bases replaced by
+    N, found in linear time.
+    """
+    bases = numpy.frombuffer(str(seq), dtype='S1')
+    good = (numpy.asarray(conf) > threshold) & (bases != 'N')
+    starts, ends = runs(good)
+    long_runs = numpy.nonzero(ends - starts >= min_run)[0]
+    if len(long_runs) == 0:
+        return None
+    return int(starts[long_runs[0]]), int(ends[long_runs[-1]])
+
+usable_pattern = r'(?=[^N]{10,})(?:[^N]|N(?=.*[^N]{10,}))+'
+
+def test_hysteresis_mask():
+    import random
+    r = random.Random(1)
+    for n in range(200):
+        vals = [r.choice([0, 5, 10, 15, 39, 40, 60]) for _ in range(r.randrange(30))]
+        for high, low in [(40, 10), (10, 40), (40, 40)]:
+            assert canny_mask(vals, high, low) == \
+                looped_canny_mask(vals, high, low)
+
+def test_usable_window():
+    import random
+    r = random.Random(1)
+    assert usable_window('ACGT', [50]*4, 20) is None
+    for n in range(500):
+        seq = ''.join(r.choice('ACGTN') for _ in range(r.randrange(80)))
+        conf = [r.choice([10, 30]) for _ in seq]
+        m = re.search(usable_pattern,
+                      ''.join([c > 20 and b or 'N' for c,b in zip(conf, seq)]))
+        w = usable_window(seq, conf, 20)
+        assert (m and (m.start(), m.end())) == (w or None)
+
 def test_canny_mask():
     assert canny_mask([]) == []
     assert canny_mask([50]) == [True]
@@ -89,82 +232,85 @@ def test_canny_mask():
     assert canny_mask([50,15,15,50,15,15,5]) == [True]*6 + [False]
     
 
-def contig(seq1, conf1, seq2, conf2, high_threshold=40, low_threshold=10, call_threshold=20):
-    mask1 = canny_mask(conf1, high_threshold, low_threshold)
-    mask2 = canny_mask(conf2, high_threshold, low_threshold)
-    masked_seq1 = ''.join([m and c or 'N' for m,c in zip(mask1,seq1)])
-    masked_seq2 = ''.join([m and c or 'N' for m,c in zip(mask2,seq2)])
-    r = r'(?=[^N]{10,})(?:[^N]|N(?=.*[^N]{10,}))+'
-    m1 = re.search(r, ''.join([m>high_threshold and c or 'N' for m,c in zip(conf1,seq1)]))
-    m2 = re.search(r, ''.join([m>high_threshold and c or 'N' for m,c in zip(conf2,seq2)]))
-    if not(m1) and not(m2): # Neither sequence is usable.
-        return {'reference': None, 'read1': (0, seq1), 'read2': (0, seq2), 'strands': 'none'}
-    elif m1 and not(m2):
-        # Only sequence 1 is usable. Take its masked, acceptable part
-        # as the reference.
-        return {'reference': (m1.start(), tracks.sequence(masked_seq1[m1.start():m1.end()])),
-                'read1': (0, seq1), 'read2': (0, seq2),
-                'strands': 'strand 1'}
-    elif m2 and not(m1):
-        # Same as above, but only sequence 2 is usable.
-        return {'reference': (m2.start(), tracks.sequence(masked_seq2[m2.start():m2.end()])),
-                'read1': (0, seq1), 'read2': (0, seq2),
-                'strands': 'strand 2'}
-    else:
-        # Both are usable. Align them.
-        l1, r1 = m1.start(), m1.end()
-        seg1 = masked_seq1[l1:r1]
-        segconf1 = conf1[l1:r1]
-        l2, r2 = m2.start(), m2.end()
-        seg2 = masked_seq2[l2:r2]
-        segconf2 = conf2[l2:r2]
-        (offset1, aligned1), (offset2, aligned2) = fasta.fasta(seg1, seg2)
-
-        if offset1 != 0:
-            left, right, leftconf, rightconf = \
-                (aligned2,aligned1,
-                 dashify(segconf2,aligned2), 
-                 dashify(segconf1,aligned1)) 
+def contig(seq1, conf1, seq2, conf2, high_threshold=40, low_threshold=10, call_threshold=20,
+           backend='seeded'):
+    with instrument.span('contig', backend=backend) as s:
+        mask1 = hysteresis_mask(conf1, high_threshold, low_threshold)
+        mask2 = hysteresis_mask(conf2, high_threshold, low_threshold)
+        masked_seq1 = numpy.where(mask1, numpy.frombuffer(str(seq1), dtype='S1'),
+                                  'N').tostring()
+        masked_seq2 = numpy.where(mask2, numpy.frombuffer(str(seq2), dtype='S1'),
+                                  'N').tostring()
+        m1 = usable_window(seq1, conf1, high_threshold)
+        m2 = usable_window(seq2, conf2, high_threshold)
+        if not(m1) and not(m2): # Neither sequence is usable.
+            s['strands'] = 'none'
+            return {'reference': None, 'read1': (0, seq1), 'read2': (0, seq2), 'strands': 'none'}
+        elif m1 and not(m2):
+            # Only sequence 1 is usable. Take its masked, acceptable part
+            # as the reference.
+            s['strands'] = 'strand 1'
+            return {'reference': (m1[0], tracks.sequence(masked_seq1[m1[0]:m1[1]])),
+                    'read1': (0, seq1), 'read2': (0, seq2),
+                    'strands': 'strand 1'}
+        elif m2 and not(m1):
+            # Same as above, but only sequence 2 is usable.
+            s['strands'] = 'strand 2'
+            return {'reference': (m2[0], tracks.sequence(masked_seq2[m2[0]:m2[1]])),
+                    'read1': (0, seq1), 'read2': (0, seq2),
+                    'strands': 'strand 2'}
         else:
-            left, right, leftconf, rightconf = \
-                (aligned1,aligned2,
-                 dashify(segconf1,aligned1),
-                 dashify(segconf2,aligned2))
-
-        offset = max(offset1, offset2)
-
-        left_end = min(len(left), len(right)+offset)
-        right_end = min(len(right), len(left)-offset)
-
-        reference = left[:offset]
-
-        def combine(b1, c1, b2, c2):
-            d = collections.defaultdict(lambda: 0)
-            d[b1] += c1
-            d[b2] += c2
-            key = tuple(sorted(k for k,v in d.iteritems() if v > call_threshold))
-            return iupac_table[key]
-
-        # Use left, right, and the resulting confs instead
-        reference += ''.join([combine(b1,c1,b2,c2) for b1,c1,b2,c2
-                              in zip(left[offset:left_end],
-                                     leftconf[offset:left_end],
-                                     right[:right_end],
-                                     rightconf[:right_end])])
-
-        reference += right[right_end:] + left[left_end:] # One of these is ''
-
-        read1 = tracks.sequence(seq1[:l1] + aligned1 + seq1[r1:])
-        read2 = tracks.sequence(seq2[:l2] + aligned2 + seq2[r2:])
- 
-        maxo = min(max(l1,l2)-(l1-offset1), max(l1,l2)-(l2-offset2))
-
-        v = {'reference': (max(l1,l2)-maxo, tracks.sequence(reference)),
-             'read1': (max(l1,l2)-(l1-offset1)-maxo, read1),
-             'read2': (max(l1,l2)-(l2-offset2)-maxo, read2),
-             'strands': 'both'}
-        return v
-        
+            # Both are usable. Align them.
+            l1, r1 = m1
+            seg1 = masked_seq1[l1:r1]
+            segconf1 = conf1[l1:r1]
+            l2, r2 = m2
+            seg2 = masked_seq2[l2:r2]
+            segconf2 = conf2[l2:r2]
+            (offset1, aligned1), (offset2, aligned2) = fasta.fasta(seg1, seg2, backend=backend)
+
+            if offset1 != 0:
+                left, right, leftconf, rightconf = \
+                    (aligned2,aligned1,
+                     dashify(segconf2,aligned2), 
+                     dashify(segconf1,aligned1)) 
+            else:
+                left, right, leftconf, rightconf = \
+                    (aligned1,aligned2,
+                     dashify(segconf1,aligned1),
+                     dashify(segconf2,aligned2))
+
+            offset = max(offset1, offset2)
+
+            left_end = min(len(left), len(right)+offset)
+            right_end = min(len(right), len(left)-offset)
+
+            reference = left[:offset]
+
+            # Use left, right, and the resulting confs instead
+            reference += consensus(left[offset:left_end],
+                                   leftconf[offset:left_end],
+                                   right[:right_end],
+                                   rightconf[:right_end], call_threshold)
+
+            reference += right[right_end:] + left[left_end:] # One of these is ''
+
+            read1 = tracks.sequence(seq1[:l1] + aligned1 + seq1[r1:])
+            read2 = tracks.sequence(seq2[:l2] + aligned2 + seq2[r2:])
+
+            maxo = min(max(l1,l2)-(l1-offset1), max(l1,l2)-(l2-offset2))
+
+            v = {'reference': (max(l1,l2)-maxo, tracks.sequence(reference)),
+                 'read1': (max(l1,l2)-(l1-offset1)-maxo, read1),
+                 'read2': (max(l1,l2)-(l2-offset2)-maxo, read2),
+                 'strands': 'both'}
+            s['strands'] = 'both'
+            if instrument.active():
+                instrument.count('contig.masked_bases',
+                                 seg1.count('N') + seg2.count('N'))
+                instrument.count('contig.reference_length', len(reference))
+            return v
+
 
 def test_contig():
     ref = 'ACTGATGAGATTGAGACCATTAGGGTAGTTGGAGGCC'
@@ -176,5 +322,6 @@ def test_contig():
     c2 = [1]*len(pref2) + [60]*len(ref) + [1]*len(pref2)
     assert contig(s1,c1,s2,c2) == {'reference': (30,ref),
                                    'read1': (9, s1),
-                                   'read2': (0, s2)}
+                                   'read2': (0, s2),
+                                   'strands': 'both'}
 
@@ -0,0 +1,501 @@
+"""
+daemon.py - Assemble samples as their files arrive in a directory
+
+Watches a directory with inotify (or, where inotify is not available,
+by polling it) and groups the files that arrive by sample, as in
+batch.py: NAME-1.ab1, NAME-2.ab1 and optionally NAME.fasta.  A sample
+is assembled as soon as all three files are there, or once both reads
+are there and no file of the sample has changed for the debounce
+window, in case there is no lab assembly.
+
+Samples ready to assemble are queued, and at most max_pending of them
+are handed to the worker pool at a time, so a burst of thousands of
+files costs memory for the queue but never swamps the pool.  After
+the first scan the directory is only listed again if inotify's event
+queue overflows.
+
+    python -m seqviewer.daemon [-j JOBS] [-o OUTDIR] [--debounce SECONDS]
+                               [--poll] [--trace FILE] [--detach]
+                               [--pidfile FILE] DIRECTORY
+"""
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import struct
+import ctypes
+import ctypes.util
+import argparse
+import traceback
+import collections
+import multiprocessing
+import Queue
+
+import batch
+import store
+import instrument
+
+roles = [('-1.ab1', 'read1'), ('-2.ab1', 'read2'), ('.fasta', 'fasta')]
+
+def sample_of(filename):
+    """Return (sample name, role) of *filename*, or None if not a sample file."""
+    base = os.path.basename(filename)
+    for suffix, role in roles:
+        if base.endswith(suffix) and len(base) > len(suffix):
+            return base[:-len(suffix)], role
+    return None
+
+class Grouper(object):
+    """Collects the files of each sample until it is ready to assemble."""
+    def __init__(self, directory, debounce=5.0):
+        self.directory = directory
+        self.debounce = debounce
+        # Sample name to [dict of role to path, time of last change].
+        self.groups = {}
+        # The files of each sample already assembled, so that a file
+        # arriving late (such as the lab assembly) reassembles it.
+        self.assembled = {}
+        # Samples being assembled, which are not assembled again until
+        # they finish, so that two jobs never write the same output.
+        self.running = set()
+
+    def add(self, filename, now):
+        s = sample_of(filename)
+        if s is None:
+            return
+        name, role = s
+        group = self.groups.setdefault(
+            name, [dict(self.assembled.get(name, {})), now])
+        group[0][role] = os.path.join(self.directory, os.path.basename(filename))
+        group[1] = now
+
+    def add_assembled(self, filename):
+        """Record *filename* as belonging to a sample already assembled."""
+        s = sample_of(filename)
+        if s is None:
+            return
+        name, role = s
+        self.assembled.setdefault(name, {})[role] = \
+            os.path.join(self.directory, os.path.basename(filename))
+
+    def finished(self, name):
+        """Note that the sample *name* is no longer being assembled."""
+        self.running.discard(name)
+
+    def ready(self, now):
+        """Remove and return the samples ready to assemble, by name."""
+        samples = []
+        for name, (files, changed) in sorted(self.groups.items()):
+            if 'read1' not in files or 'read2' not in files or \
+                    name in self.running:
+                continue
+            if 'fasta' in files or now - changed >= self.debounce:
+                samples.append(batch.Sample(name, files['read1'],
+                                            files['read2'], files.get('fasta')))
+                self.assembled[name] = files
+                self.running.add(name)
+                del self.groups[name]
+        return samples
+
+    def next_deadline(self):
+        """Return when the next sample waiting on the debounce window is due."""
+        waiting = [changed + self.debounce
+                   for name, (files, changed) in self.groups.items()
+                   if 'read1' in files and 'read2' in files and
+                   name not in self.running]
+        if not waiting:
+            return None
+        return min(waiting)
+
+# From <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+event_header = struct.Struct('iIII')
+
+class InotifyWatcher(object):
+    """Reports files written or moved into *directory*, using inotify.
+
+    Raises OSError if inotify is not available.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        if libc.inotify_add_watch(self.fd, directory,
+                                  IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            e = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(e, os.strerror(e))
+
+    def close(self):
+        os.close(self.fd)
+
+    def changes(self, timeout):
+        """Wait up to *timeout* seconds and return (filenames, overflowed).
+
+        If *overflowed*, events were lost and the directory must be
+        scanned to catch up.
+        """
+        try:
+            r, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return [], False
+            raise
+        names = []
+        overflowed = False
+        while r:
+            try:
+                buf = os.read(self.fd, 1 << 20)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            pos = 0
+            while pos < len(buf):
+                _, mask, _, n = event_header.unpack_from(buf, pos)
+                pos += event_header.size
+                if mask & IN_Q_OVERFLOW:
+                    overflowed = True
+                elif n:
+                    names.append(buf[pos:pos+n].rstrip('\0'))
+                pos += n
+        return names, overflowed
+
+class PollingWatcher(object):
+    """Reports files that appear or change in *directory* by listing it."""
+    def __init__(self, directory):
+        self.directory = directory
+        self.seen = self.scan()
+
+    def close(self):
+        pass
+
+    def scan(self):
+        seen = {}
+        for f in os.listdir(self.directory):
+            try:
+                st = os.stat(os.path.join(self.directory, f))
+            except OSError:
+                continue
+            seen[f] = (st.st_size, st.st_mtime)
+        return seen
+
+    def changes(self, timeout):
+        time.sleep(timeout)
+        seen = self.scan()
+        names = [f for f, v in seen.items() if self.seen.get(f) != v]
+        self.seen = seen
+        return names, False
+
+def watcher(directory, poll=False):
+    if not poll:
+        try:
+            return InotifyWatcher(directory)
+        except OSError, e:
+            print >>sys.stderr, 'inotify unavailable (%s), polling instead' % e
+    return PollingWatcher(directory)
+
+def guarded(work, failed, sample, *args):
+    """Return work(sample, *args), or failed(sample, traceback) if it raises."""
+    try:
+        return work(sample, *args)
+    except Exception:
+        return failed(sample, traceback.format_exc())
+
+class Dispatcher(object):
+    """Runs *work* on samples in *pool*, at most *max_pending* at a time.
+
+    Samples beyond that wait in a queue in this process.  *work* is
+    called as work(sample, *args) and its results are returned by
+    collect as they finish.  If it raises, failed(sample, traceback)
+    is returned instead, so that no job is lost.
+    """
+    def __init__(self, pool, work, args=(), max_pending=8,
+                 failed=batch.failed):
+        self.pool = pool
+        self.work = work
+        self.failed = failed
+        self.args = args
+        self.max_pending = max_pending
+        self.queue = collections.deque()
+        self.pending = 0
+        self.done = Queue.Queue()
+
+    def submit(self, sample):
+        self.queue.append(sample)
+        self.pump()
+
+    def pump(self):
+        while self.queue and self.pending < self.max_pending:
+            self.pending += 1
+            self.pool.apply_async(guarded, (self.work, self.failed,
+                                            self.queue.popleft()) + self.args,
+                                  callback=self.done.put)
+
+    def collect(self, timeout=0):
+        """Return the results that have finished, waiting up to *timeout*
+        seconds for the first one if there are jobs in flight."""
+        results = []
+        try:
+            if timeout and self.pending:
+                results.append(self.done.get(timeout=timeout))
+            while True:
+                results.append(self.done.get_nowait())
+        except Queue.Empty:
+            pass
+        self.pending -= len(results)
+        self.pump()
+        return results
+
+    def idle(self):
+        return not self.queue and not self.pending
+
+def watch(directory, outdir=None, jobs=None, debounce=5.0, poll=False,
+          cache_dir=None, format='tracks', catalog=None,
+          report=batch.report_result, stop=lambda: False, sinks=()):
+    """Assemble samples arriving in *directory* until stop() is true.
+
+    Samples already in *directory* without output in *outdir* are
+    assembled first; those with output are reassembled if more of
+    their files arrive.  The remaining arguments are as for batch.run.
+    """
+    outdir = outdir or directory
+    w = watcher(directory, poll)
+    grouper = Grouper(directory, debounce)
+    pool = multiprocessing.Pool(jobs)
+    dispatcher = Dispatcher(pool, batch.process,
+                            (outdir, cache_dir, format, bool(sinks)),
+                            max_pending=2*(jobs or multiprocessing.cpu_count()))
+    def scan():
+        now = time.time()
+        for f in os.listdir(directory):
+            s = sample_of(f)
+            if s is None:
+                continue
+            if os.path.exists(batch.output_path(outdir, s[0], format)):
+                grouper.add_assembled(f)
+            else:
+                grouper.add(f, now)
+    try:
+        scan()
+        while not stop():
+            now = time.time()
+            for s in grouper.ready(now):
+                dispatcher.submit(s)
+            for r in dispatcher.collect():
+                grouper.finished(r.name)
+                if catalog is not None and r.error is None:
+                    catalog.add(r.name, r.path, r.stats)
+                for e in r.events:
+                    for sink in sinks:
+                        sink.event(e)
+                if report:
+                    report(r)
+            deadline = grouper.next_deadline()
+            timeout = 1.0
+            if deadline is not None:
+                timeout = min(timeout, max(0.0, deadline - now))
+            if not dispatcher.idle():
+                timeout = min(timeout, 0.1)
+            names, overflowed = w.changes(timeout)
+            now = time.time()
+            for f in names:
+                grouper.add(f, now)
+            if overflowed:
+                scan()
+    finally:
+        w.close()
+        pool.close()
+        pool.join()
+
+def daemonize(pidfile=None):
+    """Detach from the terminal with the usual double fork.
+
+    Writes our process id to *pidfile*, if given, and removes it
+    again on exit.
+    """
+    if os.fork() > 0:
+        os._exit(0)
+    os.chdir('/')
+    os.setsid()
+    os.umask(0o22)
+    if os.fork() > 0:
+        os._exit(0)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(null, fd)
+    if pidfile:
+        with open(pidfile, 'w') as h:
+            print >>h, os.getpid()
+        import atexit
+        atexit.register(lambda: os.path.exists(pidfile) and os.unlink(pidfile))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Assemble samples as they arrive in a directory.')
+    parser.add_argument('directory')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='where to write results (default: DIRECTORY)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per core)')
+    parser.add_argument('--debounce', type=float, default=5.0,
+                        help='seconds to wait for a lab assembly after both '
+                        'reads arrive')
+    parser.add_argument('--poll', action='store_true',
+                        help='poll the directory instead of using inotify')
+    parser.add_argument('--cache', default=None, metavar='CACHEDIR',
+                        help='cache parsed reads, contigs and results here')
+    parser.add_argument('--format', choices=batch.formats, default='tracks')
+    parser.add_argument('--catalog', default=None,
+                        help='SQLite catalog to record samples in '
+                        '(default: OUTDIR/catalog.sqlite)')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='append spans and counters here as JSON lines')
+    parser.add_argument('--detach', action='store_true',
+                        help='run in the background')
+    parser.add_argument('--pidfile', default=None)
+    args = parser.parse_args(argv)
+    directory = os.path.abspath(args.directory)
+    outdir = os.path.abspath(args.outdir or directory)
+    catalog = store.Catalog(os.path.abspath(
+        args.catalog or os.path.join(outdir, 'catalog.sqlite')))
+    cache_dir = args.cache and os.path.abspath(args.cache)
+    trace = args.trace and os.path.abspath(args.trace)
+    if args.detach:
+        daemonize(args.pidfile and os.path.abspath(args.pidfile))
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *_: stopping.append(True))
+    with open(trace or os.devnull, 'a') as h:
+        sinks = trace and [instrument.JSONLines(h)] or []
+        try:
+            watch(directory, outdir, args.jobs, args.debounce, args.poll,
+                  cache_dir, args.format, catalog, stop=lambda: stopping,
+                  sinks=sinks)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def test_grouper():
+    g = Grouper('/data', debounce=5)
+    for f in ['a-1.ab1', 'b-1.ab1', 'a-2.ab1', 'b-2.ab1', 'notes.txt', '-1.ab1']:
+        g.add(f, 0)
+    g.add('b.fasta', 1)
+    assert g.ready(2) == [batch.Sample('b', '/data/b-1.ab1', '/data/b-2.ab1',
+                                       '/data/b.fasta')]
+    assert g.next_deadline() == 5
+    assert g.ready(4) == []
+    assert [s.name for s in g.ready(5)] == ['a']
+    assert g.ready(100) == [] and g.next_deadline() is None
+    g.add('c-1.ab1', 0)
+    assert g.ready(100) == []
+    # A lab assembly arriving late reassembles the sample at once.
+    g.finished('a')
+    g.add('a.fasta', 200)
+    assert g.ready(200) == [batch.Sample('a', '/data/a-1.ab1', '/data/a-2.ab1',
+                                         '/data/a.fasta')]
+    # A sample is not dispatched again until its running job finishes.
+    g.add('a-1.ab1', 201)
+    assert g.ready(300) == [] and g.next_deadline() is None
+    g.finished('a')
+    assert [s.name for s in g.ready(300)] == ['a']
+    # Samples assembled before a restart are reassembled by a late
+    # lab assembly too.
+    g = Grouper('/data', debounce=5)
+    g.add_assembled('d-1.ab1')
+    g.add_assembled('d-2.ab1')
+    assert g.ready(100) == []
+    g.add('d.fasta', 100)
+    assert g.ready(100) == [batch.Sample('d', '/data/d-1.ab1', '/data/d-2.ab1',
+                                         '/data/d.fasta')]
+
+def test_watchers():
+    import tempfile, shutil
+    d = tempfile.mkdtemp()
+    try:
+        watchers = [PollingWatcher(d)]
+        try:
+            watchers.append(InotifyWatcher(d))
+        except OSError:
+            pass
+        for i in range(2000):
+            open(os.path.join(d, 'x%d-1.ab1' % i), 'w').close()
+        os.rename(os.path.join(d, 'x0-1.ab1'), os.path.join(d, 'y-1.ab1'))
+        for w in watchers:
+            names, overflowed = w.changes(0.01)
+            assert not overflowed
+            # inotify also sees x0-1.ab1 written before it was renamed.
+            assert len(set(names) - set(['x0-1.ab1'])) == 2000
+            assert 'y-1.ab1' in names
+            w.close()
+    finally:
+        shutil.rmtree(d)
+
+def test_watch():
+    import tempfile, shutil, threading
+    import trackfile
+    here = os.path.join(os.path.dirname(__file__), '..', 'test_data')
+    d = tempfile.mkdtemp()
+    try:
+        reported = []
+        t = threading.Thread(target=watch, args=(d,),
+                             kwargs={'jobs': 1, 'debounce': 0.2,
+                                     'report': reported.append,
+                                     'stop': lambda: len(reported) == 1})
+        t.start()
+        for f in ['tmpzRpKiy-1.ab1', 'tmpzRpKiy-2.ab1']:
+            shutil.copy(os.path.join(here, f), d)
+        t.join(60)
+        assert not t.is_alive()
+        assert [(r.name, r.fate, r.error) for r in reported] == \
+            [('tmpzRpKiy', 'both', None)]
+        _, meta = trackfile.load(os.path.join(d, 'tmpzRpKiy.tracks'))
+        assert meta == {'fate': 'both'}
+    finally:
+        shutil.rmtree(d)
+
+def test_dispatcher():
+    import threading
+    import multiprocessing.dummy
+    gate = threading.Event()
+    running = []
+    def work(x, y):
+        running.append(x)
+        gate.wait()
+        if x % 2:
+            raise ValueError
+        return x + y
+    pool = multiprocessing.dummy.Pool(4)
+    try:
+        d = Dispatcher(pool, work, (10,), max_pending=2,
+                       failed=lambda x, error: -x)
+        for i in range(5):
+            d.submit(i)
+        time.sleep(0.1)
+        assert sorted(running) == [0, 1] and len(d.queue) == 3
+        gate.set()
+        results = []
+        while not d.idle():
+            results.extend(d.collect(timeout=1))
+        assert sorted(results) == [-3, -1, 10, 12, 14]
+    finally:
+        pool.close()
+        pool.join()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,9 @@
 """
 fasta.py - Module to run and parse FASTA alignment
 
-This module only binds the ssearch36 program, which does pairwise,
-global alignment.
+fasta aligns two sequences with one of several backends: 'native',
+the in-process aligner in align.pyx, or 'ssearch36', which runs the
+ssearch36 program from the FASTA package and is kept as a reference.
 """
 import re
 import os
@@ -10,7 +11,13 @@ import shutil
 import tempfile
 import subprocess
 import contextlib
+import itertools
+import multiprocessing.pool
 import Bio.SeqIO
+import distutils.spawn
+
+import align
+import instrument
 
 @contextlib.contextmanager
 def as_fasta(seq, tmpdir=None, label='sequence'):
@@ -31,7 +38,44 @@ def as_fasta(seq, tmpdir=None, label='sequence'):
     finally:
         os.unlink(db_name)
 
-def fasta(seq1, seq2, ssearch36_path="ssearch36", tmpdir='/tmp'):
+def fasta(seq1, seq2, backend='native', **kwargs):
+    """Align *seq1* and *seq2*.
+
+    Returns ((offset1, aligned1), (offset2, aligned2)), where aligned1
+    and aligned2 are the sequences with gaps inserted, and the offsets
+    place them in a common frame where aligned columns coincide.
+    *kwargs* are passed on to the backend.
+    """
+    try:
+        f = backends[backend]
+    except KeyError:
+        raise ValueError("Unknown alignment backend %s" % (backend,))
+    with instrument.span('fasta', backend=backend):
+        result = f(seq1, seq2, **kwargs)
+        if instrument.active():
+            (_, aligned1), (_, aligned2) = result
+            instrument.count('fasta.bases', len(seq1) + len(seq2))
+            instrument.count('fasta.alignment_length',
+                             max(len(aligned1), len(aligned2)))
+            instrument.count('fasta.gaps',
+                             aligned1.count('-') + aligned2.count('-'))
+    return result
+
+def native(seq1, seq2, mode='local', **kwargs):
+    return align.align(seq1, seq2, mode=mode, **kwargs)
+
+def seeded(seq1, seq2, k=12, band=16, mode='local', **kwargs):
+    """Align in a band around the diagonal where most k-mers match.
+
+    Falls back to aligning the whole of both sequences when no
+    diagonal has enough shared k-mers.
+    """
+    d = align.best_diagonal(seq1, seq2, k)
+    if d is None:
+        return native(seq1, seq2, mode=mode, **kwargs)
+    return native(seq1, seq2, mode=mode, diagonals=(d-band, d+band), **kwargs)
+
+def ssearch36(seq1, seq2, ssearch36_path="ssearch36", tmpdir='/tmp'):
     with as_fasta(seq1, tmpdir) as fasta1, as_fasta(seq2, tmpdir) as fasta2:
         command = ' '.join([ssearch36_path, '-d','1','-m','3', fasta1, fasta2])
         pipe = subprocess.Popen(str(command), shell=True, 
@@ -42,6 +86,9 @@ def fasta(seq1, seq2, ssearch36_path="ssearch36", tmpdir='/tmp'):
         assert len(seq2) == len(res[1][1])
         return res
 
+backends = {'native': native,
+            'seeded': seeded,
+            'ssearch36': ssearch36}
 
 
 def parse_fasta(alignment, origseq1, origseq2):
@@ -80,10 +127,173 @@ def parse_fasta(alignment, origseq1, origseq2):
     return ((offset1, bases1), (offset2, bases2))
         
 
+def split_alignments(output, query_label='q'):
+    """Split ssearch36 -m 3 output for one query into one text per hit.
+
+    Returns a dict from library label to the lines of that alignment,
+    relabelled as '>sequen ..' so parse_fasta can read them.
+    """
+    def label(line):
+        return line.startswith('>') and line[1:].split()[0] or None
+    lines = output.split('\n')
+    results = {}
+    i = 0
+    while i < len(lines):
+        if label(lines[i]) != query_label:
+            i += 1
+            continue
+        c = i + 1
+        while c < len(lines) and not lines[c].startswith('>'):
+            c += 1
+        if c == len(lines):
+            break
+        r = lines[c:].index('') + c if '' in lines[c:] else len(lines)
+        results[label(lines[c])] = '\n'.join(['>sequen ..'] + lines[i+1:c] +
+                                             ['>sequen ..'] + lines[c+1:r] + [''])
+        i = r
+    return results
+
+def default_scratch():
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return None
+
+class SSearchPool(object):
+    """Run many ssearch36 alignments on a bounded pool of workers.
+
+    Pairs sharing their first sequence are aligned by one ssearch36
+    run, with that sequence as the query on stdin and the second
+    sequences as a multi-record library file, and the runs are spread
+    over *workers* concurrent processes.  Library files live in a
+    scratch directory of the pool's own, on tmpfs where available,
+    which is removed by close().  Use it as a context manager:
+
+        with SSearchPool() as pool:
+            results = pool.align_many([(s1, s2), (s1, s3), (s4, s5)])
+    """
+    def __init__(self, workers=4, ssearch36_path="ssearch36", scratch=None):
+        self.ssearch36_path = ssearch36_path
+        self.scratch = tempfile.mkdtemp(prefix='seqviewer-',
+                                        dir=scratch or default_scratch())
+        self.pool = multiprocessing.pool.ThreadPool(workers)
+        self.counter = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def align(self, seq1, seq2):
+        return self.align_many([(seq1, seq2)])[0]
+
+    def align_many(self, pairs):
+        """Align each (seq1, seq2) in *pairs*, returning results in order."""
+        groups = {}
+        for k, (seq1, seq2) in enumerate(pairs):
+            groups.setdefault(seq1, []).append((k, seq2))
+        results = [None] * len(pairs)
+        batches = self.pool.map(lambda g: self.run(*g), groups.items())
+        for batch in batches:
+            for k, res in batch:
+                results[k] = res
+        return results
+
+    def run(self, query, library):
+        """Align *query* against each (k, seq) in *library* in one process."""
+        name = os.path.join(self.scratch, 'lib%d.fasta' % next(self.counter))
+        with open(name, 'w') as h:
+            for i, (_, seq) in enumerate(library):
+                h.write('>l%d\n%s\n' % (i, seq))
+        try:
+            n = str(len(library))
+            pipe = subprocess.Popen([self.ssearch36_path, '-b', n, '-d', n,
+                                     '-m', '3', '@', name],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            (output, _) = pipe.communicate('>q\n%s\n' % query)
+        finally:
+            os.unlink(name)
+        alignments = split_alignments(output)
+        results = []
+        for i, (k, seq) in enumerate(library):
+            if 'l%d' % i in alignments:
+                res = parse_fasta(alignments['l%d' % i], query, seq)
+            else:
+                # Not reported in the batch; align it on its own.
+                res = ssearch36(query, seq, self.ssearch36_path, self.scratch)
+            results.append((k, res))
+        return results
+
+def test_split_alignments():
+    output = '\n'.join(['SSEARCH header', '>q ..', '  ACGTAC', 'GT', '>l1 ..',
+                        'ACG-ACGT', '', '>q ..', 'ACGTACGT', '>l0 ..',
+                        '   TACGT', '', 'trailer'])
+    alignments = split_alignments(output)
+    assert sorted(alignments) == ['l0', 'l1']
+    assert parse_fasta(alignments['l1'], 'ACGTACGT', 'ACGACGT') == \
+        ((2, 'ACGTACGT'), (0, 'ACG-ACGT'))
+    assert parse_fasta(alignments['l0'], 'ACGTACGT', 'TACGT') == \
+        ((0, 'ACGTACGT'), (3, 'TACGT'))
+
+def test_ssearch_pool():
+    if distutils.spawn.find_executable('ssearch36') is None:
+        return
+    s = 'CTCAGGATGAACGCTGGCGGCGTGCCTAATACATGCMAGTCGAGCGAACAGATAAGGAGCTTGCTCCTTTGACGTTAGCGGCGGACGGGTGAGTAACACGTGGGTAACCTACCTATAAGACTGGGACAACTTCGGGAAACCGGAGCTAATACCGGATAATATGTTGAACCGCATGGTTCAATAGTGAAAGATGG'
+    pairs = [(s, s[5:-10]), (s, s[40:]), (s[20:], s[:100] + s[104:])]
+    with SSearchPool(workers=2) as pool:
+        assert pool.align_many(pairs) == \
+            [fasta(s1, s2, backend='ssearch36') for s1, s2 in pairs]
+        assert os.path.isdir(pool.scratch)
+    assert not os.path.exists(pool.scratch)
+
 def test_ssearch():
     s1 = 'CTCAGGATGAACGCTGGCGGCGTGCCTAATACATGCMAGTCGAGCGAACAGATAAGGAGCTTGCTCCTTTGACGTTAGCGGCGGACGGGTGAGTAACACGTGGGTAACCTACCTATAAGACTGGGACAACTTCGGGAAACCGGAGCTAATACCGGATAATATGTTGAACCGCATGGTTCAATAGTGAAAGATGGTTTTGCTATCACTTATAGATGGACCCGCGCCGTATTAGCTAGTTGGTGAGGTAACGGCTCACCAAGGCAACGATACGTAGCCGACCTGAGAGGGTGATCGGCCACACTGGAACTGAGACACGGTCCAGACTCCTACGGGAGGCAGCAGTAGGGAATCTTCCGCAATGGGCGAAAGCCTGACGGAGCAACGCCGCGTGAGTGATGAAGGTCTTAGGATCGTAAAACTCTGTTATTAGGGAAGAACAAACGTGTAAGTAACTGTGCACGTCTTGACGGTACCTAATCAGAAAGCCACGGCTAACTACG'
     s2 = 'GATGAACGCTGGCGGCGTGCCTAATACATGCAAGTCGAGCGAACAGATAAGGAGCTTGCTCCTTTGACGTTAGCGGCGGACGGGTGAGTAACACGTGGGTAACCTACCTATAAGACTGGGACAACTTCGGGAAACCGGAGCTAATACCGGATAATATGTTGAACCGCATGGTTCAATAGTGAAAGATGGTTTTGCTATCACTTATAGATGGACCCGCGCCGTATTAGCTAGTTGGTGAGGTAACGGCTCACCAAGGCAACGATACGTAGCCGACCTGAGAGGGTGATCGGCCACACTGGAACTGAGACACGGTCCAGACTCCTACGGGAGGCAGCAGTAGGGAATCTTCCGCAATGGGCGAAAGCCTGACGGAGCAACGCCGCGTGAGTGATGAAGGTCTTAGGATCGTAAAACTCTGTTATTAGGGAAGAACAAACGTGTAAGTAACTGTGCACGTCTTGACGGTACCTAATCAGAAAGCCACGGCTAACTA'
-    print fasta(s1,s2)
+    print fasta(s1,s2,backend='ssearch36')
+
+def test_native():
+    assert fasta('ACGTACGTAA', 'ACGTACGTAA') == \
+        ((0, 'ACGTACGTAA'), (0, 'ACGTACGTAA'))
+    # Overlapping reads are placed in a common frame.
+    assert fasta('TTTTACGTACGTAAGG', 'ACGTACGTAAGGCCCC') == \
+        ((0, 'TTTTACGTACGTAAGG'), (4, 'ACGTACGTAAGGCCCC'))
+    assert fasta('ACGTACGTAAGGCCCC', 'TTTTACGTACGTAAGG') == \
+        ((4, 'ACGTACGTAAGGCCCC'), (0, 'TTTTACGTACGTAAGG'))
+    # Gaps are affine, and ambiguity codes match what they contain.
+    s1 = 'GATTACAGATTACAGATTACA'
+    s2 = 'GATTACAGATTTTTTACAGATTACA'
+    assert fasta(s1, s2) == ((0, 'GATTACAGA----TTACAGATTACA'), (0, s2))
+    assert fasta(s1, s2, mode='global') == fasta(s1, s2)
+    assert fasta(s1, s2, diagonals=(-1, 5)) == fasta(s1, s2)
+    assert fasta('CCCCCGATTACAGATTACAGATTACA', 'GATTACRGATTACAGATTACAGGGGG') \
+        == ((0, 'CCCCCGATTACAGATTACAGATTACA'), (5, 'GATTACRGATTACAGATTACAGGGGG'))
+
+def test_seeded():
+    s = 'CTCAGGATGAACGCTGGCGGCGTGCCTAATACATGCMAGTCGAGCGAACAGATAAGGAGCTTGCTCCTTTGACGTTAGCGGCGGACGGGTGAGTAACACGTGGGTAACCTACCTATAAGACTGGGACAACTTCGGGAAACCGGAGCTAATACCGGATAATATGTTGAACCGCATGGTTCAATAGTGAAAGATGG'
+    assert align.best_diagonal(s[30:], s) == 30
+    assert align.best_diagonal(s, s[30:]) == -30
+    assert align.best_diagonal(s, 'N'*len(s)) is None
+    for s1, s2 in [(s, s[5:-10]), (s[:-30], s[40:]),
+                   (s[20:], s[:100] + s[104:]),
+                   (s[20:], s[:100] + 'GATTACA' + s[100:])]:
+        assert fasta(s1, s2, backend='seeded') == fasta(s1, s2)
+    # Too short to seed, so this falls back to the full alignment.
+    assert fasta('ACGTACGTAA', 'ACGTACGTAA', backend='seeded') == \
+        fasta('ACGTACGTAA', 'ACGTACGTAA')
+
+def test_native_matches_ssearch36():
+    if distutils.spawn.find_executable('ssearch36') is None:
+        return
+    s = 'CTCAGGATGAACGCTGGCGGCGTGCCTAATACATGCMAGTCGAGCGAACAGATAAGGAGCTTGCTCCTTTGACGTTAGCGGCGGACGGGTGAGTAACACGTGGGTAACCTACCTATAAGACTGGGACAACTTCGGGAAACCGGAGCTAATACCGGATAATATGTTGAACCGCATGGTTCAATAGTGAAAGATGG'
+    for s1, s2 in [(s, s[5:-10]), (s[:-30], s[40:]),
+                   (s[20:], s[:100] + s[104:])]:
+        assert fasta(s1, s2) == fasta(s1, s2, backend='ssearch36')
 
 if __name__=='__main__':
     test_ssearch()
@@ -0,0 +1,219 @@
+"""
+instrument.py - Spans and counters reported by the assembly pipeline
+
+The stages of assembly report how long they take and what they did:
+
+    with instrument.span('contig') as s:
+        ...
+        s['strands'] = 'both'
+    instrument.count('fasta.gaps', n)
+
+Nothing is recorded unless a sink is installed with recording(), so by
+default span() returns a shared object that does nothing and count()
+returns at once.  Work done only to compute a counter should be
+guarded by active().  A sink is any object with an event(dict) method;
+each event is a dict with 'type' ('span' or 'count'), 'name', and
+'path', the names of the enclosing spans joined by '/'.  Spans also
+have 'start' and 'seconds', and 'error' if their block raised;
+counters have 'value'.
+
+    with instrument.recording(instrument.JSONLines(h), summary):
+        assemble.assemble(read1, read2)
+    summary.report()
+"""
+import sys
+import json
+import time
+import threading
+import contextlib
+
+_sinks = []
+_local = threading.local()
+
+def active():
+    """Return whether any sink is recording."""
+    return bool(_sinks)
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+def emit(event):
+    for sink in _sinks:
+        sink.event(event)
+
+class NullSpan(object):
+    """What span() returns when nothing is recording."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+    def __setitem__(self, key, value):
+        pass
+
+null_span = NullSpan()
+
+class Span(object):
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __setitem__(self, key, value):
+        self.fields[key] = value
+
+    def __enter__(self):
+        stack = _stack()
+        stack.append(self.name)
+        self.path = '/'.join(stack)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, tb):
+        seconds = time.time() - self.start
+        _stack().pop()
+        event = dict(self.fields, type='span', name=self.name,
+                     path=self.path, start=self.start, seconds=seconds)
+        if type is not None:
+            event['error'] = type.__name__
+        emit(event)
+        return False
+
+def span(name, **fields):
+    """Return a context manager timing its block as the span *name*.
+
+    *fields* are added to the span's event, as are any items set on
+    the span inside the block.
+    """
+    if not _sinks:
+        return null_span
+    return Span(name, fields)
+
+def count(name, value=1, **fields):
+    """Report the counter *name* as *value*."""
+    if not _sinks:
+        return
+    stack = _stack()
+    event = dict(fields, type='count', name=name, path='/'.join(stack),
+                 value=value)
+    emit(event)
+
+@contextlib.contextmanager
+def recording(*sinks):
+    """Send the events of the enclosed block to *sinks*.
+
+    Sinks are shared by all threads, and are added to any already
+    recording.
+    """
+    _sinks.extend(sinks)
+    try:
+        yield sinks
+    finally:
+        for s in sinks:
+            _sinks.remove(s)
+
+class Collector(object):
+    """A sink keeping its events in the list *events*."""
+    def __init__(self):
+        self.events = []
+
+    def event(self, e):
+        self.events.append(e)
+
+class JSONLines(object):
+    """A sink writing each event to the file *h* as a line of JSON."""
+    def __init__(self, h):
+        self.h = h
+        self.lock = threading.Lock()
+
+    def event(self, e):
+        line = json.dumps(e, sort_keys=True) + '\n'
+        with self.lock:
+            self.h.write(line)
+            self.h.flush()
+
+class Summary(object):
+    """A sink totalling spans by path and counters by name."""
+    def __init__(self):
+        self.spans = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def event(self, e):
+        with self.lock:
+            if e['type'] == 'span':
+                n, total, longest, errors = \
+                    self.spans.get(e['path'], (0, 0.0, 0.0, 0))
+                self.spans[e['path']] = (n + 1, total + e['seconds'],
+                                         max(longest, e['seconds']),
+                                         errors + ('error' in e))
+            elif e['type'] == 'count':
+                n, total, largest = self.counters.get(e['name'],
+                                                      (0, 0, None))
+                self.counters[e['name']] = (n + 1, total + e['value'],
+                                            max(largest, e['value']))
+
+    def report(self, h=sys.stdout):
+        if self.spans:
+            print >>h, '%-40s %6s %10s %9s %9s %6s' % \
+                ('span', 'n', 'total', 'mean', 'max', 'errors')
+        for path in sorted(self.spans):
+            n, total, longest, errors = self.spans[path]
+            print >>h, '%-40s %6d %9.3fs %8.4fs %8.4fs %6d' % \
+                (path, n, total, total/n, longest, errors)
+        if self.counters:
+            print >>h, '%-40s %6s %12s %12s %12s' % \
+                ('counter', 'n', 'sum', 'mean', 'max')
+        for name in sorted(self.counters):
+            n, total, largest = self.counters[name]
+            print >>h, '%-40s %6d %12s %12s %12s' % \
+                (name, n, number(total), number(float(total)/n),
+                 number(largest))
+
+def number(x):
+    if isinstance(x, float):
+        return '%.4g' % x
+    return str(x)
+
+
+def test_disabled():
+    assert not active()
+    assert span('x', a=1) is null_span
+    with span('x') as s:
+        s['b'] = 2
+    count('y', 3)
+
+def test_recording():
+    import StringIO
+    c = Collector()
+    summary = Summary()
+    h = StringIO.StringIO()
+    with recording(c, summary, JSONLines(h)):
+        assert active()
+        with span('outer', sample='a') as s:
+            with span('inner'):
+                count('n', 2)
+            count('n', 3)
+            s['result'] = 'ok'
+        try:
+            with span('failing'):
+                raise ValueError
+        except ValueError:
+            pass
+    assert not active()
+    assert [(e['type'], e['name'], e['path']) for e in c.events] == \
+        [('count', 'n', 'outer/inner'), ('span', 'inner', 'outer/inner'),
+         ('count', 'n', 'outer'), ('span', 'outer', 'outer'),
+         ('span', 'failing', 'failing')]
+    assert c.events[3]['sample'] == 'a' and c.events[3]['result'] == 'ok'
+    assert c.events[4]['error'] == 'ValueError'
+    assert [json.loads(l) for l in h.getvalue().splitlines()] == c.events
+    assert summary.counters['n'] == (2, 5, 3)
+    assert summary.spans['failing'][3] == 1
+    out = StringIO.StringIO()
+    summary.report(out)
+    assert 'outer/inner' in out.getvalue()
@@ -0,0 +1,537 @@
+"""
+server.py - Serve assembled samples to the web interface
+
+Serves the track files or pickles written by batch.py from a
+directory, along with the files in resources/.  Samples are sent as an empty frame, and the
+interface fetches the columns of the frame in tiles as they scroll
+into view, so opening a sample costs the same however long it is.
+Browsers with canvas support instead fetch the whole sample once as a
+track file (see trackfile.py) and draw it themselves.
+
+Responses for a sample are rendered in a pool of worker processes, so
+a long render holds up only the request waiting for it.  Each carries
+an ETag derived from the hash of the sample's stored file, so a
+client revalidating an unchanged sample gets 304 Not Modified without
+anything being rendered, and the most recent responses are kept, with
+their gzipped bodies for clients that accept them.
+
+    GET /                               resources/interface.html
+    GET /list.json                      the samples, for the list pane
+    GET /samples/NAME                   the frame of sample NAME
+    GET /samples/NAME/tile?start=S&end=E  columns S to E of NAME
+    GET /samples/NAME/tracks            sample NAME as a track file
+
+    python -m seqviewer.server [-p PORT] [-j JOBS] [--resources DIR]
+                               [--catalog CATALOG] DIRECTORY
+
+With a catalog (see store.py), the list comes from the catalog and
+includes how well each sample agrees with its lab assembly.
+"""
+import os
+import sys
+import gzip
+import json
+import hashlib
+import urlparse
+import argparse
+import threading
+import mimetypes
+import cStringIO
+import collections
+import SocketServer
+import multiprocessing
+import wsgiref.simple_server
+
+import tracks
+import store
+import cache
+import trackfile
+
+resources = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '..', 'resources')
+
+# Largest number of columns served in one tile.
+max_tile = 1000
+
+# Part of every ETag for a sample; change it when rendering changes,
+# so that clients do not keep responses rendered the old way.
+render_version = 1
+
+class HTTPError(Exception):
+    def __init__(self, status, message=''):
+        Exception.__init__(self, status, message)
+        self.status = status
+        self.message = message
+
+class Samples(object):
+    """The samples stored in *directory*, loaded on demand.
+
+    Samples are NAME.tracks or NAME.pickle files; the track file wins
+    if there are both.  The most recently used *capacity* samples are
+    kept in memory and reloaded if their file changes.
+    """
+    def __init__(self, directory, capacity=16):
+        self.directory = directory
+        self.capacity = capacity
+        self.loaded = collections.OrderedDict()
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def names(self):
+        return sorted(set(os.path.splitext(f)[0]
+                          for f in os.listdir(self.directory)
+                          if f.endswith('.tracks') or f.endswith('.pickle')))
+
+    def path(self, name):
+        """Return the file holding sample *name*, or raise KeyError."""
+        if os.path.basename(name) == name:
+            for ext in ('.tracks', '.pickle'):
+                p = os.path.join(self.directory, name + ext)
+                if os.path.exists(p):
+                    return p
+        raise KeyError(name)
+
+    def get(self, name):
+        """Return (trackset, fate) of sample *name*, or raise KeyError."""
+        path = self.path(name)
+        stamp = (path, os.path.getmtime(path))
+        with self.lock:
+            if name in self.loaded and self.loaded[name][0] == stamp:
+                value = self.loaded.pop(name)
+                self.loaded[name] = value
+                return value[1]
+        if path.endswith('.tracks'):
+            t, meta = trackfile.load(path)
+            value = (stamp, (t, meta.get('fate')))
+        else:
+            with open(path, 'rb') as h:
+                value = (stamp, tracks.load(h))
+        with self.lock:
+            self.loaded.pop(name, None)
+            self.loaded[name] = value
+            while len(self.loaded) > self.capacity:
+                self.loaded.popitem(last=False)
+        return value[1]
+
+    def digest(self, name):
+        """Return the hash of the file holding sample *name*.
+
+        The file is only rehashed when its size or time changes.
+        """
+        path = self.path(name)
+        st = os.stat(path)
+        stamp = (path, st.st_size, st.st_mtime)
+        with self.lock:
+            if name in self.digests and self.digests[name][0] == stamp:
+                return self.digests[name][1]
+        digest = cache.hash_file(path)
+        with self.lock:
+            self.digests[name] = (stamp, digest)
+        return digest
+
+Response = collections.namedtuple('Response', ['content_type', 'body',
+                                               'gzipped', 'etag'])
+
+def compress(content_type, body):
+    """Return *body* gzipped, or None if that is not worth doing."""
+    if len(body) < 256 or content_type.startswith('image/'):
+        return None
+    buf = cStringIO.StringIO()
+    # A fixed mtime keeps the output the same for the same body.
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6, mtime=0) as h:
+        h.write(body)
+    return buf.getvalue()
+
+def response(content_type, body, etag=None):
+    """Return a Response of *body*, with an ETag of its hash by default."""
+    if etag is None:
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    return Response(content_type, body, compress(content_type, body), etag)
+
+def render(samples, name, kind, params, tile_size, etag):
+    """Render the *kind* of response for sample *name*.
+
+    *kind* is 'frame', 'tile' with *params* (start, end), or 'tracks'.
+    """
+    t, fate = samples.get(name)
+    if kind == 'frame':
+        body = '<style>\n' + tracks.stylesheet + '</style>\n' + \
+            t.render_frame('samples/%s/tile' % name, tile_size)
+        return response('text/html', body, etag)
+    elif kind == 'tile':
+        start, end = params
+        start, end = max(0, start), min(len(t), end)
+        if end - start > max_tile:
+            raise HTTPError('400 Bad Request',
+                            'At most %d columns per tile' % max_tile)
+        return response('text/html', t.columns(start, end, compact=True),
+                        etag)
+    # Trace points are quantized to the precision of the SVGs the
+    # tiles would draw them with.
+    return response('application/octet-stream',
+                    trackfile.encode(t, {'fate': fate}, quantized=True), etag)
+
+# The samples of a worker process in the render pool.
+worker_samples = None
+
+def init_worker(directory, capacity):
+    global worker_samples
+    worker_samples = Samples(directory, capacity)
+
+def render_in_worker(*args):
+    return render(worker_samples, *args)
+
+class Responses(object):
+    """The most recently used responses, up to *max_bytes* of them, by ETag."""
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def size(self, r):
+        return len(r.body) + len(r.gzipped or '')
+
+    def get(self, etag):
+        with self.lock:
+            r = self.entries.pop(etag, None)
+            if r is not None:
+                self.entries[etag] = r
+            return r
+
+    def put(self, r):
+        with self.lock:
+            if r.etag in self.entries:
+                self.total -= self.size(self.entries.pop(r.etag))
+            self.entries[r.etag] = r
+            self.total += self.size(r)
+            while self.total > self.max_bytes and self.entries:
+                _, old = self.entries.popitem(last=False)
+                self.total -= self.size(old)
+
+class Application(object):
+    """WSGI application serving *samples* and the files in *resources*.
+
+    *catalog*, a store.Catalog, is used for the list if given.
+    Samples are rendered by *pool*, a multiprocessing.Pool whose
+    workers were started with init_worker, or in the calling thread
+    if there is none.  Up to *cache_bytes* of responses are kept.
+    """
+    def __init__(self, samples, resources=resources, tile_size=100,
+                 catalog=None, pool=None, cache_bytes=64 << 20):
+        self.samples = samples
+        self.resources = resources
+        self.tile_size = tile_size
+        self.catalog = catalog
+        self.pool = pool
+        self.responses = Responses(cache_bytes)
+
+    def __call__(self, environ, start_response):
+        head = environ['REQUEST_METHOD'] == 'HEAD'
+        try:
+            if environ['REQUEST_METHOD'] not in ('GET', 'HEAD'):
+                raise HTTPError('405 Method Not Allowed')
+            path = environ.get('PATH_INFO', '') or '/'
+            query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+            r = self.route(path, query, environ.get('HTTP_IF_NONE_MATCH'))
+        except HTTPError, e:
+            content_type, body = 'text/plain', e.message or e.status
+            start_response(e.status, [('Content-Type', content_type),
+                                      ('Content-Length', str(len(body)))])
+            return [] if head else [body]
+        headers = [('ETag', r.etag), ('Vary', 'Accept-Encoding'),
+                   ('Cache-Control', 'no-cache')]
+        if matches(environ.get('HTTP_IF_NONE_MATCH'), r.etag):
+            start_response('304 Not Modified', headers)
+            return []
+        body = r.body
+        if r.gzipped is not None and \
+                accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING', '')):
+            body = r.gzipped
+            headers.append(('Content-Encoding', 'gzip'))
+        start_response('200 OK', headers +
+                       [('Content-Type', r.content_type),
+                        ('Content-Length', str(len(body)))])
+        return [] if head else [body]
+
+    def route(self, path, query, if_none_match=None):
+        """Return the Response for *path*.
+
+        Responses for a sample that match *if_none_match* are not
+        rendered, and have no body.
+        """
+        parts = path.strip('/').split('/')
+        if path == '/':
+            return self.resource('interface.html')
+        elif parts == ['list.json']:
+            return response('application/json', json.dumps(self.listing()))
+        elif len(parts) == 2 and parts[0] == 'samples':
+            return self.sample(parts[1], 'frame', (), if_none_match)
+        elif len(parts) == 3 and parts[0] == 'samples' and parts[2] == 'tile':
+            try:
+                params = (int(query['start'][0]), int(query['end'][0]))
+            except (KeyError, ValueError):
+                raise HTTPError('400 Bad Request',
+                                'start and end must be integers')
+            return self.sample(parts[1], 'tile', params, if_none_match)
+        elif len(parts) == 3 and parts[0] == 'samples' and parts[2] == 'tracks':
+            return self.sample(parts[1], 'tracks', (), if_none_match)
+        elif len(parts) == 1:
+            return self.resource(parts[0])
+        raise HTTPError('404 Not Found')
+
+    def sample(self, name, kind, params, if_none_match=None):
+        """Return the Response of *kind* for sample *name* (see render)."""
+        try:
+            digest = self.samples.digest(name)
+        except (KeyError, OSError):
+            raise HTTPError('404 Not Found', 'No sample %s' % name)
+        etag = '"%s"' % cache.digest(digest, kind, params, self.tile_size,
+                                     render_version)
+        if matches(if_none_match, etag):
+            return Response(None, '', None, etag)
+        r = self.responses.get(etag)
+        if r is None:
+            args = (name, kind, params, self.tile_size, etag)
+            try:
+                if self.pool is None:
+                    r = render(self.samples, *args)
+                else:
+                    r = self.pool.apply(render_in_worker, args)
+            except KeyError:
+                raise HTTPError('404 Not Found', 'No sample %s' % name)
+            self.responses.put(r)
+        return r
+
+    def resource(self, name):
+        p = os.path.join(self.resources, name)
+        if os.path.basename(name) != name or not os.path.isfile(p):
+            raise HTTPError('404 Not Found')
+        with open(p, 'rb') as h:
+            body = h.read()
+        return response(mimetypes.guess_type(name)[0] or
+                        'application/octet-stream', body)
+
+    def trackset(self, name):
+        try:
+            return self.samples.get(name)
+        except KeyError:
+            raise HTTPError('404 Not Found', 'No sample %s' % name)
+
+    def listing(self):
+        if self.catalog is not None:
+            return self.catalog_listing()
+        entries = []
+        for name in self.samples.names():
+            _, fate = self.trackset(name)
+            entries.append({'fields': {'Sample': name, 'Fate': fate},
+                            'content_url': 'samples/%s' % name,
+                            'data_url': 'samples/%s/tracks' % name})
+        return {'columns': [{'name': 'Sample', 'width': '20em'},
+                            {'name': 'Fate', 'width': '10em'}],
+                'entries': entries}
+
+    def catalog_listing(self):
+        entries = []
+        for r in self.catalog.samples():
+            fields = {'Sample': r['name'], 'Fate': r['fate']}
+            if r['percent_identity'] is not None:
+                fields['Identity'] = '%.1f%%' % (100*r['percent_identity'])
+                fields['Overlap'] = '%.1f%%' % (100*r['overlap_fraction'])
+                fields['Mismatches'] = r['mismatches']
+            entries.append({'fields': fields,
+                            'content_url': 'samples/%s' % r['name'],
+                            'data_url': 'samples/%s/tracks' % r['name']})
+        return {'columns': [{'name': 'Sample', 'width': '20em'},
+                            {'name': 'Fate', 'width': '10em'},
+                            {'name': 'Identity', 'width': '6em'},
+                            {'name': 'Overlap', 'width': '6em'},
+                            {'name': 'Mismatches', 'width': '6em'}],
+                'entries': entries}
+
+def matches(if_none_match, etag):
+    """Return whether the If-None-Match header *if_none_match* names *etag*."""
+    if not if_none_match:
+        return False
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+def accepts_gzip(accept_encoding):
+    for coding in accept_encoding.split(','):
+        parts = coding.strip().split(';')
+        if parts[0].strip() in ('gzip', 'x-gzip'):
+            q = [p.strip()[2:] for p in parts[1:] if p.strip().startswith('q=')]
+            try:
+                return not q or float(q[0]) > 0
+            except ValueError:
+                return False
+    return False
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                          wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+def serve(directory, port=8000, resources=resources, catalog=None,
+          jobs=None):
+    """Serve *directory* on *port*, rendering on *jobs* processes."""
+    samples = Samples(directory)
+    pool = multiprocessing.Pool(jobs, init_worker,
+                                (directory, samples.capacity))
+    app = Application(samples, resources,
+                      catalog=catalog and store.Catalog(catalog), pool=pool)
+    server = wsgiref.simple_server.make_server(
+        '', port, app, server_class=ThreadingWSGIServer)
+    print 'Serving %s on port %d' % (directory, port)
+    try:
+        server.serve_forever()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve assembled samples to the web interface.')
+    parser.add_argument('directory')
+    parser.add_argument('-p', '--port', type=int, default=8000)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='rendering processes (default: one per core)')
+    parser.add_argument('--resources', default=resources,
+                        help='directory of interface.html and friends')
+    parser.add_argument('--catalog', default=None,
+                        help='SQLite catalog of the samples (see store.py)')
+    args = parser.parse_args(argv)
+    serve(args.directory, args.port, args.resources, args.catalog,
+          args.jobs)
+
+
+def request(app, path, query='', headers={}, method='GET'):
+    """Call *app* on a request for *path*, returning (status, headers, body).
+
+    *headers* are added to the environment, as in HTTP_IF_NONE_MATCH.
+    """
+    environ = dict(headers, REQUEST_METHOD=method, PATH_INFO=path,
+                   QUERY_STRING=query)
+    status = []
+    body = ''.join(app(environ, lambda s, h: status.append((s, dict(h)))))
+    return status[0][0], status[0][1], body
+
+def get(app, path, query=''):
+    """Call *app* on a GET of *path*, returning (status, body)."""
+    status, _, body = request(app, path, query)
+    return status, body
+
+def test_application():
+    import tempfile, shutil
+    import batch
+    d = tempfile.mkdtemp()
+    try:
+        t = tracks.TrackSet([tracks.TrackEntry('bases', 0,
+                                               tracks.sequence('ACGTAC'*50))])
+        batch.save((t, 'both'), os.path.join(d, 'x.pickle'))
+        trackfile.save(os.path.join(d, 'z.tracks'), t, {'fate': 'none'})
+        app = Application(Samples(d), tile_size=100)
+        status, body = get(app, '/list.json')
+        assert status == '200 OK'
+        entries = json.loads(body)['entries']
+        assert entries == [{'fields': {'Sample': 'x', 'Fate': 'both'},
+                            'content_url': 'samples/x',
+                            'data_url': 'samples/x/tracks'},
+                           {'fields': {'Sample': 'z', 'Fate': 'none'},
+                            'content_url': 'samples/z',
+                            'data_url': 'samples/z/tracks'}]
+        status, body = get(app, '/samples/x')
+        assert status == '200 OK'
+        assert body.count('class="tile"') == 3
+        assert 'class="track-column"' not in body
+        status, body = get(app, '/samples/x/tile', 'start=200&end=400')
+        assert status == '200 OK'
+        assert body == t.columns(200, 300, compact=True)
+        assert get(app, '/samples/x/tile', 'start=a&end=3')[0] == \
+            '400 Bad Request'
+        assert get(app, '/samples/y')[0] == '404 Not Found'
+        assert get(app, '/samples/..%2Fx')[0] == '404 Not Found'
+        assert get(app, '/interface.js')[0] == '200 OK'
+        status, body = get(app, '/samples/x/tracks')
+        assert status == '200 OK'
+        assert body == trackfile.encode(t, {'fate': 'both'}, quantized=True)
+        assert get(app, '/samples/y/tracks')[0] == '404 Not Found'
+        catalog = store.Catalog(os.path.join(d, 'catalog.sqlite'))
+        store.index(catalog, d)
+        app = Application(Samples(d), catalog=catalog)
+        entries = json.loads(get(app, '/list.json')[1])['entries']
+        assert [e['fields']['Fate'] for e in entries] == ['both', 'none']
+    finally:
+        shutil.rmtree(d)
+
+def test_caching():
+    import tempfile, shutil, time
+    import batch
+    d = tempfile.mkdtemp()
+    pool = multiprocessing.Pool(1, init_worker, (d, 4))
+    try:
+        t = tracks.TrackSet([tracks.TrackEntry('bases', 0,
+                                               tracks.sequence('ACGTAC'*50))])
+        p = os.path.join(d, 'x.pickle')
+        batch.save((t, 'both'), p)
+        app = Application(Samples(d), pool=pool)
+        status, headers, body = request(app, '/samples/x/tile',
+                                        'start=0&end=100')
+        assert status == '200 OK'
+        assert body == t.columns(0, 100, compact=True)
+        etag = headers['ETag']
+        status, headers, body = request(
+            app, '/samples/x/tile', 'start=0&end=100',
+            {'HTTP_ACCEPT_ENCODING': 'deflate, gzip;q=0.5'})
+        assert headers['Content-Encoding'] == 'gzip'
+        assert headers['ETag'] == etag
+        assert gzip.GzipFile(fileobj=cStringIO.StringIO(body)).read() == \
+            t.columns(0, 100, compact=True)
+        assert 'Content-Encoding' not in request(
+            app, '/samples/x/tile', 'start=0&end=100',
+            {'HTTP_ACCEPT_ENCODING': 'gzip;q=0'})[1]
+        # HEAD has the headers of a GET and no body.
+        for encoding in ['', 'gzip']:
+            get_headers = request(app, '/samples/x/tile', 'start=0&end=100',
+                                  {'HTTP_ACCEPT_ENCODING': encoding})[1]
+            status, headers, body = request(
+                app, '/samples/x/tile', 'start=0&end=100',
+                {'HTTP_ACCEPT_ENCODING': encoding}, method='HEAD')
+            assert status == '200 OK' and body == ''
+            assert headers == get_headers
+        assert request(app, '/samples/y/tile', 'start=0&end=5',
+                       method='HEAD')[::2] == ('404 Not Found', '')
+        assert request(app, '/samples/x', method='POST')[0] == \
+            '405 Method Not Allowed'
+        # A matching ETag is answered without rendering.
+        app.responses = Responses()
+        status, headers, body = request(app, '/samples/x/tile',
+                                        'start=0&end=100',
+                                        {'HTTP_IF_NONE_MATCH': etag})
+        assert status == '304 Not Modified' and body == ''
+        assert not app.responses.entries
+        other = request(app, '/samples/x/tile', 'start=100&end=200')[1]
+        assert other['ETag'] != etag
+        # Changing the stored sample changes its ETags.
+        batch.save((tracks.TrackSet(t), 'none'), p)
+        os.utime(p, (time.time() + 10, time.time() + 10))
+        assert request(app, '/samples/x/tile', 'start=0&end=100',
+                       {'HTTP_IF_NONE_MATCH': etag})[0] == '200 OK'
+        assert get(app, '/samples/x/tile', 'start=0&end=b')[0] == \
+            '400 Bad Request'
+        assert get(app, '/samples/y/tile', 'start=0&end=5')[0] == \
+            '404 Not Found'
+        status, headers, _ = request(app, '/list.json')
+        assert request(app, '/list.json', '',
+                       {'HTTP_IF_NONE_MATCH': headers['ETag']})[0] == \
+            '304 Not Modified'
+        r = Responses(max_bytes=10)
+        r.put(Response('text/plain', 'abcdef', None, '"a"'))
+        r.put(Response('text/plain', 'ghijkl', None, '"b"'))
+        assert r.get('"a"') is None and r.get('"b"').body == 'ghijkl'
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+simplify.pyx - Polyline simplification for chromatogram traces
+
+greedy reproduces tracks.looped_sparsify exactly, point for point.
+rdp is Ramer-Douglas-Peucker with an absolute error bound.  Both
+measure error vertically, since traces are drawn into SVGs with
+preserveAspectRatio="none" and x and y are not on the same scale.
+"""
+import numpy
+
+cdef inline bint close_enough(double Lx, double Ly, double Rx, double Ry,
+                              double px, double py, double alpha):
+    # Same arithmetic, in the same order, as tracks.close_enough.
+    return abs(py - ((Ry-Ly)/(Rx-Lx))*(px-Lx) - Ly) < alpha * (Ly + Ry)/2.0
+
+def greedy(xs, ys, double alpha=0.005, int max_skip=10):
+    """Drop points lying within *alpha* of the line through their neighbours.
+
+    From each kept point, extend the line to the following points
+    while every point skipped so far is close_enough to it, skipping
+    at most *max_skip* points at a time.
+    """
+    cdef double[:] x = numpy.asarray(xs, dtype=float)
+    cdef double[:] y = numpy.asarray(ys, dtype=float)
+    cdef Py_ssize_t n = x.shape[0]
+    cdef Py_ssize_t i = 0, l, p, nskipped
+    cdef bint ok
+    new_points = [(x[0], y[0])]
+    while i < n-1:
+        l = i
+        nskipped = 0
+        while i < n-2 and nskipped < max_skip:
+            ok = True
+            for p in range(l+1, i+2):
+                if not close_enough(x[l], y[l], x[i+2], y[i+2],
+                                    x[p], y[p], alpha):
+                    ok = False
+                    break
+            if not ok:
+                break
+            nskipped += 1
+            i += 1
+        new_points.append((x[i+1], y[i+1]))
+        i += 1
+    return new_points
+
+def rdp(xs, ys, double epsilon=0.01):
+    """Ramer-Douglas-Peucker simplification of the polyline *xs*, *ys*.
+
+    No dropped point is more than *epsilon* away (vertically) from
+    the simplified line.
+    """
+    cdef double[:] x = numpy.asarray(xs, dtype=float)
+    cdef double[:] y = numpy.asarray(ys, dtype=float)
+    cdef Py_ssize_t n = x.shape[0]
+    cdef Py_ssize_t first, last, p, worst
+    cdef double d, dmax, slope
+    keep = numpy.zeros(n, dtype=numpy.uint8)
+    cdef unsigned char[:] k = keep
+    k[0] = 1
+    k[n-1] = 1
+    stack = [(0, n-1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        slope = (y[last]-y[first]) / (x[last]-x[first])
+        dmax = -1
+        worst = first
+        for p in range(first+1, last):
+            d = abs(y[p] - y[first] - slope*(x[p]-x[first]))
+            if d > dmax:
+                dmax = d
+                worst = p
+        if dmax > epsilon:
+            k[worst] = 1
+            stack.append((first, worst))
+            stack.append((worst, last))
+    return [(x[p], y[p]) for p in range(n) if k[p]]
@@ -0,0 +1,210 @@
+"""
+store.py - SQLite catalog of assembled samples
+
+Each sample's track file or pickle is indexed in an SQLite database,
+along with statistics computed when it is assembled: the fate of the
+assembly, the length of the reference, and how well the reference
+agrees with the lab assembly.  Listing samples or finding the ones
+that fail QC is then a single query instead of loading every sample.
+
+    python -m seqviewer.store CATALOG index DIRECTORY
+    python -m seqviewer.store CATALOG qc [--identity 0.99] [--overlap 0.9]
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import contextlib
+
+import tracks
+import trackfile
+
+schema = """
+CREATE TABLE IF NOT EXISTS samples (
+    name TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    fate TEXT,
+    reference_length INTEGER,
+    lab_length INTEGER,
+    percent_identity REAL,
+    overlap_fraction REAL,
+    mismatches INTEGER,
+    indexed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS samples_fate ON samples (fate);
+CREATE INDEX IF NOT EXISTS samples_percent_identity ON samples (percent_identity);
+CREATE INDEX IF NOT EXISTS samples_overlap_fraction ON samples (overlap_fraction);
+"""
+
+stat_fields = ['fate', 'reference_length', 'lab_length', 'percent_identity',
+               'overlap_fraction', 'mismatches']
+
+def find_track(t, name):
+    for e in t:
+        if e.name == name:
+            return e
+    return None
+
+def sample_stats(t, fate):
+    """Compute the catalog statistics of the TrackSet *t*.
+
+    Only the 'reference' and 'lab assembly' tracks are used, so *t*
+    may hold just those.  The comparisons with the lab assembly are
+    None if there is no lab assembly or no reference.
+    """
+    ref = find_track(t, 'reference')
+    lab = find_track(t, 'lab assembly')
+    stats = dict((f, None) for f in stat_fields)
+    stats['fate'] = fate
+    if ref is not None:
+        stats['reference_length'] = len(ref.track)
+    if lab is not None:
+        stats['lab_length'] = len(lab.track)
+    if ref is not None and lab is not None and fate != 'none':
+        diff = min(ref.offset+len(ref.track), lab.offset+len(lab.track)) - \
+            max(ref.offset, lab.offset)
+        stats['overlap_fraction'] = \
+            diff / (0.5 * (len(ref.track) + len(lab.track)))
+        refseg = ref.track[lab.offset - min(ref.offset, lab.offset):]
+        labseg = lab.track[ref.offset - min(ref.offset, lab.offset):]
+        pairs = zip(refseg, labseg)
+        same = sum([1 for x,y in pairs if x == y])
+        if pairs:
+            stats['percent_identity'] = float(same) / len(pairs)
+        stats['mismatches'] = len(pairs) - same
+    return stats
+
+def read_sample(path, names=None):
+    """Return (trackset, fate) from a track file or pickle."""
+    if path.endswith('.tracks'):
+        t, meta = trackfile.load(path, names)
+        return t, meta.get('fate')
+    with open(path, 'rb') as h:
+        return tracks.load(h)
+
+class Catalog(object):
+    """The catalog in the SQLite database *path*, created if need be.
+
+    Every method opens its own connection, so a Catalog can be shared
+    between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            db.executescript(schema)
+
+    @contextlib.contextmanager
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def add(self, name, path, stats):
+        """Record sample *name*, stored at *path*, with *stats*."""
+        row = dict(stats, name=name, path=os.path.abspath(path),
+                   mtime=os.path.getmtime(path), indexed=time.time())
+        fields = ['name', 'path', 'mtime', 'indexed'] + stat_fields
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO samples (%s) VALUES (%s)' %
+                       (', '.join(fields), ', '.join('?' * len(fields))),
+                       [row[f] for f in fields])
+
+    def remove(self, name):
+        with self.connect() as db:
+            db.execute('DELETE FROM samples WHERE name = ?', (name,))
+
+    def samples(self, where='', params=()):
+        """Return the rows of the samples matching *where*, by name."""
+        with self.connect() as db:
+            return db.execute('SELECT * FROM samples %s ORDER BY name' %
+                              (where and 'WHERE ' + where), params).fetchall()
+
+    def get(self, name):
+        rows = self.samples('name = ?', (name,))
+        return rows[0] if rows else None
+
+    def failing(self, min_identity=0.99, min_overlap=0.90):
+        """Return the samples whose reference disagrees with the lab assembly."""
+        return self.samples('percent_identity < ? OR overlap_fraction < ?',
+                            (min_identity, min_overlap))
+
+def index(catalog, directory):
+    """Add the samples in *directory* that are new or changed to *catalog*.
+
+    Returns the names of the samples indexed.
+    """
+    known = dict((r['path'], r['mtime']) for r in catalog.samples())
+    paths = {}
+    for f in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(f)
+        # Track files take precedence over pickles, as in server.py.
+        if ext == '.tracks' or (ext == '.pickle' and name not in paths):
+            paths[name] = os.path.abspath(os.path.join(directory, f))
+    indexed = []
+    for name, path in sorted(paths.items()):
+        if known.get(path) == os.path.getmtime(path):
+            continue
+        t, fate = read_sample(path, ['reference', 'lab assembly'])
+        catalog.add(name, path, sample_stats(t, fate))
+        indexed.append(name)
+    return indexed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Maintain and query the catalog of assembled samples.')
+    parser.add_argument('catalog')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('index', help='index new and changed samples')
+    p.add_argument('directory')
+    p = commands.add_parser('qc', help='list samples failing QC')
+    p.add_argument('--identity', type=float, default=0.99)
+    p.add_argument('--overlap', type=float, default=0.90)
+    args = parser.parse_args(argv)
+    catalog = Catalog(args.catalog)
+    if args.command == 'index':
+        for name in index(catalog, args.directory):
+            print name
+    else:
+        for r in catalog.failing(args.identity, args.overlap):
+            print '%-20s %-10s identity %.4f  overlap %.4f  mismatches %d' % \
+                (r['name'], r['fate'], r['percent_identity'],
+                 r['overlap_fraction'], r['mismatches'])
+    return 0
+
+
+def test_catalog():
+    import tempfile, shutil
+    d = tempfile.mkdtemp()
+    try:
+        t = tracks.TrackSet([
+            tracks.TrackEntry('reference', 2, tracks.sequence('ACGTACGT')),
+            tracks.TrackEntry('lab assembly', 0, tracks.sequence('GGACGAACG'))])
+        stats = sample_stats(t, 'both')
+        assert stats['reference_length'] == 8
+        assert stats['lab_length'] == 9
+        assert stats['mismatches'] == 1
+        assert stats['percent_identity'] == 6/7.0
+        assert stats['overlap_fraction'] == 7/8.5
+        assert sample_stats(t[:1], 'both')['percent_identity'] is None
+        trackfile.save(os.path.join(d, 'a.tracks'), t, {'fate': 'both'})
+        trackfile.save(os.path.join(d, 'b.tracks'), t[:1], {'fate': 'none'})
+        c = Catalog(os.path.join(d, 'catalog.sqlite'))
+        assert index(c, d) == ['a', 'b']
+        assert index(c, d) == []
+        assert [r['name'] for r in c.samples()] == ['a', 'b']
+        assert c.get('a')['mismatches'] == 1
+        assert [r['name'] for r in c.failing()] == ['a']
+        assert [r['name'] for r in c.samples('fate = ?', ('none',))] == ['b']
+        os.utime(os.path.join(d, 'b.tracks'), (0, 0))
+        assert index(c, d) == ['b']
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    sys.exit(main())
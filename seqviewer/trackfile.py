@@ -0,0 +1,290 @@
+"""
+trackfile.py - Binary storage of TrackSets
+
+A track file holds one TrackSet and a dict of metadata (such as the
+fate of the assembly), laid out so that it can be memory mapped and
+only the tracks asked for decoded:
+
+    header        magic 'SVTS', version, number of tracks, and where
+                  the metadata is
+    track table   one track_dtype entry per track
+    data          the name of each track, its metadata as JSON, and
+                  its arrays, each starting on an 8 byte boundary
+
+A Sequence is stored as its bytes, a Numeric as an array of values
+plus a mask of gaps (None), and a Traces as its point buffer and its
+starts and ends arrays.  All numbers are little endian.  Points are
+single precision floats, or, if the track's dtype is '<i2', 16 bit
+integers in units of 1/trace_scale, which is as precise as the SVGs
+the server draws and half the size.  Such files record trace_scale in
+their metadata.
+
+    python -m seqviewer.trackfile FILE.pickle ...
+
+converts pickles written by batch.py to FILE.tracks.
+"""
+import os
+import sys
+import json
+import mmap
+import numpy
+
+import tracks
+
+magic = 'SVTS'
+version = 1
+
+header_dtype = numpy.dtype([('magic', 'S4'),
+                            ('version', '<u4'),
+                            ('ntracks', '<u8'),
+                            ('meta_start', '<u8'),
+                            ('meta_size', '<u8')])
+
+# Each track has up to three arrays, described by where they start and
+# how many elements they have.  Their dtypes are fixed by the kind of
+# track, except for the values of a Numeric, which are in 'dtype'.
+track_dtype = numpy.dtype([('name_start', '<u8'),
+                           ('name_size', '<u8'),
+                           ('kind', '<u1'),
+                           ('dtype', 'S7'),
+                           ('offset', '<i8'),
+                           ('starts', '<u8', (3,)),
+                           ('counts', '<u8', (3,))])
+
+kinds = ['Sequence', 'Numeric', 'Traces']
+
+points_dtype = numpy.dtype('<f4')
+quantized_dtype = numpy.dtype('<i2')
+index_dtype = numpy.dtype('<i4')
+
+def quantize(points):
+    info = numpy.iinfo(quantized_dtype)
+    return numpy.clip(numpy.round(points * tracks.trace_scale),
+                      info.min, info.max).astype(quantized_dtype)
+
+def arrays(track, quantized=False):
+    """Return (kind, [arrays]) to store for *track*.
+
+    With *quantized*, the points of a Traces are stored as integers.
+    """
+    if isinstance(track, tracks.Traces):
+        if quantized:
+            points = quantize(track.points)
+        else:
+            points = numpy.ascontiguousarray(track.points, points_dtype)
+        return 'Traces', [points,
+                          numpy.ascontiguousarray(track.starts, index_dtype),
+                          numpy.ascontiguousarray(track.ends, index_dtype)]
+    elif isinstance(track, tracks.Sequence):
+        return 'Sequence', [numpy.frombuffer(str(track), dtype=numpy.uint8)]
+    elif isinstance(track, tracks.Numeric):
+        mask = numpy.array([x is None for x in track], dtype=numpy.uint8)
+        values = numpy.array([0 if x is None else x for x in track])
+        if values.dtype.kind not in 'iuf':
+            raise ValueError("Can only store numbers in a Numeric track")
+        return 'Numeric', [values.astype(values.dtype.newbyteorder('<')),
+                           mask]
+    raise ValueError("Cannot store a track of type %s" % type(track).__name__)
+
+def pad(n):
+    return (n + 7) & ~7
+
+def encode(trackset, meta={}, quantized=False):
+    """Return *trackset* and the dict *meta* in the track file format.
+
+    With *quantized*, trace points are stored as 16 bit integers, and
+    tracks.trace_scale is added to *meta* as 'trace_scale'.
+    """
+    if quantized:
+        meta = dict(meta, trace_scale=tracks.trace_scale)
+    entries = list(trackset)
+    table = numpy.zeros(len(entries), dtype=track_dtype)
+    blobs = []
+    position = [pad(header_dtype.itemsize + table.nbytes)]
+    def place(data):
+        start = position[0]
+        blobs.append((start, data))
+        position[0] = pad(start + len(data))
+        return start
+    for i, t in enumerate(entries):
+        kind, data = arrays(t.track, quantized)
+        name = t.name
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        table['name_start'][i] = place(name)
+        table['name_size'][i] = len(name)
+        table['kind'][i] = kinds.index(kind)
+        table['offset'][i] = t.offset
+        if kind == 'Numeric' or data[0].dtype == quantized_dtype:
+            table['dtype'][i] = data[0].dtype.str
+        for j, a in enumerate(data):
+            table['starts'][i, j] = place(a.tostring())
+            table['counts'][i, j] = len(a)
+    meta_json = json.dumps(meta)
+    header = numpy.zeros((), dtype=header_dtype)
+    header['magic'] = magic
+    header['version'] = version
+    header['ntracks'] = len(entries)
+    header['meta_start'] = place(meta_json)
+    header['meta_size'] = len(meta_json)
+
+    parts = [header.tostring(), table.tostring()]
+    end = header_dtype.itemsize + table.nbytes
+    for start, data in blobs:
+        parts.append('\0' * (start - end))
+        parts.append(data)
+        end = start + len(data)
+    return ''.join(parts)
+
+def save(filename, trackset, meta={}):
+    """Write *trackset* and the dict *meta* to *filename*.
+
+    The file is written under a temporary name and renamed, so readers
+    never see half a file.
+    """
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as h:
+        h.write(encode(trackset, meta))
+    os.rename(tmp, filename)
+
+class TrackFile(object):
+    """A track file whose tracks are decoded on first access.
+
+    Traces are views onto the mapped file, so their points are only
+    read from disk when they are rendered.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as h:
+            try:
+                self.buf = mmap.mmap(h.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                self.buf = h.read()
+        if len(self.buf) < header_dtype.itemsize or \
+                self.buf[:4] != magic:
+            raise ValueError("Not a track file: %s" % filename)
+        header = numpy.ndarray((), dtype=header_dtype, buffer=self.buf)
+        if header['version'] != version:
+            raise ValueError("Unsupported track file version %d in %s" %
+                             (header['version'], filename))
+        self.table = numpy.ndarray((int(header['ntracks']),),
+                                   dtype=track_dtype, buffer=self.buf,
+                                   offset=header_dtype.itemsize)
+        start = int(header['meta_start'])
+        self.meta = json.loads(self.buf[start:start+int(header['meta_size'])])
+        self.names = [self.buf[int(e['name_start']):
+                               int(e['name_start'] + e['name_size'])]
+                      for e in self.table]
+
+    def __len__(self):
+        return len(self.table)
+
+    def array(self, i, j, dtype, shape=()):
+        e = self.table[i]
+        return numpy.ndarray((int(e['counts'][j]),) + shape, dtype=dtype,
+                             buffer=self.buf, offset=int(e['starts'][j]))
+
+    def track(self, i):
+        kind = kinds[self.table[i]['kind']]
+        if kind == 'Sequence':
+            return tracks.sequence(self.array(i, 0, numpy.uint8).tostring())
+        elif kind == 'Numeric':
+            values = self.array(i, 0, self.table[i]['dtype']).tolist()
+            mask = self.array(i, 1, numpy.uint8)
+            for k in numpy.nonzero(mask)[0]:
+                values[k] = None
+            return tracks.numeric(values)
+        elif self.table[i]['dtype'] == quantized_dtype.str:
+            points = self.array(i, 0, quantized_dtype, (2,))
+            scale = self.meta.get('trace_scale', tracks.trace_scale)
+            return tracks.Traces((points / float(scale))
+                                 .astype(tracks.Traces.point_dtype),
+                                 self.array(i, 1, index_dtype, (4,)),
+                                 self.array(i, 2, index_dtype, (4,)))
+        else:
+            return tracks.Traces(self.array(i, 0, points_dtype, (2,)),
+                                 self.array(i, 1, index_dtype, (4,)),
+                                 self.array(i, 2, index_dtype, (4,)))
+
+    def entry(self, i):
+        return tracks.TrackEntry(self.names[i], int(self.table[i]['offset']),
+                                 self.track(i))
+
+    def trackset(self, names=None):
+        """Return a TrackSet of the tracks named in *names*, or all of them."""
+        return tracks.TrackSet([self.entry(i) for i in range(len(self))
+                                if names is None or self.names[i] in names])
+
+def load(filename, names=None):
+    """Return (trackset, meta) from *filename*.
+
+    If *names* is given, only the tracks with those names are read.
+    """
+    f = TrackFile(filename)
+    return f.trackset(names), f.meta
+
+def convert(pickle_filename, filename=None):
+    """Convert a pickle of (trackset, fate) to a track file.
+
+    *filename* defaults to the pickle's name with the extension .tracks.
+    """
+    if filename is None:
+        filename = os.path.splitext(pickle_filename)[0] + '.tracks'
+    with open(pickle_filename, 'rb') as h:
+        t, fate = tracks.load(h)
+    save(filename, t, {'fate': fate})
+    return filename
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        print >>sys.stderr, 'Usage: python -m seqviewer.trackfile FILE.pickle ...'
+        return 2
+    for p in argv:
+        print '%s -> %s' % (p, convert(p))
+    return 0
+
+
+def test_roundtrip():
+    import tempfile, shutil
+    t = tracks.TrackSet([
+        tracks.TrackEntry('traces', 2, tracks.pack_traces(
+            [{'A': [(0,1),(1,1)], 'C': [(0,0.5)], 'T': [(0,0),(1,0)],
+              'G': [(0.5,0)]}] * 3)),
+        tracks.TrackEntry('confidences', 2, tracks.numeric([4, None, 7])),
+        tracks.TrackEntry('bases', 2, tracks.sequence('AC-')),
+        tracks.TrackEntry('reference', 0, tracks.sequence('GGACT'))])
+    d = tempfile.mkdtemp()
+    try:
+        p = os.path.join(d, 'x.tracks')
+        save(p, t, {'fate': 'both'})
+        u, meta = load(p)
+        assert meta == {'fate': 'both'}
+        assert u == t
+        assert tracks.render(u) == tracks.render(t)
+        assert [type(e.track) for e in u] == [type(e.track) for e in t]
+        u, _ = load(p, names=['reference', 'confidences'])
+        assert u == [t[1], t[3]]
+        assert tracks.render(tracks.revcomp(load(p)[0][0].track), 0) == \
+            tracks.render(tracks.revcomp(t[0].track), 0)
+        with open(p, 'wb') as h:
+            h.write(encode(t, quantized=True))
+        u, meta = load(p)
+        assert meta == {'trace_scale': tracks.trace_scale}
+        assert [e.name for e in u] == [e.name for e in t]
+        assert numpy.array_equal(u[0].track.starts, t[0].track.starts)
+        assert abs(u[0].track.points - t[0].track.points).max() <= \
+            0.5 / tracks.trace_scale
+        assert u[0].track.render_span(0, 3) == t[0].track.render_span(0, 3)
+        with open(p, 'r+b') as h:
+            h.write('XXXX')
+        try:
+            load(p)
+            assert False
+        except ValueError:
+            pass
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    sys.exit(main())
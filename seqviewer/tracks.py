@@ -1,6 +1,12 @@
+import sys
 import numpy
+import cPickle
+import copy_reg
 from collections import namedtuple
 
+import simplify
+import instrument
+
 def base_color(base):
     base_coloring = {'A': 'green', 'C': 'blue', 'T': 'red', 
                      'G': 'black', 'U': 'red', 'X': 'black'}
@@ -9,17 +15,65 @@ def base_color(base):
     except KeyError:
         return 'yellow'
 
-class Traces(list, object):
+class Traces(object):
+    """Chromatogram traces, one polyline per base per channel.
+
+    All points live in one (P, 2) array *points*.  The polyline of
+    channel k (in the order 'ACTG') at base i is
+    points[starts[i,k]:ends[i,k]], with x running from 0 to 1 across
+    the base.  Slicing only slices *starts* and *ends*, complementing
+    permutes their columns, and indexing a single base returns a dict
+    of channel name to (n, 2) array view.
+    """
+    __slots__ = ('points', 'starts', 'ends')
     css_class = 'Traces'
+    channels = 'ACTG'
+    # Single precision is ample for points that are only ever
+    # rendered to three decimal places.
+    point_dtype = numpy.float32
+    index_dtype = numpy.int32
+
+    def __init__(self, points, starts, ends):
+        self.points = points
+        self.starts = starts
+        self.ends = ends
+    def __reduce__(self):
+        return (Traces, (self.points, self.starts, self.ends))
+    def __len__(self):
+        return len(self.starts)
+    def __getitem__(self, pos):
+        if isinstance(pos, slice):
+            return Traces(self.points, self.starts[pos], self.ends[pos])
+        s, e = self.starts[pos], self.ends[pos]
+        return dict((b, self.points[s[k]:e[k]])
+                    for k,b in enumerate(self.channels))
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def __eq__(self, other):
+        if not isinstance(other, Traces):
+            return NotImplemented
+        return len(self) == len(other) and \
+            all(numpy.array_equal(d1[b], d2[b])
+                for d1,d2 in zip(self, other) for b in self.channels)
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+    __hash__ = None
     def __comp__(self):
-        return Traces([{'A': d['T'], 'C': d['G'], 'T': d['A'], 'G': d['C']}
-                       for d in self])
+        # A <-> T and C <-> G in the order ACTG.
+        perm = [2, 3, 0, 1]
+        return Traces(self.points, self.starts[:,perm], self.ends[:,perm])
     def __rev__(self):
-        return Traces([{'A': rev_entry(d['A']), 
-                        'T': rev_entry(d['T']),
-                        'C': rev_entry(d['C']),
-                        'G': rev_entry(d['G'])}
-                       for d in self[::-1]])
+        # Reverse the point buffer, so each polyline is reversed and
+        # reflected in x, and move each polyline's span with it.
+        P = len(self.points)
+        points = self.points[::-1].copy()
+        points[:,0] = 1 - points[:,0]
+        return Traces(points, P - self.ends[::-1], P - self.starts[::-1])
+    def __cells__(self, start, stop):
+        # Every base draws different curves, so there is nothing to share.
+        return [self.__render__(i) for i in range(start, stop)]
     def __render__(self, pos):
         entry = self[pos]
         paths = ''
@@ -30,12 +84,136 @@ class Traces(list, object):
         return div(classes=['track-entry','Traces'],
                    body=div(classes='svg-container',
                             body=unit_svg(paths)))
+    def render_span(self, start, stop):
+        """Render bases *start* to *stop* as one SVG, one path per channel.
+
+        The SVG is meant to overlay the Traces cells of columns *start*
+        to *stop*, which are 1.3em wide each.  Coordinates are scaled
+        to integers (trace_scale per base across, and per unit of
+        height) and every point after the first is relative to the one
+        before, which keeps the paths several times smaller than the
+        per-base SVGs of __render__.
+        """
+        n = stop - start
+        paths = ''
+        for k,b in enumerate(self.channels):
+            paths += path(span_path(self.points, self.starts[start:stop,k],
+                                    self.ends[start:stop,k]),
+                          stroke=base_color(b),
+                          strokeWidth=str(int(0.03*trace_scale)))
+        return """<svg class="trace-span" style="width: %gem" """ \
+            """preserveAspectRatio="none" viewbox="0 %d %d %d" """ \
+            """version="1.1">""" % (column_width*n, -0.05*trace_scale,
+                                    n*trace_scale, 1.05*trace_scale) + \
+            paths + "</svg>"
+    def insert(self, pos, item):
+        extra = numpy.vstack([item[b] for b in self.channels])
+        counts = numpy.array([len(item[b]) for b in self.channels],
+                             dtype=self.index_dtype)
+        P = len(self.points)
+        s = P + numpy.cumsum(counts) - counts
+        return Traces(numpy.vstack([self.points,
+                                    extra.astype(self.point_dtype)]),
+                      numpy.insert(self.starts, pos, s, axis=0),
+                      numpy.insert(self.ends, pos, s + counts, axis=0))
+    def __regap__(self, gaps):
+        # All the gaps share one copy of the gap's points.
+        gapped = self.insert(len(self), self.gap)
+        rows = gap_rows(len(self), gaps)
+        return Traces(gapped.points, gapped.starts[rows], gapped.ends[rows])
     gap = {'A': numpy.array([(0.5,0)]), 'C': numpy.array([(0.5,0)]),
            'T': numpy.array([(0.5,0)]), 'G': numpy.array([(0.5,0)])}
 
-
-def rev_entry(d):
-    return [(1-x,y) for x,y in d[::-1]]
+# Width of a track-column in em, as set in the stylesheet.
+column_width = 1.3
+# Units per base and per trace height in compact SVG paths.
+trace_scale = 1000
+
+def span_path(points, starts, ends):
+    """Path data drawing the polylines points[starts[i]:ends[i]].
+
+    Polyline i is shifted i units right, and the coordinates are
+    multiplied by trace_scale and rounded.  Each polyline begins with
+    a move and continues with one line command; all but the first
+    coordinate are relative.
+    """
+    counts = ends - starts
+    if counts.sum() == 0:
+        return ''
+    # Indices of all the points, and which polyline each belongs to.
+    owner = numpy.repeat(numpy.arange(len(counts)), counts)
+    first = numpy.cumsum(counts) - counts
+    idx = numpy.arange(counts.sum()) - first[owner] + starts[owner]
+    xy = numpy.rint((points[idx] + numpy.column_stack([owner, owner*0])) *
+                    trace_scale).astype(int)
+    delta = xy.copy()
+    delta[1:] -= xy[:-1]
+    # Space separated, except before a minus sign.
+    coords = [('%d %d' % (x, y)).replace(' -', '-') for x,y in delta]
+    coords[0] = 'M' + coords[0]
+    d = []
+    pos = 0
+    for c in counts:
+        if c == 0:
+            continue
+        if pos > 0:
+            d.append('m' + coords[pos])
+        else:
+            d.append(coords[pos])
+        if c > 1:
+            d.append('l' + ' '.join(coords[pos+1:pos+c]).replace(' -', '-'))
+        pos += c
+    return ''.join(d)
+
+def test_span_path():
+    t = pack_traces([{'A': [(0,0.5),(0.5,0.25),(1,0.5)], 'C': [(0.5,0)],
+                      'T': [], 'G': [(0,1),(1,1)]},
+                     {'A': [(0,0.5),(1,0.75)], 'C': [(0.5,0)],
+                      'T': [], 'G': [(0,1),(1,0)]}])
+    assert span_path(t.points, t.starts[:,0], t.ends[:,0]) == \
+        'M0 500l500-250 500 250m0 0l1000 250'
+    assert span_path(t.points, t.starts[:,1], t.ends[:,1]) == 'M500 0m1000 0'
+    assert span_path(t.points, t.starts[:,2], t.ends[:,2]) == ''
+    assert span_path(t.points, t.starts[1:,3], t.ends[1:,3]) == 'M0 1000l1000-1000'
+    svg = t.render_span(0, 2)
+    assert svg.count('<path') == 4
+    assert 'viewbox="0 -50 2000 1050"' in svg
+    assert 'width: 2.6em' in svg
+
+def pack_traces(entries):
+    """Build a Traces from a sequence of dicts of channel to points."""
+    polylines = [numpy.asarray(d[b], dtype=Traces.point_dtype).reshape(-1, 2)
+                 for d in entries for b in Traces.channels]
+    counts = numpy.array([len(p) for p in polylines], dtype=Traces.index_dtype)
+    ends = numpy.cumsum(counts, dtype=Traces.index_dtype)
+    starts = ends - counts
+    shape = (len(polylines) // 4, 4)
+    if polylines:
+        points = numpy.vstack(polylines)
+    else:
+        points = numpy.zeros((0, 2), dtype=Traces.point_dtype)
+    return Traces(points, starts.reshape(shape), ends.reshape(shape))
+
+def test_traces_representation():
+    entries = [{'A': [(0,1),(1,1)], 'C': [(0,0.5)], 'T': [(0,0),(0.5,0.25),(1,0)],
+                'G': [(0.5,0)]},
+               {'A': [(0,0.125)], 'C': [(0,0.25),(1,0.375)], 'T': [(0,0.5)],
+                'G': [(0,0.625),(1,0.75)]}]
+    t = pack_traces(entries)
+    assert len(t) == 2
+    assert t[1]['C'].tolist() == [[0,0.25],[1,0.375]]
+    assert t[1:] == pack_traces(entries[1:])
+    assert comp(t)[0]['A'].tolist() == [[0,0],[0.5,0.25],[1,0]]
+    assert comp(t)[0]['G'].tolist() == [[0,0.5]]
+    r = rev(t)
+    assert r[0]['G'].tolist() == [[0,0.75],[1,0.625]]
+    assert r[1]['T'].tolist() == [[0,0],[0.5,0.25],[1,0]]
+    assert rev(rev(t)) == t
+    g = t.insert(1, Traces.gap)
+    assert len(g) == 3 and g[1]['A'].tolist() == [[0.5,0]]
+    assert g[:1] == t[:1] and g[2:] == t[1:]
+    assert cPickle.loads(cPickle.dumps(t)) == t
+    assert cPickle.loads(cPickle.dumps(t, 2)) == t
 
 
 def cutoff(a, n_hinges=6.1):
@@ -45,7 +223,24 @@ def cutoff(a, n_hinges=6.1):
     c = numpy.exp(m + n_hinges*d) - 1
     return c
 
-def sparsify(xs, ys):
+def sparsify(xs, ys, method='greedy', alpha=0.005, epsilon=0.01):
+    """Simplify the polyline *xs*, *ys* to fewer points.
+
+    *method* 'greedy' drops points lying within a fraction *alpha* of
+    the average height of the line through their neighbours (see
+    close_enough).  'rdp' uses Ramer-Douglas-Peucker, keeping every
+    dropped point within *epsilon* of the result, so *epsilon* trades
+    SVG size against fidelity.
+    """
+    if method == 'greedy':
+        return simplify.greedy(xs, ys, alpha)
+    elif method == 'rdp':
+        return simplify.rdp(xs, ys, epsilon)
+    else:
+        raise ValueError("Unknown sparsify method %s" % (method,))
+
+def looped_sparsify(xs, ys, alpha=0.005):
+    """The original, pure Python implementation of greedy sparsify."""
     new_points = [(xs[0], ys[0])]
     i = 0
     while i < len(ys)-1:
@@ -53,7 +248,7 @@ def sparsify(xs, ys):
         skipped = []
         while i < len(ys)-2 and len(skipped) < 10:
             nextx, nexty = xs[i+2], ys[i+2]
-            if all([close_enough(Lx,Ly, nextx,nexty, px,py)
+            if all([close_enough(Lx,Ly, nextx,nexty, px,py, alpha)
                     for px,py in skipped + [(Rx,Ry)]]):
                 skipped += [(Rx,Ry)]
                 Rx,Ry = nextx,nexty
@@ -72,8 +267,68 @@ def test_sparsify():
     ys = numpy.arange(4)
     assert sparsify(xs,ys) == [(0,0), (3,3)]
 
+def test_sparsify_matches_looped():
+    numpy.random.seed(0)
+    xs = numpy.arange(40) / 39.0
+    for alpha in [0.005, 0.05, 0.5]:
+        for ys in [numpy.random.rand(40), numpy.sin(xs*6)+1, 1-xs]:
+            assert sparsify(xs, ys, alpha=alpha) == \
+                looped_sparsify(xs, ys, alpha=alpha)
+
+def test_sparsify_rdp():
+    xs = numpy.arange(20) / 19.0
+    assert sparsify(xs, 1-xs, method='rdp') == [(0,1), (1,0)]
+    ys = numpy.sin(xs*6)
+    for epsilon in [0.001, 0.01, 0.1]:
+        points = sparsify(xs, ys, method='rdp', epsilon=epsilon)
+        px, py = zip(*points)
+        assert max(abs(numpy.interp(xs, px, py) - ys)) <= epsilon
+    assert len(sparsify(xs, ys, method='rdp', epsilon=0.1)) < \
+        len(sparsify(xs, ys, method='rdp', epsilon=0.001))
+
+
+def traces(A, C, T, G, centers, method='greedy', alpha=0.005, epsilon=0.01):
+    with instrument.span('traces', method=method):
+        channels = numpy.vstack([A, C, T, G]).astype(float)
+        centers = numpy.array(centers).astype(numpy.integer)
+        N = channels.shape[1]
+        assert all(centers >= 0) and all(centers < N)
+        assert all(sorted(centers) == centers)
+        # Base i spans starts[i] to ends[i], including the sample on
+        # each boundary, so neighbouring windows share one sample.
+        _limits = numpy.ceil((centers[1:] + centers[:-1]) / 2.0).astype(int)
+        starts = numpy.concatenate([[0], _limits])
+        ends = numpy.concatenate([_limits + 1, [N]])
+        # reduceat gives the maximum over starts[i]:starts[i+1]; the
+        # shared boundary sample is folded in afterwards.
+        peaks = channels.max(axis=0)
+        maxima = numpy.maximum.reduceat(peaks, starts)
+        maxima[:-1] = numpy.maximum(maxima[:-1], peaks[starts[1:]])
+        m = min(2*numpy.median(maxima), max(maxima))
+        ys = 1 - channels/m
+        xss = {}
+        entries = []
+        for l,r in zip(starts, ends):
+            n = r-l
+            if n not in xss:
+                xss[n] = numpy.arange(0,n) / float(n-1)
+            xs = xss[n]
+            entries.append(dict((b, sparsify(xs, ys[k,l:r], method, alpha, epsilon))
+                                for k,b in enumerate('ACTG')))
+        t = pack_traces(entries)
+        if instrument.active():
+            # How far sparsify cut down the samples of the four channels.
+            instrument.count('traces.samples', channels.size)
+            instrument.count('traces.points', len(t.points))
+            instrument.count('traces.reduction',
+                             float(channels.size) / max(len(t.points), 1))
+    return t
+
+def looped_traces(A, C, T, G, centers):
+    """The original, per-base implementation of traces.
 
-def traces(A, C, T, G, centers):
+    Kept as a reference for testing and benchmarking traces.
+    """
     A = numpy.array(A).astype(numpy.float)
     C = numpy.array(C).astype(numpy.float)
     G = numpy.array(G).astype(numpy.float)
@@ -89,7 +344,7 @@ def traces(A, C, T, G, centers):
     maxima = [max(numpy.concatenate([A[i:j],C[i:j],T[i:j],G[i:j]]))
               for i,j in limits]
     m = min(2*numpy.median(maxima), max(maxima))
-    t = Traces()
+    t = []
     for l,r in limits:
         xs = numpy.arange(0,r-l) / float(r-l-1)
         assert len(xs) == len(A[l:r]) == len(C[l:r]) \
@@ -98,9 +353,9 @@ def traces(A, C, T, G, centers):
                   'C': sparsify(xs, 1-C[l:r]/m),
                   'T': sparsify(xs, 1-T[l:r]/m),
                   'G': sparsify(xs, 1-G[l:r]/m)}), 
-    return t
+    return pack_traces(t)
 
-def close_enough(Lx,Ly, Rx,Ry, px,py):
+def close_enough(Lx,Ly, Rx,Ry, px,py, alpha=0.005):
     """Is px,py close enough to the line given by L and R to be approximated by it?"""
     # Find the vertical distance of px,py from the line through Lx,Ly
     # and Rx,Ry.  px,py is defined to be "close enough" if it no more
@@ -108,7 +363,6 @@ def close_enough(Lx,Ly, Rx,Ry, px,py):
     # from it.  The value of alpha here was selected by looking at the
     # output by eye and taking the highest value that left the curves
     # still looking reasonably smooth.
-    alpha = 0.005
     return abs(py - ((Ry-Ly)/float(Rx-Lx))*(px-Lx) - Ly) < alpha * (Ly + Ry)/2.0
 
     
@@ -122,6 +376,11 @@ def test_traces():
     assert len(t[0]['C']) == 2
     assert len(t[1]['A']) == 2
 
+def test_traces_matches_looped():
+    numpy.random.seed(0)
+    A, C, T, G = numpy.random.randint(0, 1000, size=(4, 200))
+    for centers in [[2,4,7], [5,5,30,100,199], [0,1,2], [50]]:
+        assert traces(A,C,T,G,centers) == looped_traces(A,C,T,G,centers)
 
 
 class Sequence(str, object):
@@ -135,14 +394,22 @@ class Sequence(str, object):
     def __rev__(self):
         return Sequence(self[::-1])
     def __render__(self, pos):
+        return self.cell(self[pos])
+    def __cells__(self, start, stop):
+        return self.fragments.lookup(list(self[start:stop]), self.cell)
+    @staticmethod
+    def cell(base):
         return div(classes=['track-entry','Sequence'],
-                   style="color: %s" % base_color(self[pos]),
-                   body=self[pos])
+                   style="color: %s" % base_color(base),
+                   body=base)
     gap = '-'
     def __isgap__(self, other):
         return other == '-' or other == '.'
     def insert(self, pos, item):
         return Sequence(self[:pos] + item + self[pos:])
+    def __regap__(self, gaps):
+        bases = numpy.frombuffer(str(self) + self.gap, dtype='S1')
+        return Sequence(bases[gap_rows(len(self), gaps)].tostring())
 
 def sequence(s):
     return Sequence(s)
@@ -154,8 +421,19 @@ class Numeric(list, object):
     def __comp__(self):
         return self
     def __render__(self, pos):
-        return div(classes=['track-entry','Numeric'],
-                   body=str(self[pos]))
+        return self.cell(self[pos])
+    def __cells__(self, start, stop):
+        # 1 and 1.0 are equal but render differently, so the type is
+        # part of the key.
+        return self.fragments.lookup([(v.__class__, v)
+                                      for v in self[start:stop]],
+                                     lambda (_, v): self.cell(v))
+    @staticmethod
+    def cell(value):
+        return div(classes=['track-entry','Numeric'], body=str(value))
+    def __regap__(self, gaps):
+        vals = list(self) + [self.gap]
+        return numeric([vals[i] for i in gap_rows(len(self), gaps)])
     gap = None
 
 def numeric(vals):
@@ -164,7 +442,7 @@ def numeric(vals):
 TrackEntry = namedtuple('TrackEntry', ['name', 'offset', 'track'])
 
 class TrackSet(list, object):
-    def __render__(self):
+    def labels(self):
         labels = div(classes='label', body=span('Position'))
         for t in self:
             if isinstance(t.track, Traces):
@@ -173,25 +451,98 @@ class TrackSet(list, object):
             else:
                 labels += div(classes='label',
                               body=span(t.name))
-        maxlen = max([len(x.track)+x.offset for x in self])
-        tracks = ""
-        for i in range(len(self)):
-            colbody = div(classes=['track-entry','integer'], body=str(i))
-            for t in self:
-                L = len(t.track)
-                c = t.track.css_class
-                if i < t.offset:
-                    colbody += div(classes=['track-entry','empty',c])
-                elif i < t.offset + L:
-                    colbody += render(t.track, pos=i-t.offset)
-                else:
-                    colbody += div(classes=['track-entry','empty',c])
-            tracks += div(classes=['track-column'], body=colbody)
-
-        return div(classes='trackset',
-                   body=div(classes='label-column', body=labels) + \
-                       div(classes='scrolling-container',
-                           body=tracks))
+        return labels
+    def column(self, i, start=None, stop=None):
+        """Render column *i*.
+
+        If *start* and *stop* are given, column *i* lies in the block
+        of columns start to stop, and Traces are drawn as one SVG per
+        block (see Traces.render_span) in the block's first cell of
+        each track instead of one SVG per cell.  columns gives the
+        same HTML for a block of columns, rendered track by track.
+        """
+        colbody = div(classes=['track-entry','integer'], body=str(i))
+        for t in self:
+            L = len(t.track)
+            c = t.track.css_class
+            if i < t.offset:
+                colbody += div(classes=['track-entry','empty',c])
+            elif i >= t.offset + L:
+                colbody += div(classes=['track-entry','empty',c])
+            elif start is None or not isinstance(t.track, Traces):
+                colbody += render(t.track, pos=i-t.offset)
+            elif i == max(start, t.offset):
+                colbody += div(classes=['track-entry','Traces'],
+                               body=t.track.render_span(
+                                   i - t.offset,
+                                   min(stop, t.offset + L) - t.offset))
+            else:
+                colbody += div(classes=['track-entry','Traces'])
+        return div(classes=['track-column'], body=colbody)
+    def iter_render(self, columns=100, compact=False):
+        """Yield the rendered TrackSet in pieces of *columns* columns.
+
+        Joining the pieces gives the same HTML as render, but only one
+        block of columns is held in memory at a time.  With *compact*,
+        each block draws each Traces track as a single SVG.
+        """
+        yield open_tag('div', classes='trackset') + \
+            div(classes='label-column', body=self.labels()) + \
+            open_tag('div', classes='scrolling-container')
+        n = len(self)
+        for start in range(0, n, columns):
+            yield self.columns(start, min(n, start+columns), compact)
+        yield close_tag('div') + close_tag('div')
+    def columns(self, start, stop, compact=False):
+        """Render columns *start* to *stop* (see column).
+
+        Rather than rendering cell by cell, each track renders its
+        cells in the block at once (see cells), and the cells are then
+        joined into columns.
+        """
+        number = div(classes=['track-entry','integer'], body='%d')
+        rows = [[number % i for i in range(start, stop)]]
+        for t in self:
+            rows.append(self.row(t, start, stop, compact))
+        column_open = open_tag('div', classes=['track-column'])
+        column_close = close_tag('div')
+        return ''.join([column_open + ''.join(cs) + column_close
+                        for cs in zip(*rows)])
+    def row(self, t, start, stop, compact=False):
+        """Return the cells of the TrackEntry *t* in columns *start* to *stop*."""
+        L = len(t.track)
+        lo = min(max(start, t.offset), stop)
+        hi = max(min(stop, t.offset + L), lo)
+        empty = empty_cell('empty', t.track.css_class)
+        if compact and isinstance(t.track, Traces) and hi > lo:
+            body = [div(classes=['track-entry','Traces'],
+                        body=t.track.render_span(lo - t.offset,
+                                                 hi - t.offset))] + \
+                [empty_cell('Traces')] * (hi - lo - 1)
+        else:
+            body = cells(t.track, lo - t.offset, hi - t.offset)
+        return [empty] * (lo - start) + body + [empty] * (stop - hi)
+    def render_frame(self, tile_url, columns=100):
+        """Render the TrackSet with its columns left to be fetched.
+
+        The scrolling container holds an empty placeholder, as wide as
+        the columns it stands for, for each block of *columns* columns.
+        The web interface fills a placeholder with the compact HTML of
+        its columns, fetched from *tile_url* with the query parameters
+        start and end, when it scrolls into view.
+        """
+        n = len(self)
+        tiles = ''.join(['<div class="tile" data-start="%d" data-end="%d" '
+                         'style="width: %gem"></div>' %
+                         (start, min(n, start+columns),
+                          column_width*(min(n, start+columns) - start))
+                         for start in range(0, n, columns)])
+        return open_tag('div', classes='trackset') + \
+            div(classes='label-column', body=self.labels()) + \
+            ('<div class="scrolling-container" data-tile-url="%s">' %
+             (tile_url,)) + tiles + close_tag('div') + close_tag('div')
+    def __render__(self):
+        return ''.join(self.iter_render())
     def __len__(self):
         return max([len(t.track)+t.offset for t in self])
 
@@ -210,29 +561,149 @@ def render(s, *args, **kwargs):
         isinstance(s, Numeric) or isinstance(s, Traces)
     return s.__render__(*args, **kwargs)
 
+def cells(s, start, stop):
+    """Return the rendered cells of positions *start* to *stop* of track *s*."""
+    return s.__cells__(start, stop)
+
+class Fragments(object):
+    """A bounded table of rendered cells, keyed by what they show.
+
+    A track renders each distinct cell in a block once, so rendering
+    costs one lookup per cell plus one render per distinct cell.  The
+    table is emptied when it would grow past *maxsize* fragments, and
+    never holds more than that: fragments beyond it are made for the
+    block at hand and not kept.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.table = {}
+    def lookup(self, keys, make):
+        """Return the fragment of each of *keys*, made by make(key) if new."""
+        table = self.table
+        missing = set(keys).difference(table)
+        if len(table) + len(missing) > self.maxsize:
+            table = self.table = {}
+            missing = set(keys)
+        made = {}
+        for k in missing:
+            if len(table) < self.maxsize:
+                table[k] = make(k)
+            else:
+                made[k] = make(k)
+        if made:
+            return [table[k] if k in table else made[k] for k in keys]
+        return map(table.__getitem__, keys)
 
-def regap(template, target):
+Sequence.fragments = Fragments()
+Numeric.fragments = Fragments()
+
+empty_cells = {}
+
+def empty_cell(*classes):
+    """A cell with no body and the classes 'track-entry' and *classes*."""
+    if classes not in empty_cells:
+        empty_cells[classes] = div(classes=['track-entry'] + list(classes))
+    return empty_cells[classes]
+
+
+def looped_regap(template, target):
     result = target
     gaps = [i for i,t in enumerate(template)
             if t == template.gap]
     for i in gaps:
         a = result.insert(i, result.gap)
-        if a != None:
+        if a is not None:
             result = a
     return result
 
+def gap_positions(template):
+    """Return the positions of the gaps in *template*, in increasing order."""
+    if isinstance(template, Sequence):
+        return numpy.nonzero(numpy.frombuffer(str(template), dtype='S1') ==
+                             template.gap)[0]
+    return numpy.array([i for i,t in enumerate(template)
+                        if t == template.gap], dtype=int)
+
+def gap_rows(n, gaps):
+    """Index an entry of *n* rows, plus a gap at row *n*, into a gapped one.
+
+    *gaps* are the positions of the gaps in the result, so the result
+    has n + len(gaps) rows.
+    """
+    is_gap = numpy.zeros(n + len(gaps), dtype=bool)
+    is_gap[gaps] = True
+    rows = numpy.cumsum(~is_gap) - 1
+    rows[is_gap] = n
+    return rows
+
+def regap(template, target):
+    """Insert gaps into *target* wherever *template* has them.
+
+    Builds the result in one pass, where inserting the gaps one at a
+    time (as looped_regap does) takes time proportional to the length
+    times the number of gaps.  *target* is left as it is.
+    """
+    return target.__regap__(gap_positions(template))
+
+
+def test_regap():
+    import random
+    r = random.Random(1)
+    for n in [0, 1, 5, 40]:
+        for frac in [0, 0.3, 0.9]:
+            bases = ''.join(r.choice('ACGT') for _ in range(n))
+            template = list(bases)
+            for _ in range(int(frac*n) + r.randrange(3)):
+                template.insert(r.randrange(len(template)+1), '-')
+            template = sequence(''.join(template))
+            confs = [r.randrange(60) for _ in range(n)]
+            trs = pack_traces([{'A': [(0, x/64.0), (1, x/64.0)], 'C': [(0.5, 0)],
+                                'T': [(0, 0.5)], 'G': [(0, 0.25), (1, 0.75)]}
+                               for x in confs])
+            assert regap(template, sequence(bases)) == template
+            assert regap(template, numeric(confs)) == \
+                looped_regap(template, numeric(confs))
+            assert regap(template, trs) == looped_regap(template, trs)
+            assert len(regap(template, trs)) == len(template)
+    confs = numeric([1, 2])
+    assert regap(sequence('A-C'), confs) == [1, None, 2]
+    assert confs == [1, 2]
+
+def legacy_reconstructor(cls, base, state):
+    if cls is Traces:
+        return pack_traces(state)
+    return copy_reg._reconstructor(cls, base, state)
+
+def find_global(module, name):
+    if (module, name) == ('copy_reg', '_reconstructor'):
+        return legacy_reconstructor
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+def load(h):
+    """Unpickle an object from the file *h*, converting old Traces.
+
+    Traces used to be a list of dicts of lists of points, and pickles
+    from then rebuild it with copy_reg._reconstructor.  That call is
+    intercepted here to pack the old lists into the current Traces.
+    """
+    unpickler = cPickle.Unpickler(h)
+    unpickler.find_global = find_global
+    return unpickler.load()
 
 
 ### XML
+def open_tag(name, classes=[], style=""):
+    if not(isinstance(classes, list)):
+        classes = [classes]
+    return """<%s class="%s" style="%s">""" % (name, ' '.join(classes), style)
+
+def close_tag(name):
+    return """</%s>""" % (name,)
+
 def tag(name):
     def f(body="", classes=[], style=""):
-        if not(isinstance(classes, list)):
-            classes = [classes]
-        return ("""<%s class="%s" style="%s">""" % (name,
-                                                    ' '.join(classes),
-                                                    style)) + \
-            body + \
-            ("""</%s>""" % (name,))
+        return open_tag(name, classes, style) + body + close_tag(name)
     return f
 
 div = tag('div')
@@ -254,15 +725,103 @@ def path(d, stroke="black", strokeWidth="0.03", fill="none"):
         (stroke, strokeWidth, fill, dstr)
         
 def standalone(tracksets):
+    return ''.join(iter_standalone(tracksets))
+
+def iter_standalone(tracksets, columns=100, compact=False):
+    """Yield a standalone HTML page of *tracksets* in pieces.
+
+    *tracksets* is a TrackSet or a list of (title, TrackSet) pairs.
+    Each TrackSet is rendered *columns* columns at a time, so memory
+    stays flat however long or numerous the tracksets are.  *compact*
+    is passed on to TrackSet.iter_render.
+    """
     if isinstance(tracksets, TrackSet):
-        tracksets = [tracksets]
-    xml = """<html><head>\n"""
-    xml += """<style>\n""" + stylesheet + "</style>\n"
-    xml += """</head><body>"""
+        tracksets = [('', tracksets)]
+    yield """<html><head>\n"""
+    yield """<style>\n""" + stylesheet + "</style>\n"
+    yield """</head><body>"""
     for title,t in tracksets:
-        xml += ("<h1>%s</h1>\n" % title) + render(t)
-    xml += """</body></html>"""
-    return xml
+        yield "<h1>%s</h1>\n" % title
+        for fragment in t.iter_render(columns, compact):
+            yield fragment
+    yield """</body></html>"""
+
+def write_standalone(tracksets, h, columns=100, compact=False):
+    """Write a standalone HTML page of *tracksets* to the file *h*.
+
+    *h* may be anything with a write method, such as the result of
+    socket.makefile('wb').
+    """
+    for fragment in iter_standalone(tracksets, columns, compact):
+        h.write(fragment)
+
+def test_iter_render():
+    import StringIO
+    t = TrackSet([TrackEntry('bases', 2, sequence('ACGTA')),
+                  TrackEntry('confidences', 0, numeric([1,2,3,4]))])
+    fragments = list(t.iter_render(columns=3))
+    assert len(fragments) == 2 + 3
+    assert ''.join(fragments) == render(t)
+    assert fragments[1].count('track-column') == 3
+    assert fragments[3].count('track-column') == 1
+    assert render(t).count('track-column') == 7
+    h = StringIO.StringIO()
+    write_standalone([('a', t), ('b', t)], h, columns=2)
+    assert h.getvalue() == standalone([('a', t), ('b', t)])
+    assert standalone(t) == standalone([('', t)])
+
+def test_compact_render():
+    tr = pack_traces([{'A': [(0,0.5),(1,0.5)], 'C': [(0.5,0)], 'T': [(0.5,0)],
+                       'G': [(0.5,0)]}] * 5)
+    t = TrackSet([TrackEntry('bases', 0, sequence('ACGTAC')),
+                  TrackEntry('traces', 1, tr)])
+    html = ''.join(t.iter_render(columns=4, compact=True))
+    # One SVG for columns 1-3 and one for 4-5, each cell still present.
+    assert html.count('<svg') == 2
+    assert html.count('<path') == 8
+    assert 'width: 3.9em' in html and 'width: 2.6em' in html
+    assert html.count('track-column') == 6
+    assert html.count('Traces') == 6
+    assert html.count('</svg>') == 2
+
+def test_fragments():
+    made = []
+    def make(k):
+        made.append(k)
+        return str(k)
+    f = Fragments(maxsize=4)
+    assert f.lookup([1, 2, 1], make) == ['1', '2', '1']
+    assert f.lookup([2, 3], make) == ['2', '3'] and sorted(made) == [1, 2, 3]
+    # A block with more distinct keys than fit is still rendered whole.
+    keys = range(10) + [9, 0]
+    assert f.lookup(keys, make) == map(str, keys)
+    assert len(f.table) == 4
+
+def test_columns_by_track():
+    tr = pack_traces([{'A': [(0,0.5),(1,0.5)], 'C': [(0.5,0)], 'T': [(0.5,0)],
+                       'G': [(0.5,0)]}] * 3)
+    t = TrackSet([TrackEntry('bases', 2, sequence('ACGTAC')),
+                  TrackEntry('confidences', 0, numeric([1, 1.0, None, 60])),
+                  TrackEntry('traces', 5, tr)])
+    for start, stop in [(0, 9), (0, 3), (3, 7), (6, 8), (8, 9)]:
+        assert t.columns(start, stop) == \
+            ''.join([t.column(i) for i in range(start, stop)])
+        assert t.columns(start, stop, compact=True) == \
+            ''.join([t.column(i, start, stop) for i in range(start, stop)])
+    f = Fragments(maxsize=3)
+    assert f.lookup(list('ABA'), str.lower) == ['a', 'b', 'a']
+    assert f.lookup(list('CD'), str.lower) == ['c', 'd']
+    assert sorted(f.table) == ['C', 'D']
+
+def test_render_frame():
+    t = TrackSet([TrackEntry('bases', 0, sequence('ACGTAC'))])
+    frame = t.render_frame('/samples/x/tile', columns=4)
+    assert 'data-tile-url="/samples/x/tile"' in frame
+    assert 'data-start="0" data-end="4" style="width: 5.2em"' in frame
+    assert 'data-start="4" data-end="6" style="width: 2.6em"' in frame
+    assert 'track-column' not in frame
+    assert t.columns(0, 4) + t.columns(4, 6) == t.columns(0, 6)
+    assert t.columns(0, 6) in render(t)
 
 
 stylesheet = """
@@ -333,6 +892,12 @@ stylesheet = """
     vertical-align: top;
 }
 
+.tile {
+    display: inline-block;
+    vertical-align: top;
+    white-space: nowrap;
+}
+
 @media print { .track-column {     
                    padding-bottom: 0.5em;
                    border-bottom: 0.1em double #000;
@@ -365,6 +930,15 @@ stylesheet = """
 .Traces {
     height: 4em !important;
     padding: 0;
+    position: relative;
+}
+
+.Traces > .trace-span {
+    position: absolute;
+    left: 0;
+    top: 0;
+    height: 100%;
+    z-index: 1;
 }
 
 .track-entry > .svg-container {
@@ -0,0 +1,121 @@
+"""
+trackset.py - Command line interface to stored TrackSets
+
+    python -m seqviewer.trackset init OUTPUT first.ab1 second.ab1 [a.fasta ...]
+    python -m seqviewer.trackset add OUTPUT a.fasta [b.fasta ...]
+    python -m seqviewer.trackset render OUTPUT output.html
+
+init assembles the two AB1 files and aligns the sequences in the FASTA
+files to the result.  add aligns further sequences to the reference of
+an existing OUTPUT without reassembling it.  OUTPUT is a track file,
+or a pickle if its name ends in .pickle.  Each sequence becomes a
+track named by its FASTA record's id, unless names are given with -n,
+one per sequence in order; a lab assembly should be named 'lab
+assembly' for the QC statistics in store.py.
+"""
+import os
+import sys
+import argparse
+import Bio.SeqIO
+
+import tracks
+import assemble
+import batch
+import store
+
+def read_fasta(filenames, names=()):
+    """Return (name, sequence) pairs for the records in *filenames*."""
+    seqs = [(r.id, tracks.sequence(str(r.seq)))
+            for f in filenames for r in Bio.SeqIO.parse(f, 'fasta')]
+    if len(names) > len(seqs):
+        raise ValueError("%d names given for %d sequences" %
+                         (len(names), len(seqs)))
+    return [(n, s) for n, (_, s) in zip(names, seqs)] + seqs[len(names):]
+
+def output_format(filename):
+    return filename.endswith('.pickle') and 'pickle' or 'tracks'
+
+def add(filename, seqs, catalog=None):
+    """Align the (name, sequence) pairs *seqs* into the sample in *filename*.
+
+    Only the new sequences are aligned; the reads, traces and
+    reference are copied as they are.  If *catalog* is given, the
+    sample's statistics there are updated.
+    """
+    t, fate = store.read_sample(filename)
+    t = assemble.add_sequences(t, seqs)
+    batch.store(t, fate, filename, output_format(filename))
+    if catalog is not None:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        catalog.add(name, filename, store.sample_stats(t, fate))
+    return t, fate
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Create, extend and render stored TrackSets.')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('init', help='assemble two AB1 files')
+    p.add_argument('output')
+    p.add_argument('read1')
+    p.add_argument('read2')
+    p.add_argument('fasta', nargs='*')
+    p.add_argument('-n', '--name', action='append', default=[],
+                   help='name of the next sequence')
+    p = commands.add_parser('add', help='align more sequences to a TrackSet')
+    p.add_argument('output')
+    p.add_argument('fasta', nargs='+')
+    p.add_argument('-n', '--name', action='append', default=[],
+                   help='name of the next sequence')
+    p.add_argument('--catalog', default=None,
+                   help='SQLite catalog to update (see store.py)')
+    p = commands.add_parser('render', help='render a TrackSet to HTML')
+    p.add_argument('output')
+    p.add_argument('html')
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        seqs = read_fasta(args.fasta, args.name)
+        t, fate = assemble.assemble(args.read1, args.read2, *seqs)
+        batch.store(t, fate, args.output, output_format(args.output))
+    elif args.command == 'add':
+        add(args.output, read_fasta(args.fasta, args.name),
+            args.catalog and store.Catalog(args.catalog))
+    else:
+        t, _ = store.read_sample(args.output)
+        name = os.path.splitext(os.path.basename(args.output))[0]
+        with open(args.html, 'w') as h:
+            tracks.write_standalone([(name, t)], h)
+    return 0
+
+
+def test_add():
+    import tempfile, shutil
+    here = os.path.join(os.path.dirname(__file__), '..', 'test_data')
+    read1 = os.path.join(here, 'tmpzRpKiy-1.ab1')
+    read2 = os.path.join(here, 'tmpzRpKiy-2.ab1')
+    lab = os.path.join(here, 'tmpzRpKiy.fasta')
+    d = tempfile.mkdtemp()
+    try:
+        p = os.path.join(d, 'x.tracks')
+        main(['init', p, read1, read2])
+        t, fate = store.read_sample(p)
+        assert [e.name for e in t][-1] == 'reference'
+        main(['add', p, lab, '-n', 'lab assembly'])
+        expected = assemble.assemble(read1, read2, *read_fasta([lab],
+                                                                ['lab assembly']))
+        assert store.read_sample(p) == expected
+        assert [e.name for e in expected[0]][-2:] == ['lab assembly',
+                                                     'mismatches']
+        # A second sequence leaves no single sequence to show
+        # mismatches against, as when assembling with both.
+        main(['add', p, lab])
+        t, _ = store.read_sample(p)
+        assert [e.name for e in t][-2:] == ['lab assembly',
+                                           'F34496_BLANCHETTE_14376']
+        main(['render', p, os.path.join(d, 'x.html')])
+        assert os.path.getsize(os.path.join(d, 'x.html')) > 0
+    finally:
+        shutil.rmtree(d)
+
+if __name__ == '__main__':
+    sys.exit(main())
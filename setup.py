@@ -5,6 +5,8 @@ import numpy
 
 setup(
     cmdclass = {'build_ext': build_ext},
-    ext_modules = [Extension("seqviewer.ab1", ["seqviewer/ab1.pyx"])],
+    ext_modules = [Extension("seqviewer.ab1", ["seqviewer/ab1.pyx"]),
+                   Extension("seqviewer.simplify", ["seqviewer/simplify.pyx"]),
+                   Extension("seqviewer.align", ["seqviewer/align.pyx"])],
     include_dirs = [numpy.get_include(),],
 )
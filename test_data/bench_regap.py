@@ -0,0 +1,33 @@
+import sys; sys.path.insert(0, '../')
+from seqviewer.tracks import regap, looped_regap, sequence, numeric, pack_traces
+import random
+import time
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - start
+
+# Gap a read of n bases in frac*n places, as an alignment against a
+# badly matching reference would, and time gapping each kind of track.
+r = random.Random(1)
+for n, frac in [(1000, 0.1), (1000, 0.5), (10000, 0.1), (10000, 0.5)]:
+    bases = ''.join(r.choice('ACGT') for _ in range(n))
+    template = list(bases)
+    for i in sorted(r.sample(xrange(n), int(frac*n)), reverse=True):
+        template.insert(i, '-')
+    template = sequence(''.join(template))
+    confs = [r.randrange(60) for _ in range(n)]
+    traces = pack_traces([{'A': [(0, 0.1), (0.5, 0.2), (1, 0.1)],
+                           'C': [(0, 0.3), (1, 0.4)], 'T': [(0.5, 0)],
+                           'G': [(0, 0.5), (1, 0.5)]}] * n)
+    for name, target in [('Sequence', sequence(bases)),
+                         ('Numeric', numeric(confs)),
+                         ('Traces', traces)]:
+        # looped_regap gaps a Numeric in place, so give it a copy.
+        copy = name == 'Numeric' and numeric(list(target)) or target
+        looped_t, looped = timed(looped_regap, template, copy)
+        t, single = timed(regap, template, target)
+        assert t == looped_t
+        print '%-8s %6d bases %5d gaps  looped %8.4fs  single pass %8.4fs' % \
+            (name, n, int(frac*n), looped, single)
@@ -0,0 +1,317 @@
+"""
+bench_stages.py - Time each stage of assembling and rendering a sample
+
+Run from test_data.  Every sample here is run through each stage on
+its own, once as read and once lengthened to each factor in
+--lengthen by tiling its traces, bases and confidences, so that how a
+stage scales with read length shows up too.  For each stage this
+prints the fastest of --repeats runs summed over the samples, its
+throughput in read bases per second, the peak memory the stage used on
+top of what was already resident, and the size of what it produced.
+
+    python bench_stages.py [--lengthen 1,8] [--repeats 3]
+                           [--save BASELINE.json]
+                           [--compare BASELINE.json] [--tolerance 0.2]
+
+--save writes the results as JSON; --compare reads such a file and
+flags every stage that got slower, or used or produced more, by more
+than --tolerance, exiting with status 1 if any did.
+"""
+import sys; sys.path.insert(0, '../')
+from seqviewer import ab1, tracks, contig, fasta, assemble, batch, trackfile
+import os
+import gc
+import json
+import time
+import cPickle
+import argparse
+import tempfile
+import shutil
+import resource
+import numpy
+
+def read_raw(filename):
+    f = ab1.ABIFFile(filename)
+    return {'bases': f.bases.tostring(),
+            'confidences': f.confidences.tolist(),
+            'channels': dict((b, numpy.array(f.channel(b), dtype=int))
+                             for b in 'ACTG'),
+            'centers': numpy.array(f.centers, dtype=int)}
+
+def lengthen(raw, factor):
+    """Tile the read *raw* *factor* times end to end."""
+    n = len(raw['channels']['A'])
+    return {'bases': raw['bases'] * factor,
+            'confidences': raw['confidences'] * factor,
+            'channels': dict((b, numpy.tile(c, factor))
+                             for b, c in raw['channels'].items()),
+            'centers': numpy.concatenate([raw['centers'] + i*n
+                                          for i in range(factor)])}
+
+def read_tracks(raw):
+    """The tracks ab1.read would return for *raw*."""
+    return {'sequence': tracks.sequence(raw['bases']),
+            'confidences': tracks.numeric(raw['confidences']),
+            'traces': tracks.traces(centers=raw['centers'],
+                                    **raw['channels'])}
+
+class Input(object):
+    """A sample lengthened *factor* times, with each stage's inputs."""
+    def __init__(self, sample, factor):
+        self.name = '%s x%d' % (sample.name, factor)
+        self.sample = sample
+        self.factor = factor
+        self.raw = [lengthen(read_raw(f), factor)
+                    for f in [sample.read1, sample.read2]]
+        self.bases = sum(len(r['bases']) for r in self.raw)
+        self.tracks = [read_tracks(r) for r in self.raw]
+        self.ref = assemble.contig_reads(*self.tracks)
+        seqs = [(n, tracks.sequence(s * factor))
+                for n, s in batch.lab_sequences(sample)]
+        self.trackset, self.fate = \
+            assemble.build_tracks(self.tracks[0], self.tracks[1],
+                                  self.ref, seqs)
+
+def traces_size(ts):
+    return sum(t.points.nbytes + t.starts.nbytes + t.ends.nbytes for t in ts)
+
+# Each stage is (name, run, size): run(input, tmpdir) does the work
+# and returns what it produced, and size(result) is its size in
+# bytes.  A stage whose run returns None does not apply to that input.
+
+def stage_ab1_read(x, d):
+    if x.factor != 1:
+        return None
+    return [ab1.read(f) for f in [x.sample.read1, x.sample.read2]]
+
+def stage_traces(x, d):
+    return [tracks.traces(centers=r['centers'], **r['channels'])
+            for r in x.raw]
+
+def stage_canny_mask(x, d):
+    return [contig.canny_mask(t['confidences']) for t in x.tracks]
+
+def stage_fasta(x, d):
+    return fasta.fasta(x.tracks[0]['sequence'],
+                       tracks.revcomp(x.tracks[1]['sequence']),
+                       backend='seeded')
+
+def stage_contig(x, d):
+    return assemble.contig_reads(*x.tracks)
+
+def stage_regap(x, d):
+    t1, t2 = x.tracks
+    s1, s2 = x.ref['read1'][1], x.ref['read2'][1]
+    return [tracks.regap(s1, t1['confidences']),
+            tracks.regap(s2, tracks.revcomp(t2['confidences'])),
+            tracks.regap(s1, t1['traces']),
+            tracks.regap(s2, tracks.revcomp(t2['traces']))]
+
+def stage_render(x, d):
+    return tracks.render(x.trackset)
+
+def stage_standalone(x, d):
+    return tracks.standalone([(x.name, x.trackset)])
+
+def stage_pickle_save(x, d):
+    p = os.path.join(d, 'x.pickle')
+    batch.save((x.trackset, x.fate), p)
+    return p
+
+def stage_pickle_load(x, d):
+    p = os.path.join(d, 'load.pickle')
+    if not os.path.exists(p):
+        batch.save((x.trackset, x.fate), p)
+    with open(p, 'rb') as h:
+        return tracks.load(h), p
+
+def stage_trackfile_save(x, d):
+    p = os.path.join(d, 'x.tracks')
+    trackfile.save(p, x.trackset, {'fate': x.fate})
+    return p
+
+def stage_trackfile_load(x, d):
+    p = os.path.join(d, 'load.tracks')
+    if not os.path.exists(p):
+        trackfile.save(p, x.trackset, {'fate': x.fate})
+    return trackfile.load(p), p
+
+stages = [
+    ('ab1.read', stage_ab1_read,
+     lambda r: sum(traces_size([t['traces']]) + len(t['sequence'])
+                   for t in r)),
+    ('traces', stage_traces, traces_size),
+    ('canny_mask', stage_canny_mask, lambda r: sum(len(m) for m in r)),
+    ('fasta', stage_fasta, lambda r: len(r[0][1]) + len(r[1][1])),
+    ('contig', stage_contig,
+     lambda r: len(r['reference'][1]) if r['reference'] else 0),
+    ('regap', stage_regap, lambda r: traces_size(r[2:])),
+    ('render', stage_render, len),
+    ('standalone', stage_standalone, len),
+    ('pickle.save', stage_pickle_save, os.path.getsize),
+    ('pickle.load', stage_pickle_load, lambda r: os.path.getsize(r[1])),
+    ('trackfile.save', stage_trackfile_save, os.path.getsize),
+    ('trackfile.load', stage_trackfile_load, lambda r: os.path.getsize(r[1])),
+]
+
+def memory_kb(field):
+    """Return *field* of /proc/self/status in kB, or None."""
+    try:
+        with open('/proc/self/status') as h:
+            for line in h:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+def reset_peak():
+    """Reset the peak RSS to the current RSS, if the kernel allows it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as h:
+            h.write('5')
+        return True
+    except IOError:
+        return False
+
+def peak_kb():
+    peak = memory_kb('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kB on Linux.  It cannot be reset, so it is
+        # only a bound on this stage's peak.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak
+
+def run_stage(run, size, inputs, repeats, d):
+    """Return the measurements of one stage over *inputs*."""
+    seconds = 0.0
+    bases = 0
+    output = 0
+    gc.collect()
+    before = memory_kb('VmRSS') or 0
+    reset_peak()
+    for x in inputs:
+        best = None
+        for _ in range(repeats):
+            start = time.time()
+            result = run(x, d)
+            elapsed = time.time() - start
+            if result is None:
+                break
+            best = elapsed if best is None else min(best, elapsed)
+        if best is None:
+            continue
+        seconds += best
+        bases += x.bases
+        output += size(result)
+        del result
+    peak = peak_kb()
+    return {'seconds': seconds,
+            'bases': bases,
+            'bases_per_second': bases / seconds if seconds else 0.0,
+            'peak_rss_kb': max(peak - before, 0),
+            'output_bytes': output}
+
+def run(directory, factors, repeats):
+    samples = batch.discover(directory)
+    d = tempfile.mkdtemp()
+    results = {}
+    try:
+        for factor in factors:
+            inputs = [Input(s, factor) for s in samples]
+            for name, f, size in stages:
+                for p in ['load.pickle', 'load.tracks']:
+                    if os.path.exists(os.path.join(d, p)):
+                        os.remove(os.path.join(d, p))
+                results['%s x%d' % (name, factor)] = \
+                    run_stage(f, size, inputs, repeats, d)
+            del inputs
+    finally:
+        shutil.rmtree(d)
+    return results
+
+def ordered(results):
+    names = [n for n, _, _ in stages]
+    def key(k):
+        name, factor = k.rsplit(' x', 1)
+        return (int(factor), names.index(name) if name in names else len(names), k)
+    return sorted(results, key=key)
+
+def report(results):
+    print '%-22s %10s %14s %10s %12s' % \
+        ('stage', 'time', 'bases/s', 'peak RSS', 'output')
+    for k in ordered(results):
+        r = results[k]
+        if not r['bases']:
+            continue
+        print '%-22s %8.2fms %14.0f %8dkB %12d' % \
+            (k, 1000*r['seconds'], r['bases_per_second'],
+             r['peak_rss_kb'], r['output_bytes'])
+
+# Time and memory are only flagged when they grow by at least this
+# much too, since stages taking a few milliseconds or pages vary that
+# much from run to run.
+time_slack = 0.002
+rss_slack_kb = 1024
+
+def compare(results, baseline, tolerance):
+    """Print *results* against *baseline*, returning the regressions."""
+    regressions = []
+    print '%-22s %10s %10s %8s %10s %10s' % \
+        ('stage', 'baseline', 'time', 'ratio', 'peak RSS', 'output')
+    for k in ordered(results):
+        r, b = results[k], baseline.get(k)
+        if b is None or not r['bases'] or not b['bases']:
+            continue
+        flags = []
+        ratio = r['seconds'] / b['seconds'] if b['seconds'] else 1.0
+        if ratio > 1 + tolerance and r['seconds'] > b['seconds'] + time_slack:
+            flags.append('time')
+        if r['peak_rss_kb'] > max(b['peak_rss_kb'] * (1 + tolerance),
+                                  b['peak_rss_kb'] + rss_slack_kb):
+            flags.append('memory')
+        if r['output_bytes'] > b['output_bytes'] * (1 + tolerance):
+            flags.append('output')
+        if flags:
+            regressions.append((k, flags))
+        print '%-22s %8.2fms %8.2fms %7.2fx %8dkB %10d  %s' % \
+            (k, 1000*b['seconds'], 1000*r['seconds'], ratio,
+             r['peak_rss_kb'], r['output_bytes'],
+             flags and 'REGRESSION (%s)' % ', '.join(flags) or '')
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark each stage of assembly and rendering.')
+    parser.add_argument('--directory', default='.',
+                        help='directory of samples (default: .)')
+    parser.add_argument('--lengthen', default='1,8',
+                        help='comma separated factors to lengthen reads by')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='keep the fastest of this many runs')
+    parser.add_argument('--save', default=None,
+                        help='write the results to this JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='compare with results saved by --save')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction a stage may worsen by before it '
+                        'is flagged (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    factors = [int(x) for x in args.lengthen.split(',')]
+    results = run(args.directory, factors, args.repeats)
+    if args.save:
+        with open(args.save, 'w') as h:
+            json.dump(results, h, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as h:
+            baseline = json.load(h)
+        regressions = compare(results, baseline, args.tolerance)
+        for k, flags in regressions:
+            print >>sys.stderr, 'regression: %s (%s)' % (k, ', '.join(flags))
+        return regressions and 1 or 0
+    report(results)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
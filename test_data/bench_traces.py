@@ -0,0 +1,26 @@
+import sys; sys.path.insert(0, '../')
+from seqviewer import ab1
+from seqviewer.tracks import traces, looped_traces
+import os
+import time
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - start
+
+total_looped = 0.0
+total_vectorized = 0.0
+for n in sorted([x for x in os.listdir('.') if x.endswith('.ab1')]):
+    f = ab1.ABIFFile(n)
+    channels = dict((b, f.channel(b)) for b in 'ACTG')
+    looped_t, looped = timed(looped_traces, centers=f.centers, **channels)
+    vectorized_t, vectorized = timed(traces, centers=f.centers, **channels)
+    assert looped_t == vectorized_t
+    total_looped += looped
+    total_vectorized += vectorized
+    print '%-20s %5d bases  looped %7.3fs  vectorized %7.3fs' % \
+        (n, len(f.centers), looped, vectorized)
+
+print '%-20s %5s         looped %7.3fs  vectorized %7.3fs' % \
+    ('total', '', total_looped, total_vectorized)
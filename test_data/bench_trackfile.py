@@ -0,0 +1,60 @@
+import sys; sys.path.insert(0, '../')
+from seqviewer import tracks, trackfile
+import os
+import time
+import cPickle
+import tempfile
+import shutil
+
+def timed(f, *args, **kwargs):
+    start = time.time()
+    result = f(*args, **kwargs)
+    return result, time.time() - start
+
+def load_pickle(filename):
+    with open(filename, 'rb') as h:
+        return tracks.load(h)
+
+def save_pickle(filename, obj, protocol):
+    with open(filename, 'wb') as h:
+        cPickle.dump(obj, h, protocol)
+
+# Run each operation this many times and keep the fastest.
+repeats = 5
+
+def best(f, *args, **kwargs):
+    return min(timed(f, *args, **kwargs)[1] for _ in range(repeats))
+
+d = tempfile.mkdtemp()
+totals = {}
+try:
+    print '%-12s %9s %9s %9s   %8s %8s %8s %8s %8s' % \
+        ('', 'text', 'binary', 'tracks', 'load', 'load', 'load',
+         'partial', 'save')
+    print '%-12s %9s %9s %9s   %8s %8s %8s %8s %8s' % \
+        ('', 'pickle', 'pickle', 'file', 'text', 'binary', 'tracks',
+         'tracks', 'tracks')
+    for n in sorted([x[:-7] for x in os.listdir('.') if x.endswith('.pickle')]):
+        obj = load_pickle('%s.pickle' % n)
+        text = os.path.join(d, 'text.pickle')
+        binary = os.path.join(d, 'binary.pickle')
+        tf = os.path.join(d, 'x.tracks')
+        save_pickle(text, obj, 0)
+        save_pickle(binary, obj, cPickle.HIGHEST_PROTOCOL)
+        row = [os.path.getsize(text), os.path.getsize(binary)]
+        save_t = best(trackfile.save, tf, obj[0], {'fate': obj[1]})
+        row.append(os.path.getsize(tf))
+        row.append(best(load_pickle, text))
+        row.append(best(load_pickle, binary))
+        row.append(best(trackfile.load, tf))
+        row.append(best(trackfile.load, tf, ['reference', 'lab assembly']))
+        row.append(save_t)
+        for i, x in enumerate(row):
+            totals[i] = totals.get(i, 0) + x
+        print '%-12s %9d %9d %9d   %7.2fms %7.2fms %7.2fms %7.2fms %7.2fms' % \
+            tuple([n] + row[:3] + [1000*x for x in row[3:]])
+    row = [totals[i] for i in range(len(totals))]
+    print '%-12s %9d %9d %9d   %7.2fms %7.2fms %7.2fms %7.2fms %7.2fms' % \
+        tuple(['total'] + row[:3] + [1000*x for x in row[3:]])
+finally:
+    shutil.rmtree(d)
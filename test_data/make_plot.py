@@ -1,6 +1,6 @@
 import sys; sys.path.insert(0, '../')
 from seqviewer.assemble import assemble
-from seqviewer.tracks import standalone, sequence
+from seqviewer.tracks import standalone, sequence, load
 import os
 import Bio.SeqIO
 import cPickle
@@ -10,7 +10,7 @@ for n in ['tmp_zrpuq', 'tmpzSwR7u', 'tmpzsxOCM',
           'tmpzubQwp', 'tmpzRpKiy', 'tmpzTyEvV', 'tmpzth38k']:
     if os.path.exists('%s.pickle' % n):
         with open('%s.pickle' % n) as h:
-            ts,fate = cPickle.load(h)
+            ts,fate = load(h)
     else:
         if os.path.exists('%s.fasta' % n):
             extra_seqs = [('lab assembly', 
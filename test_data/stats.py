@@ -1,7 +1,7 @@
 import sys; sys.path.insert(0, '../')
 import os
-import cPickle
 import seqviewer.tracks
+import seqviewer.store
 import collections
 
 AssemblyStats = collections.namedtuple('AssemblyStats',
@@ -14,37 +14,26 @@ frac_overlap = []
 lab_minus_alg_len = []
 names = []
 
-for n in [x[:-7] for x in os.listdir('.') if x.endswith('.pickle')]:
-    with open('%s.pickle' % n) as h:
-        ts,fate = cPickle.load(h)
-    ref = filter(lambda x: x.name == 'reference', ts)
-    lab = filter(lambda x: x.name == 'lab assembly', ts)
-
-    names.append(n)
-    lab_fate.append(lab != [] and 'lab assembled' or 'lab unassembled')
-    alg_fate.append(fate)
-
-    if lab != [] and fate != 'none':
-        lab = lab[0]
-        ref = ref[0]
-        diff = min(ref.offset+len(ref.track), lab.offset+len(lab.track)) - \
-            max(ref.offset, lab.offset)
-        frac_overlap.append(diff / (0.5 * (len(ref.track) + len(lab.track))))
-        lab_minus_alg_len.append(len(lab.track) - len(ref.track))
-
-        refseg = ref.track[lab.offset - min(ref.offset,lab.offset):]
-        labseg = lab.track[ref.offset - min(ref.offset,lab.offset):]
-        numer = sum([1 for x,y in zip(refseg,labseg) if x==y])
-        denom = sum([1 for x,y in zip(refseg,labseg)])
-        percent_ids.append(float(numer)/float(denom))
+# Only samples that are new or changed since the last run are read.
+catalog = seqviewer.store.Catalog('catalog.sqlite')
+seqviewer.store.index(catalog, '.')
+
+for r in catalog.samples():
+    names.append(r['name'])
+    lab_fate.append(r['lab_length'] is not None and 'lab assembled' or
+                    'lab unassembled')
+    alg_fate.append(r['fate'])
+    percent_ids.append(r['percent_identity'])
+    frac_overlap.append(r['overlap_fraction'])
+    if r['overlap_fraction'] is not None:
+        lab_minus_alg_len.append(r['lab_length'] - r['reference_length'])
     else:
-        percent_ids.append(None)
-        frac_overlap.append(None)
         lab_minus_alg_len.append(None)
-    if (percent_ids[-1] != None and percent_ids[-1] < 0.99) or \
-            (frac_overlap[-1] != None and frac_overlap[-1] < 0.90):
-        with open('%s.html' % n, 'w') as h:
-            print >>h, seqviewer.tracks.standalone([(n,ts)])
+
+for r in catalog.failing(0.99, 0.90):
+    ts, fate = seqviewer.store.read_sample(r['path'])
+    with open('%s.html' % r['name'], 'w') as h:
+        print >>h, seqviewer.tracks.standalone([(r['name'],ts)])
 
 print 'd <- data.frame('
 print '    names=c(' + ','.join(['"'+x+'"' for x in names]) + '),'